@@ -0,0 +1,104 @@
+"""Prebuilt snapshot of the explore catalog.
+
+The grouped catalog is serialized once and kept in memory with its ETag.
+Endpoints that change Exercises call ``invalidate()``, and the next read
+rebuilds it. Other workers do not see that call, so each snapshot also
+expires after CATALOG_SNAPSHOT_TTL_SECONDS.
+"""
+from collections import defaultdict
+from dataclasses import dataclass
+import asyncio
+import os
+import time
+from app.etag import make_etag
+from app.responses import dumps
+
+SNAPSHOT_TTL_SECONDS = float(os.getenv("CATALOG_SNAPSHOT_TTL_SECONDS", "300"))
+
+# Only the fields the explore screen shows
+CATALOG_PROJECTION = {
+    "category": 1,
+    "subcategory": 1,
+    "reps": 1,
+    "hold": 1,
+    "sets": 1,
+    "frequency": 1,
+    "description": 1,
+    "thumbnail_url": 1,
+    "video_url": 1,
+    "title": 1,
+}
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    body: bytes
+    etag: str
+    generation: int
+    built_at: float
+
+
+_snapshot: CatalogSnapshot | None = None
+_generation = 0
+_lock = asyncio.Lock()
+
+
+def invalidate():
+    global _generation
+    _generation += 1
+
+
+def _is_fresh(snapshot: CatalogSnapshot | None) -> bool:
+    return (
+        snapshot is not None
+        and snapshot.generation == _generation
+        and time.monotonic() - snapshot.built_at < SNAPSHOT_TTL_SECONDS
+    )
+
+
+async def build_catalog(exerciseCollection) -> list:
+    """Group exercises by category and subcategory in a single cursor pass."""
+    transformed = defaultdict(lambda: defaultdict(list))
+    async for exercise in exerciseCollection.find({}, CATALOG_PROJECTION).sort("_id", 1):
+        transformed[exercise.get("category")][exercise.get("subcategory")].append({
+            "_id": {"$oid": str(exercise["_id"])},
+            "reps": exercise.get("reps"),
+            "hold": exercise.get("hold"),
+            "sets": exercise.get("sets"),
+            "frequency": exercise.get("frequency"),
+            "description": exercise.get("description"),
+            "thumbnail_url": exercise.get("thumbnail_url"),
+            "video_url": exercise.get("video_url"),
+            "name": exercise.get("title"),
+        })
+    return [
+        {
+            "title": category,
+            "subcategory": [
+                {"subtitle": subcat, "exercises": exercises}
+                for subcat, exercises in subcategories.items()
+            ]
+        }
+        for category, subcategories in transformed.items()
+    ]
+
+
+async def get_snapshot(exerciseCollection) -> CatalogSnapshot:
+    global _snapshot
+    if _is_fresh(_snapshot):
+        return _snapshot
+
+    async with _lock:
+        # Another request may have rebuilt it while we waited
+        if _is_fresh(_snapshot):
+            return _snapshot
+        generation = _generation
+        catalog = await build_catalog(exerciseCollection)
+        body = dumps(catalog)
+        _snapshot = CatalogSnapshot(
+            body=body,
+            etag=make_etag(body),
+            generation=generation,
+            built_at=time.monotonic(),
+        )
+        return _snapshot
@@ -0,0 +1,167 @@
+"""Real-time chat fan-out.
+
+Each worker keeps the WebSockets connected to it in a ``ChatHub``. Saved
+messages are handed to a broker, which gets them to the hub (on whichever
+worker) holding the recipient's sockets:
+
+- ``InProcessBroker`` delivers straight to the local hub (single worker).
+- ``RedisBroker`` publishes on a per-user Redis channel and every worker
+  relays what it hears to its own hub. Set CHAT_BROKER_URL=redis://... to
+  use it; any redis.asyncio compatible client (e.g. fakeredis) can be
+  passed in directly for testing. If the subscription drops, the listener
+  logs it, backs off (doubling up to 30s) and subscribes again; messages
+  published meanwhile are not replayed.
+"""
+from collections import defaultdict
+import asyncio
+import json
+import os
+from fastapi import WebSocket
+
+
+class ChatHub:
+    """WebSocket connections held by this worker, keyed by user id."""
+
+    def __init__(self):
+        self._sockets: dict[str, set[WebSocket]] = defaultdict(set)
+
+    def add(self, user_id: str, websocket: WebSocket):
+        self._sockets[user_id].add(websocket)
+
+    def remove(self, user_id: str, websocket: WebSocket):
+        sockets = self._sockets.get(user_id)
+        if sockets is None:
+            return
+        sockets.discard(websocket)
+        if not sockets:
+            del self._sockets[user_id]
+
+    def is_connected(self, user_id: str) -> bool:
+        return user_id in self._sockets
+
+    async def deliver(self, user_id: str, payload: dict):
+        for websocket in list(self._sockets.get(user_id, ())):
+            try:
+                await websocket.send_json(payload)
+            except Exception:
+                # Socket went away between receive loops; drop it
+                self.remove(user_id, websocket)
+
+
+class InProcessBroker:
+    def __init__(self, hub: ChatHub):
+        self.hub = hub
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, user_id: str, payload: dict):
+        await self.hub.deliver(user_id, payload)
+
+
+class RedisBroker:
+    CHANNEL_PREFIX = "chat:"
+    RECONNECT_BASE_SECONDS = 0.5
+    RECONNECT_MAX_SECONDS = 30.0
+
+    def __init__(self, hub: ChatHub, redis):
+        self.hub = hub
+        self.redis = redis
+        self._pubsub = None
+        self._listener = None
+
+    @classmethod
+    def from_url(cls, hub: ChatHub, url: str):
+        import redis.asyncio
+        return cls(hub, redis.asyncio.from_url(url))
+
+    async def start(self):
+        await self._subscribe()
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        await self._unsubscribe()
+        await self.redis.aclose()
+
+    async def _subscribe(self):
+        pubsub = self.redis.pubsub()
+        await pubsub.psubscribe(self.CHANNEL_PREFIX + "*")
+        self._pubsub = pubsub
+
+    async def _unsubscribe(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub is not None:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+    async def publish(self, user_id: str, payload: dict):
+        await self.redis.publish(self.CHANNEL_PREFIX + user_id, json.dumps(payload, default=str))
+
+    async def _listen(self):
+        delay = self.RECONNECT_BASE_SECONDS
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                    print("Chat broker resubscribed to Redis")
+                async for message in self._pubsub.listen():
+                    delay = self.RECONNECT_BASE_SECONDS
+                    await self._relay(message)
+                error = "subscription closed"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e
+            print(f"Chat broker lost Redis ({error}), reconnecting in {delay:.1f}s")
+            await self._unsubscribe()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX_SECONDS)
+
+    async def _relay(self, message: dict):
+        if message["type"] != "pmessage":
+            return
+        channel = message["channel"]
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        user_id = channel[len(self.CHANNEL_PREFIX):]
+        # Every worker hears every channel; only relay to local sockets
+        if self.hub.is_connected(user_id):
+            try:
+                payload = json.loads(message["data"])
+            except ValueError as e:
+                print(f"Chat broker dropped a malformed message on {channel}: {e}")
+                return
+            await self.hub.deliver(user_id, payload)
+
+
+hub = ChatHub()
+broker: InProcessBroker | RedisBroker = InProcessBroker(hub)
+
+
+async def start_broker():
+    global broker
+    url = os.getenv("CHAT_BROKER_URL")
+    if url:
+        broker = RedisBroker.from_url(hub, url)
+    await broker.start()
+
+
+async def stop_broker():
+    await broker.stop()
+
+
+async def publish_message(message: dict):
+    """Push a saved message to both participants' connected sockets."""
+    payload = {"event": "message", "message": message}
+    await broker.publish(message["receiver_id"], payload)
+    if message["sender_id"] != message["receiver_id"]:
+        await broker.publish(message["sender_id"], payload)
@@ -1,9 +1,71 @@
-from pymongo import MongoClient
+from typing import Annotated
+from fastapi import Depends
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
 from pymongo.server_api import ServerApi
+from app import metrics
 import os
 
-def get_database():
-    uri = os.getenv('MONGO_DB_URI')
-    client = MongoClient(uri, server_api=ServerApi(version='1'))
-    print("✅ Connected to Mongo. Databases:", client.list_database_names())  # DEBUG
-    return client["Power_Play"]
+DATABASE_NAME = os.getenv("MONGO_DB_NAME", "Power_Play")
+
+# One client (and so one connection pool) per process, opened and closed by
+# the app lifespan in app/main.py.
+_client: AsyncIOMotorClient | None = None
+
+
+def client_options() -> dict:
+    """Pool and wire settings for the shared client, read from the environment."""
+    options = {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+        "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000")),
+    }
+    # Comma separated list, e.g. "zstd,zlib". Unset means no compression.
+    compressors = os.getenv("MONGO_COMPRESSORS")
+    if compressors:
+        options["compressors"] = compressors
+    if metrics.ENABLED:
+        options["event_listeners"] = [metrics.listener]
+    return options
+
+
+def connect(client: AsyncIOMotorClient | None = None) -> AsyncIOMotorClient:
+    """Open the shared client, or adopt ``client`` (benchmarks pass an in-process one)."""
+    global _client
+    if client is not None:
+        _client = client
+    if _client is None:
+        uri = os.getenv('MONGO_DB_URI')
+        _client = AsyncIOMotorClient(uri, server_api=ServerApi(version='1'), **client_options())
+    return _client
+
+
+def close():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+def get_database() -> AsyncIOMotorDatabase:
+    if _client is None:
+        raise RuntimeError("Mongo client is not connected; call app.database.connect() first")
+    return _client[DATABASE_NAME]
+
+
+def get_collection(name: str):
+    """Build a FastAPI dependency that returns the named collection."""
+    def dependency() -> AsyncIOMotorCollection:
+        return get_database()[name]
+    return dependency
+
+
+PatientCollection = Annotated[AsyncIOMotorCollection, Depends(get_collection("Patients"))]
+TherapistCollection = Annotated[AsyncIOMotorCollection, Depends(get_collection("Therapists"))]
+ExerciseCollection = Annotated[AsyncIOMotorCollection, Depends(get_collection("Exercises"))]
+RoutineCollection = Annotated[AsyncIOMotorCollection, Depends(get_collection("Routines"))]
+MessageCollection = Annotated[AsyncIOMotorCollection, Depends(get_collection("Messages"))]
+ConnectionCollection = Annotated[AsyncIOMotorCollection, Depends(get_collection("Connections"))]
+HistoryBucketCollection = Annotated[AsyncIOMotorCollection, Depends(get_collection("Patient_History_Buckets"))]
+ActivityCollection = Annotated[AsyncIOMotorCollection, Depends(get_collection("Patient_Activity"))]
+VideoCollection = Annotated[AsyncIOMotorCollection, Depends(get_collection("Videos"))]
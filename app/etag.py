@@ -0,0 +1,33 @@
+"""Helpers for conditional GET (ETag / If-None-Match)."""
+import hashlib
+from fastapi import Request, Response
+
+
+def make_etag(content: bytes) -> str:
+    """Strong ETag for a response body."""
+    return '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True when the request's If-None-Match already names ``etag``."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so a W/ prefix still matches
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag in candidates
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def version_etag(*parts) -> str:
+    """Strong ETag from a document's identity and its version counter(s).
+
+    Every write path bumps ``version`` with ``$inc``, so the tag can be
+    checked with a projection-only lookup instead of re-reading the document.
+    """
+    return make_etag(":".join(str(part) for part in parts).encode())
@@ -0,0 +1,299 @@
+"""Completion history stored as one document per patient per month.
+
+A bucket looks like::
+
+    {
+        "_id": "<patient_id>:2025-04",
+        "patient_id": "<patient_id>",
+        "month": "2025-04",
+        "completed_exercises": [{"_id", "title", "date"}, ...],
+        "completed_routines": [{"_id", "name", "date"}, ...],
+        "exercise_count": 12,
+        "routine_count": 3
+    }
+
+Writes are a single upserted ``$push`` so their cost does not depend on
+how much history a patient already has, and reads only fetch the months
+they cover.
+
+Each completion also bumps counters in Patient_Activity, which holds one
+document per patient per day plus one running total per patient::
+
+    {"_id": "<patient_id>:2025-04-12", "patient_id": ..., "day": "2025-04-12", "exercises": 3, "routines": 1}
+    {"_id": "<patient_id>:total", "patient_id": ..., "exercises": 120, "routines": 31}
+
+Charts read a date range of these with a single indexed query.
+
+Run ``python -m app.history migrate`` once to move the legacy
+one-document-per-patient Patient_History arrays into buckets, then
+``python -m app.history rollup`` to build the activity counters from them.
+"""
+from datetime import datetime
+import argparse
+import asyncio
+from pymongo import UpdateOne
+
+HISTORY_FIELDS = {
+    "exercise": ("completed_exercises", "exercise_count"),
+    "routine": ("completed_routines", "routine_count"),
+}
+ACTIVITY_COUNTERS = {"exercise": "exercises", "routine": "routines"}
+
+
+def month_key(when: datetime | str) -> str:
+    """'YYYY-MM' for a datetime or an ISO date string."""
+    if isinstance(when, str):
+        return when[:7]
+    return when.strftime("%Y-%m")
+
+
+def bucket_id(patient_id: str, month: str) -> str:
+    return f"{patient_id}:{month}"
+
+
+def months_between(start: datetime, end: datetime) -> list[str]:
+    """Every 'YYYY-MM' from start to end inclusive."""
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def bucket_ids_between(patient_id: str, start: datetime, end: datetime) -> list[str]:
+    return [bucket_id(patient_id, month) for month in months_between(start, end)]
+
+
+def day_key(when: datetime | str) -> str:
+    """'YYYY-MM-DD' for a datetime or an ISO date string."""
+    if isinstance(when, str):
+        return when[:10]
+    return when.strftime("%Y-%m-%d")
+
+
+def activity_id(patient_id: str, day: str) -> str:
+    return f"{patient_id}:{day}"
+
+
+def totals_id(patient_id: str) -> str:
+    return f"{patient_id}:total"
+
+
+def completion_update(patient_id: str, kind: str, entries: list[dict], month: str) -> tuple[dict, dict]:
+    """Filter and update document appending entries to a month's bucket."""
+    field, counter = HISTORY_FIELDS[kind]
+    return (
+        {"_id": bucket_id(patient_id, month)},
+        {
+            "$setOnInsert": {"patient_id": patient_id, "month": month},
+            "$push": {field: {"$each": entries}},
+            "$inc": {counter: len(entries)}
+        }
+    )
+
+
+async def record_completion(bucketCollection, activityCollection, patient_id: str, kind: str, entry: dict):
+    query, update = completion_update(patient_id, kind, [entry], month_key(entry["date"]))
+    counter = ACTIVITY_COUNTERS[kind]
+    day = day_key(entry["date"])
+    await asyncio.gather(
+        bucketCollection.update_one(query, update, upsert=True),
+        activityCollection.update_one(
+            {"_id": activity_id(patient_id, day)},
+            {"$setOnInsert": {"patient_id": patient_id, "day": day}, "$inc": {counter: 1}},
+            upsert=True
+        ),
+        activityCollection.update_one(
+            {"_id": totals_id(patient_id)},
+            {"$setOnInsert": {"patient_id": patient_id}, "$inc": {counter: 1}},
+            upsert=True
+        ),
+    )
+
+
+def history_cursor(date: str, position: int) -> str:
+    """Cursor for an entry: its date plus its position in the month's array.
+
+    Completions recorded in the same instant share a date, so the position
+    (arrays are append-only) breaks the tie.
+    """
+    return f"{date}_{position}"
+
+
+def parse_history_cursor(cursor: str) -> tuple[str, int | None]:
+    """(date, position) of a cursor; position is None for a bare date."""
+    date, separator, position = cursor.rpartition("_")
+    if not separator:
+        return cursor, None
+    return date, int(position)
+
+
+async def completion_page(
+    bucketCollection,
+    patient_id: str,
+    kind: str,
+    limit: int,
+    before: str | None = None,
+    start: str | None = None,
+    end: str | None = None
+) -> list[tuple[dict, str]]:
+    """Newest-first completions of one kind, up to ``limit + 1`` of them.
+
+    Returns ``(entry, cursor)`` pairs. ``before`` is an exclusive cursor
+    from history_cursor (a bare ISO date is also accepted), ``start``/``end``
+    inclusive YYYY-MM-DD bounds. Buckets are read newest month first and
+    reading stops as soon as the page is full, since every older bucket only
+    holds older entries. The extra entry tells the caller whether another
+    page exists.
+    """
+    field, _ = HISTORY_FIELDS[kind]
+    before_key = parse_history_cursor(before) if before else None
+    query = {"patient_id": patient_id}
+    months = {}
+    if start:
+        months["$gte"] = month_key(start)
+    upper = [bound for bound in (before, end) if bound]
+    if upper:
+        months["$lte"] = min(month_key(bound) for bound in upper)
+    if months:
+        query["month"] = months
+
+    entries = []
+    async for bucket in bucketCollection.find(query, {field: 1}).sort("month", -1):
+        for position, entry in enumerate(bucket.get(field, [])):
+            date = entry.get("date") or ""
+            if before_key:
+                before_date, before_position = before_key
+                if before_position is None:
+                    if date >= before_date:
+                        continue
+                elif (date, position) >= (before_date, before_position):
+                    continue
+            if start and date < start:
+                continue
+            if end and date[:10] > end:
+                continue
+            entries.append((date, position, entry))
+        if len(entries) > limit:
+            break
+    entries.sort(key=lambda item: item[:2], reverse=True)
+    return [(entry, history_cursor(date, position)) for date, position, entry in entries[:limit + 1]]
+
+
+async def migrate(db, batch_size: int = 500, dry_run: bool = False):
+    """Copy legacy Patient_History documents into monthly buckets.
+
+    Entries are added with ``$addToSet`` and the bucket counters are then
+    recomputed from the array sizes, so an interrupted run can simply be
+    started again. Each legacy document is flagged ``migrated_to_buckets``
+    once its buckets are written and is skipped afterwards.
+    """
+    legacy = db["Patient_History"]
+    buckets = db["Patient_History_Buckets"]
+    patients = entries = 0
+
+    async for doc in legacy.find({"migrated_to_buckets": {"$ne": True}}):
+        patient_id = doc["_id"]
+        operations = []
+        for kind, (field, _) in HISTORY_FIELDS.items():
+            by_month: dict[str, list] = {}
+            for entry in doc.get(field, []):
+                by_month.setdefault(month_key(entry.get("date") or ""), []).append(entry)
+            for month, month_entries in sorted(by_month.items()):
+                operations.append(UpdateOne(
+                    {"_id": bucket_id(patient_id, month)},
+                    {
+                        "$setOnInsert": {"patient_id": patient_id, "month": month},
+                        "$addToSet": {field: {"$each": month_entries}}
+                    },
+                    upsert=True
+                ))
+                entries += len(month_entries)
+
+        if not dry_run:
+            for start in range(0, len(operations), batch_size):
+                await buckets.bulk_write(operations[start:start + batch_size], ordered=False)
+            await buckets.update_many({"patient_id": patient_id}, [{"$set": {
+                counter: {"$size": {"$ifNull": [f"${field}", []]}}
+                for field, counter in HISTORY_FIELDS.values()
+            }}])
+            await legacy.update_one({"_id": patient_id}, {"$set": {"migrated_to_buckets": True}})
+        patients += 1
+
+    return {"patients": patients, "entries": entries, "dry_run": dry_run}
+
+
+async def rebuild_activity(db, batch_size: int = 500, dry_run: bool = False):
+    """Recompute every patient's Patient_Activity counters from the buckets.
+
+    Counters are overwritten with ``$set`` rather than incremented, so this
+    can be re-run at any time to repair drift.
+    """
+    buckets = db["Patient_History_Buckets"]
+    activity = db["Patient_Activity"]
+    patients = days = 0
+
+    for patient_id in await buckets.distinct("patient_id"):
+        daily: dict[str, dict[str, int]] = {}
+        totals = {counter: 0 for counter in ACTIVITY_COUNTERS.values()}
+        async for bucket in buckets.find({"patient_id": patient_id}):
+            for kind, (field, _) in HISTORY_FIELDS.items():
+                counter = ACTIVITY_COUNTERS[kind]
+                for entry in bucket.get(field, []):
+                    day = daily.setdefault(day_key(entry.get("date") or ""), {c: 0 for c in totals})
+                    day[counter] += 1
+                    totals[counter] += 1
+
+        operations = [
+            UpdateOne(
+                {"_id": activity_id(patient_id, day)},
+                {"$set": {"patient_id": patient_id, "day": day, **counts}},
+                upsert=True
+            )
+            for day, counts in sorted(daily.items())
+        ]
+        operations.append(UpdateOne(
+            {"_id": totals_id(patient_id)},
+            {"$set": {"patient_id": patient_id, **totals}},
+            upsert=True
+        ))
+
+        if not dry_run:
+            for start in range(0, len(operations), batch_size):
+                await activity.bulk_write(operations[start:start + batch_size], ordered=False)
+        patients += 1
+        days += len(daily)
+
+    return {"patients": patients, "days": days, "dry_run": dry_run}
+
+
+def main():
+    from dotenv import load_dotenv
+    from app import database
+
+    parser = argparse.ArgumentParser(prog="python -m app.history")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="move Patient_History arrays into monthly buckets")
+    migrate_parser.add_argument("--batch-size", type=int, default=500)
+    migrate_parser.add_argument("--dry-run", action="store_true")
+    rollup_parser = commands.add_parser("rollup", help="rebuild Patient_Activity counters from the buckets")
+    rollup_parser.add_argument("--batch-size", type=int, default=500)
+    rollup_parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    command = {"migrate": migrate, "rollup": rebuild_activity}[args.command]
+
+    load_dotenv()
+
+    async def run():
+        database.connect()
+        try:
+            print(await command(database.get_database(), args.batch_size, args.dry_run))
+        finally:
+            database.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
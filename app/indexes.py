@@ -0,0 +1,235 @@
+"""Indexes the routers' query shapes rely on.
+
+``INDEXES`` declares every index the app needs, per collection, and
+``QUERY_SHAPES`` lists the filters and sorts the endpoints send. On
+startup ``bootstrap`` runs in the background, so a slow or unreachable
+cluster never delays boot. It creates anything missing (idempotent) and
+prints what still is not there.
+
+``python -m app.indexes ensure`` does the same from a shell and
+``python -m app.indexes report`` prints a drift report. The report shows
+declared indexes that are missing, undeclared ones that exist, how often
+each index has been used (``$indexStats``) and which index, if any, the
+planner picks for each query shape (``explain``).
+"""
+import argparse
+import asyncio
+import json
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+
+INDEXES = {
+    "Patients": [
+        # get_patient_by_email
+        IndexModel([("email", ASCENDING)], name="patient_email"),
+        # update_patient_by_username
+        IndexModel([("username", ASCENDING)], name="patient_username"),
+        # delete_custome_routine pulls a routine from every patient it is assigned to
+        IndexModel([("assigned_routines._id", ASCENDING)], name="patient_assigned_routines"),
+        # the push dispatcher clears tokens Expo reports as unregistered
+        IndexModel([("expoPushToken", ASCENDING)], name="patient_push_token", sparse=True),
+    ],
+    "Therapists": [
+        # get_therapist_by_email
+        IndexModel([("email", ASCENDING)], name="therapist_email"),
+        # update_therapist_by_username
+        IndexModel([("username", ASCENDING)], name="therapist_username"),
+        IndexModel([("expoPushToken", ASCENDING)], name="therapist_push_token", sparse=True),
+    ],
+    "Connections": [
+        # one pair (toggle_mute, connect/disconnect, the message push mute
+        # check) and a patient's connections
+        IndexModel([("patient_id", ASCENDING), ("therapist_id", ASCENDING)], name="connection_pair"),
+        # get_user_connections for a therapist, paged in _id order
+        IndexModel([("therapist_id", ASCENDING), ("_id", ASCENDING)], name="therapist_connections"),
+    ],
+    "Messages": [
+        # get_messages: equality on both ends of the conversation, then
+        # keyset range + sort on (timestamp, _id)
+        IndexModel(
+            [("sender_id", ASCENDING), ("receiver_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+            name="conversation_timeline"
+        ),
+        # get_unread_counts / mark_messages_read: only unread messages are
+        # indexed, so the index stays small and the per-sender count is covered
+        IndexModel(
+            [("receiver_id", ASCENDING), ("sender_id", ASCENDING), ("timestamp", ASCENDING)],
+            name="unread_by_receiver",
+            partialFilterExpression={"read": False}
+        ),
+    ],
+    "Patient_History_Buckets": [
+        # every history read selects a patient's buckets, usually by month
+        IndexModel([("patient_id", ASCENDING), ("month", ASCENDING)], name="patient_months"),
+    ],
+    "Patient_Activity": [
+        # get_graph_data: one range scan over a patient's daily counters
+        IndexModel([("patient_id", ASCENDING), ("day", ASCENDING)], name="patient_days"),
+    ],
+    "Videos": [
+        # the media queue resumes unfinished jobs on startup
+        IndexModel([("status", ASCENDING)], name="video_status"),
+    ],
+}
+
+_SAMPLE_ID = ObjectId("000000000000000000000000")
+
+# (endpoint, collection, filter, sort) with placeholder values; only the
+# shape matters to the planner
+QUERY_SHAPES = [
+    ("get_patient_by_email", "Patients", {"email": "someone@example.com"}, None),
+    ("update_patient_by_username", "Patients", {"username": "someone"}, None),
+    ("delete_custome_routine", "Patients", {"assigned_routines": {"$elemMatch": {"_id": _SAMPLE_ID}}}, None),
+    ("push token cleanup", "Patients", {"expoPushToken": {"$in": ["ExponentPushToken[x]"]}}, None),
+    ("get_therapist_by_email", "Therapists", {"email": "someone@example.com"}, None),
+    ("update_therapist_by_username", "Therapists", {"username": "someone"}, None),
+    ("toggle_mute", "Connections", {"patient_id": "p", "therapist_id": "t"}, None),
+    ("get_user_connections (patient)", "Connections", {"patient_id": "p"}, [("_id", ASCENDING)]),
+    ("get_user_connections (therapist)", "Connections", {"therapist_id": "t"}, [("_id", ASCENDING)]),
+    ("get_messages", "Messages",
+        {"$or": [{"sender_id": "a", "receiver_id": "b"}, {"sender_id": "b", "receiver_id": "a"}]},
+        [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("get_unread_counts", "Messages", {"receiver_id": "a", "read": False}, None),
+    ("get_completed_exercises", "Patient_History_Buckets", {"patient_id": "p"}, [("month", DESCENDING)]),
+    ("get_graph_data", "Patient_Activity",
+        {"patient_id": "p", "day": {"$gte": "2025-01-01", "$lte": "2025-01-31"}}, [("day", ASCENDING)]),
+    ("media queue resume", "Videos", {"status": {"$in": ["queued", "processing", "retrying"]}, "lease_until": None}, None),
+]
+
+
+async def ensure_indexes(db):
+    for collection_name, indexes in INDEXES.items():
+        try:
+            await db[collection_name].create_indexes(indexes)
+        except PyMongoError as e:
+            print(f"Index creation failed for {collection_name}: {e}")
+
+
+def _key(spec) -> tuple:
+    return tuple((field, int(direction)) for field, direction in spec)
+
+
+async def missing_indexes(db) -> dict[str, list[str]]:
+    """Declared indexes with no index of the same key on the collection."""
+    missing = {}
+    for collection_name, indexes in INDEXES.items():
+        existing = await db[collection_name].index_information()
+        existing_keys = {_key(info["key"]) for info in existing.values()}
+        names = [
+            index.document["name"] for index in indexes
+            if _key(index.document["key"].items()) not in existing_keys
+        ]
+        if names:
+            missing[collection_name] = names
+    return missing
+
+
+async def bootstrap(db):
+    """Create the declared indexes, then say which are still missing."""
+    await ensure_indexes(db)
+    try:
+        missing = await missing_indexes(db)
+    except PyMongoError as e:
+        print(f"Index verification failed: {e}")
+        return
+    for collection_name, names in missing.items():
+        print(f"Missing indexes on {collection_name}: {', '.join(names)}")
+
+
+def _plan_indexes(plan) -> tuple[set[str], bool]:
+    """Index names used by an explain plan and whether it scans a collection."""
+    names, collscan = set(), False
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            collscan = True
+        if plan.get("indexName"):
+            names.add(plan["indexName"])
+        children = plan.values()
+    elif isinstance(plan, list):
+        children = plan
+    else:
+        return names, collscan
+    for child in children:
+        child_names, child_collscan = _plan_indexes(child)
+        names |= child_names
+        collscan = collscan or child_collscan
+    return names, collscan
+
+
+async def drift_report(db) -> dict:
+    missing = await missing_indexes(db)
+    collections = {}
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        declared_keys = {_key(index.document["key"].items()) for index in indexes}
+
+        try:
+            stats = await collection.aggregate([{"$indexStats": {}}]).to_list(length=None)
+            usage = {stat["name"]: stat["accesses"]["ops"] for stat in stats}
+        except OperationFailure:
+            # Not permitted on some hosted tiers
+            usage = None
+
+        collections[collection_name] = {
+            "missing": missing.get(collection_name, []),
+            "undeclared": [
+                name for name, info in existing.items()
+                if name != "_id_" and _key(info["key"]) not in declared_keys
+            ],
+            # Counters reset when the server restarts, so read this together
+            # with the uptime before dropping anything
+            "unused": sorted(name for name, ops in (usage or {}).items() if ops == 0 and name != "_id_"),
+            "usage": usage,
+        }
+
+    queries = []
+    for endpoint, collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            plan = (await cursor.explain()).get("queryPlanner", {}).get("winningPlan", {})
+        except PyMongoError as e:
+            queries.append({"endpoint": endpoint, "collection": collection_name, "error": str(e)})
+            continue
+        names, collscan = _plan_indexes(plan)
+        queries.append({
+            "endpoint": endpoint,
+            "collection": collection_name,
+            "indexes": sorted(names),
+            "collscan": collscan,
+        })
+
+    return {"collections": collections, "queries": queries}
+
+
+def main():
+    from dotenv import load_dotenv
+    from app import database
+
+    parser = argparse.ArgumentParser(prog="python -m app.indexes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("ensure", help="create every declared index that is missing")
+    commands.add_parser("report", help="print missing/undeclared/unused indexes and query plans as JSON")
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    async def run():
+        database.connect()
+        try:
+            db = database.get_database()
+            if args.command == "ensure":
+                await bootstrap(db)
+            else:
+                print(json.dumps(await drift_report(db), indent=2))
+        finally:
+            database.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Third-party clients (Rollbar, S3), built on first use.
+
+Nothing here does network I/O or imports the heavy SDKs until a request
+actually needs them, so importing the app stays fast and works offline.
+"""
+from functools import lru_cache
+import os
+from app.startup import timed
+
+PATIENT_VIDEOS_BUCKET = "powerplaypatientvids"
+CUSTOM_VIDEOS_BUCKET = "custom-exercise-vids"
+
+
+@lru_cache(maxsize=None)
+def get_rollbar():
+    with timed("rollbar", "lazy init"):
+        import rollbar
+        rollbar.init(
+            access_token=os.getenv("ROLLBAR_ACCESS_TOKEN"),
+            environment=os.getenv("ROLLBAR_ENVIRONMENT", "testenv"),
+            code_version='1.0'
+        )
+    return rollbar
+
+
+@lru_cache(maxsize=None)
+def get_s3_resource():
+    with timed("s3", "lazy init"):
+        import boto3
+        return boto3.resource('s3',
+            aws_access_key_id=os.getenv("PATIENTVIDS_KEY_ID"),
+            aws_secret_access_key=os.getenv("PATIENTVIDS_SECRET_KEY"),
+            region_name=os.getenv("PATIENTVIDS_REGION", "us-east-2")
+        )
+
+
+def get_s3_client():
+    """Low-level client sharing the resource's session, for multipart uploads."""
+    return get_s3_resource().meta.client
+
+
+def object_url(bucket: str, key: str) -> str:
+    region = os.getenv("PATIENTVIDS_REGION", "us-east-2")
+    return f"https://{bucket}.s3.{region}.amazonaws.com/{key}"
@@ -1,14 +1,84 @@
-from fastapi.middleware.cors import CORSMiddleware
-from typing import Union
-from fastapi import FastAPI
-from app.routers import common, patients, therapists
+from app.startup import timed, mark_ready, print_startup_report, startup_report
+from contextlib import asynccontextmanager
+import asyncio
+import os
 
+with timed("fastapi", "import"):
+    from fastapi.middleware.cors import CORSMiddleware
+    from typing import Union
+    from fastapi import FastAPI, Response
 
-app = FastAPI()
+# In dependency order, so each timing only covers the module itself
+with timed("mongo driver", "import"):
+    import motor.motor_asyncio  # noqa: F401 -- loaded here only so its cost gets its own entry
+
+with timed("metrics", "import"):
+    from app import metrics
+
+with timed("database", "import"):
+    from app import database
+
+with timed("indexes", "import"):
+    from app import indexes
+
+with timed("chat", "import"):
+    from app import chat
+
+with timed("media", "import"):
+    from app import media
+
+with timed("push", "import"):
+    from app import push
+
+with timed("notifications", "import"):
+    from app import notifications
+
+with timed("routers.common", "import"):
+    from app.routers import common
+
+with timed("routers.patients", "import"):
+    from app.routers import patients
+
+with timed("routers.therapists", "import"):
+    from app.routers import therapists
+
+with timed("routers.videos", "import"):
+    from app.routers import videos
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    with timed("mongo", "init"):
+        database.connect()
+    with timed("chat broker", "init"):
+        await chat.start_broker()
+    with timed("media queue", "init"):
+        await media.start_queue(database.get_database()["Videos"])
+    with timed("push queue", "init"):
+        await push.start_queue(database.get_database())
+        await notifications.start_notifier(database.get_database())
+    # Index builds talk to the cluster, so they run alongside serving
+    index_task = None
+    if os.getenv("MONGO_ENSURE_INDEXES", "1") == "1":
+        index_task = asyncio.create_task(indexes.bootstrap(database.get_database()))
+    mark_ready()
+    print_startup_report()
+    yield
+    if index_task is not None and not index_task.done():
+        index_task.cancel()
+    await notifications.stop_notifier()
+    await push.stop_queue()
+    await media.stop_queue()
+    await chat.stop_broker()
+    database.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(patients.router)
 app.include_router(therapists.router)
 app.include_router(common.router)
+app.include_router(videos.router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,6 +88,21 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+if metrics.ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
 @app.get("/")
 def read_root():
     return "Welcome to the Backend for PowerPlay: Physical Therapy!!"
+
+@app.get("/startup_report")
+def get_startup_report():
+    return startup_report()
+
+@app.get("/push_metrics")
+def get_push_metrics():
+    return push.queue.stats()
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,315 @@
+"""Background processing for uploaded media.
+
+Uploads are recorded as jobs in the Videos collection (one document per
+object key) and worked off by a small pool of asyncio workers, so the
+request handlers only accept bytes and return. A job moves through
+
+    queued -> processing -> uploaded
+                         -> retrying -> queued ...   (transient errors)
+                         -> rejected                  (file is not acceptable)
+                         -> failed                    (out of retries)
+                         -> pending                   (presigned upload not in S3 yet)
+
+A worker claims a job by setting ``owner`` (its process) and
+``lease_until`` along with the status, and keeps extending the lease while
+it works. On startup only jobs whose lease has run out, or that never had
+one, are picked up again, so a job another process is still working on is
+left alone.
+
+Files sent through /upload_video are spooled to MEDIA_SPOOL_DIR and the
+worker stores them in S3; presigned uploads are already in S3 and the
+worker verifies them. Custom exercise videos then get a thumbnail when
+ffmpeg is available. Every status change is pushed to the owner's chat
+socket as ``{"event": "media", "video": {...}}``.
+
+Settings: MEDIA_WORKERS (2), MEDIA_QUEUE_SIZE (100), MEDIA_MAX_ATTEMPTS
+(5), MEDIA_RETRY_BASE_SECONDS (2), MEDIA_LEASE_SECONDS (300),
+MEDIA_SPOOL_DIR (a temp directory).
+"""
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from uuid import uuid4
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+from pymongo import ReturnDocument
+from starlette.concurrency import run_in_threadpool
+from app import chat
+from app.integrations import get_s3_client, object_url, PATIENT_VIDEOS_BUCKET, CUSTOM_VIDEOS_BUCKET
+
+SUPPORTED_FILE_TYPES = {
+    "video/mp4" : "mp4",
+    "video/mov" : "mov",
+    "video/quicktime" : "mov",
+    "application/pdf" : "pdf",
+}
+UPLOAD_BUCKETS = {
+    "patient": PATIENT_VIDEOS_BUCKET,
+    "custom": CUSTOM_VIDEOS_BUCKET,
+}
+
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+# libmagic only needs the first few KB to identify these formats
+SNIFF_BYTES = 8 * 1024
+# S3 multipart parts must be at least 5 MiB; with two parts in flight this
+# bounds the memory a single transfer uses
+PART_SIZE = 5 * 1024 * 1024
+
+UNFINISHED = ["queued", "processing", "retrying"]
+INTERNAL_FIELDS = ("spool_path", "owner", "lease_until")
+
+
+class RejectedUpload(Exception):
+    """The file itself is unacceptable; retrying will not help."""
+
+
+class NotUploaded(Exception):
+    """A presigned upload was reported complete before it reached S3."""
+
+
+def spool_dir() -> Path:
+    path = Path(os.getenv("MEDIA_SPOOL_DIR") or Path(tempfile.gettempdir()) / "powerplay-media")
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def sniff(head: bytes) -> str:
+    import magic
+    return magic.from_buffer(head, mime=True)
+
+
+def public_job(video: dict) -> dict:
+    return {k: v for k, v in video.items() if k not in INTERNAL_FIELDS}
+
+
+async def store_spooled(video: dict) -> dict:
+    """Upload a spooled file to S3 in parts."""
+    from boto3.s3.transfer import TransferConfig
+    config = TransferConfig(multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE, max_concurrency=2)
+    await run_in_threadpool(
+        get_s3_client().upload_file,
+        video["spool_path"], video["bucket"], video["_id"],
+        ExtraArgs={"ContentType": video["content_type"]}, Config=config
+    )
+    return {"size": os.path.getsize(video["spool_path"])}
+
+
+async def verify_presigned(video: dict) -> dict:
+    """Check an object uploaded with a presigned POST is what was promised."""
+    from botocore.exceptions import ClientError
+    client = get_s3_client()
+    try:
+        head = await run_in_threadpool(client.head_object, Bucket=video["bucket"], Key=video["_id"])
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            raise NotUploaded("File has not been uploaded yet")
+        raise
+    sample = await run_in_threadpool(
+        client.get_object, Bucket=video["bucket"], Key=video["_id"], Range=f"bytes=0-{SNIFF_BYTES - 1}")
+    sample = await run_in_threadpool(sample["Body"].read)
+
+    file_type = sniff(sample)
+    if SUPPORTED_FILE_TYPES.get(file_type) != SUPPORTED_FILE_TYPES[video["content_type"]] \
+            or head["ContentLength"] > MAX_UPLOAD_BYTES:
+        # Not what was presigned for; don't keep it around
+        await run_in_threadpool(client.delete_object, Bucket=video["bucket"], Key=video["_id"])
+        raise RejectedUpload("Uploaded file does not match the requested type or size")
+    return {"size": head["ContentLength"], "etag": head["ETag"].strip('"')}
+
+
+async def make_thumbnail(video: dict) -> dict:
+    """Grab a frame one second in as the exercise thumbnail (needs ffmpeg)."""
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg or not video["content_type"].startswith("video/"):
+        return {}
+
+    client = get_s3_client()
+    source = video.get("spool_path") or await run_in_threadpool(
+        client.generate_presigned_url, "get_object",
+        Params={"Bucket": video["bucket"], "Key": video["_id"]}, ExpiresIn=600
+    )
+    thumbnail_key = f"{video['_id'].rsplit('.', 1)[0]}.jpg"
+    thumbnail_path = spool_dir() / thumbnail_key
+    process = await asyncio.create_subprocess_exec(
+        ffmpeg, "-y", "-loglevel", "error", "-ss", "1", "-i", source, "-frames:v", "1", str(thumbnail_path),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate()
+    if process.returncode != 0 or not thumbnail_path.exists():
+        print(f"Thumbnail failed for {video['_id']}: {stderr.decode(errors='replace').strip()}")
+        return {}
+    try:
+        await run_in_threadpool(
+            client.upload_file, str(thumbnail_path), video["bucket"], thumbnail_key,
+            ExtraArgs={"ContentType": "image/jpeg"}
+        )
+    finally:
+        thumbnail_path.unlink(missing_ok=True)
+    return {"thumbnail_url": object_url(video["bucket"], thumbnail_key)}
+
+
+async def process(video: dict) -> dict:
+    """Run every step for one job; returns the fields to record on success."""
+    if video.get("spool_path"):
+        result = await store_spooled(video)
+    else:
+        result = await verify_presigned(video)
+    if video["kind"] == "custom":
+        result.update(await make_thumbnail(video))
+    return result
+
+
+class MediaQueue:
+    def __init__(self, workers: int, maxsize: int, max_attempts: int, retry_base_seconds: float, lease_seconds: float):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.videoCollection = None
+        self._queue: asyncio.Queue | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def start(self, videoCollection):
+        self.videoCollection = videoCollection
+        self._queue = asyncio.Queue(self.maxsize)
+        for _ in range(self.workers):
+            self._spawn(self._work())
+        self._spawn(self._resume())
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def full(self) -> bool:
+        return self._queue is None or self._queue.full()
+
+    def submit(self, key: str):
+        """Queue a job that is already recorded as queued; raises QueueFull."""
+        self._queue.put_nowait(key)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _lease(self, seconds: float | None = None) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=seconds or self.lease_seconds)
+
+    async def _resume(self):
+        # Jobs left unfinished by a process whose lease has run out. A
+        # spooled file only exists on the worker that accepted it, so skip
+        # the ones not here.
+        now = datetime.now(timezone.utc)
+        unclaimed = {"status": {"$in": UNFINISHED}, "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]}
+        async for video in self.videoCollection.find(unclaimed):
+            if video.get("spool_path") and not os.path.exists(video["spool_path"]):
+                continue
+            # Only take it over if nobody claimed it since it was read
+            result = await self.videoCollection.update_one(
+                {"_id": video["_id"], "status": video["status"], "lease_until": video.get("lease_until")},
+                {"$set": {"status": "queued", "owner": None, "lease_until": None}}
+            )
+            if result.modified_count:
+                await self._queue.put(video["_id"])
+
+    async def _retry_later(self, key: str, delay: float):
+        await asyncio.sleep(delay)
+        result = await self.videoCollection.update_one(
+            {"_id": key, "status": "retrying", "owner": self.owner},
+            {"$set": {"status": "queued", "owner": None, "lease_until": None}}
+        )
+        if result.modified_count:
+            await self._queue.put(key)
+
+    async def _renew_lease(self, key: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await self.videoCollection.update_one(
+                {"_id": key, "owner": self.owner}, {"$set": {"lease_until": self._lease()}})
+
+    async def _work(self):
+        while True:
+            key = await self._queue.get()
+            try:
+                await self._run(key)
+            except Exception as e:
+                print(f"Media job {key} crashed: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _set(self, key: str, fields: dict):
+        video = await self.videoCollection.find_one_and_update(
+            {"_id": key}, {"$set": fields}, return_document=ReturnDocument.AFTER)
+        if video:
+            await self._notify(video)
+        return video
+
+    async def _notify(self, video: dict):
+        try:
+            await chat.broker.publish(video["owner_id"], {"event": "media", "video": public_job(video)})
+        except Exception as e:
+            print(f"Media status fan-out failed: {e}")
+
+    async def _run(self, key: str):
+        video = await self.videoCollection.find_one_and_update(
+            {"_id": key, "status": "queued"},
+            {"$set": {"status": "processing", "owner": self.owner, "lease_until": self._lease()}, "$inc": {"attempts": 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not video:
+            return
+        await self._notify(video)
+
+        renewal = asyncio.create_task(self._renew_lease(key))
+        try:
+            result = await process(video)
+        except RejectedUpload as e:
+            await self._finish(video, {"status": "rejected", "error": str(e)})
+        except NotUploaded as e:
+            # Back to waiting for the client to upload and call again
+            await self._set(key, {"status": "pending", "error": str(e), "owner": None, "lease_until": None})
+        except Exception as e:
+            if video["attempts"] >= self.max_attempts:
+                await self._finish(video, {"status": "failed", "error": str(e)})
+            else:
+                delay = self.retry_base_seconds * 2 ** (video["attempts"] - 1)
+                print(f"Media job {key} attempt {video['attempts']} failed, retrying in {delay}s: {e}")
+                # The lease covers the wait so nobody resumes it meanwhile
+                await self._set(key, {"status": "retrying", "error": str(e),
+                                      "lease_until": self._lease(delay + self.lease_seconds)})
+                self._spawn(self._retry_later(key, delay))
+        else:
+            await self._finish(video, {"status": "uploaded", "error": None, **result})
+        finally:
+            renewal.cancel()
+
+    async def _finish(self, video: dict, fields: dict):
+        fields["finished_at"] = datetime.now(timezone.utc).isoformat()
+        fields["owner"] = fields["lease_until"] = None
+        if video.get("spool_path"):
+            await run_in_threadpool(Path(video["spool_path"]).unlink, missing_ok=True)
+            fields["spool_path"] = None
+        await self._set(video["_id"], fields)
+
+
+queue = MediaQueue(
+    workers=int(os.getenv("MEDIA_WORKERS", "2")),
+    maxsize=int(os.getenv("MEDIA_QUEUE_SIZE", "100")),
+    max_attempts=int(os.getenv("MEDIA_MAX_ATTEMPTS", "5")),
+    retry_base_seconds=float(os.getenv("MEDIA_RETRY_BASE_SECONDS", "2")),
+    lease_seconds=float(os.getenv("MEDIA_LEASE_SECONDS", "300")),
+)
+
+
+async def start_queue(videoCollection):
+    await queue.start(videoCollection)
+
+
+async def stop_queue():
+    await queue.stop()
@@ -0,0 +1,219 @@
+"""Per-route request and Mongo metrics in Prometheus text format.
+
+``MetricsMiddleware`` times every HTTP request and labels it with the
+matched route template (``/patient/get_patient/{patient_id}``), not the
+raw path. ``listener`` is registered on the Mongo client and charges each
+command to the request that issued it. Motor copies the request's context
+into its executor threads, so a contextvar ties the two together. The
+result is a count of round trips and database time per route, and a
+histogram of commands per request that makes N+1 loops stand out.
+Commands issued outside a request (queues, index bootstrap) are recorded
+under the route ``background``; tasks a request starts to run after it
+must be created with a fresh context to land there too.
+
+``render()`` produces the /metrics body. Numbers are kept per process, so
+with several workers each one reports its own.
+
+Settings: METRICS_ENABLED (1), METRICS_SERVER_TIMING (0; adds a
+``Server-Timing`` header with the database time), METRICS_REPLY_BYTES (0;
+also count the BSON bytes of every reply, which re-encodes each one, so
+only turn it on while investigating).
+"""
+from bisect import bisect_left
+from contextvars import ContextVar
+import os
+import threading
+import time
+import bson
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "0") == "1"
+REPLY_BYTES = os.getenv("METRICS_REPLY_BYTES", "0") == "1"
+
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+    """Mongo work done on behalf of one request."""
+
+    def __init__(self):
+        self.commands = 0
+        self.failures = 0
+        self.db_seconds = 0.0
+        self.reply_bytes = 0
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.requests: dict[str, int] = {}  # by status code
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.commands_per_request = Histogram(COMMAND_COUNT_BUCKETS)
+        self.db = RequestStats()
+
+
+_current: ContextVar[RequestStats | None] = ContextVar("mongo_request_stats", default=None)
+_routes: dict[tuple[str, str], RouteMetrics] = {}
+_background = RequestStats()
+
+
+def _route(route: str, method: str) -> RouteMetrics:
+    metrics = _routes.get((route, method))
+    if metrics is None:
+        metrics = _routes[(route, method)] = RouteMetrics()
+    return metrics
+
+
+def _add(stats: RequestStats, seconds: float, reply_bytes: int, failed: bool):
+    with _lock:
+        stats.commands += 1
+        stats.db_seconds += seconds
+        stats.reply_bytes += reply_bytes
+        if failed:
+            stats.failures += 1
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        reply_bytes = len(bson.encode(event.reply)) if REPLY_BYTES else 0
+        _add(_current.get() or _background, event.duration_micros / 1e6, reply_bytes, False)
+
+    def failed(self, event):
+        _add(_current.get() or _background, event.duration_micros / 1e6, 0, True)
+
+
+listener = MongoCommandListener()
+
+
+def server_timing(stats: RequestStats, app_seconds: float) -> bytes:
+    return (
+        f'db;dur={stats.db_seconds * 1000:.1f};desc="commands={stats.commands}", '
+        f'app;dur={app_seconds * 1000:.1f}'
+    ).encode()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and Mongo usage per route template."""
+
+    def __init__(self, app, server_timing: bool = SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(stats, time.perf_counter() - start)))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            elapsed = time.perf_counter() - start
+            route = scope.get("route")
+            # Unmatched paths share one label so scanners can't grow the registry
+            template = getattr(route, "path", None) or "unmatched"
+            with _lock:
+                metrics = _route(template, scope["method"])
+                metrics.requests[str(status)] = metrics.requests.get(str(status), 0) + 1
+                metrics.latency.observe(elapsed)
+                metrics.commands_per_request.observe(stats.commands)
+                metrics.db.commands += stats.commands
+                metrics.db.failures += stats.failures
+                metrics.db.db_seconds += stats.db_seconds
+                metrics.db.reply_bytes += stats.reply_bytes
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _histogram(lines: list, name: str, histogram: Histogram, labels: dict):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+
+
+def render() -> str:
+    """Everything recorded so far, in the Prometheus text exposition format."""
+    with _lock:
+        routes = sorted(_routes.items())
+        mongo = [((route, method), metrics.db) for (route, method), metrics in routes]
+        mongo.append((("background", ""), _background))
+
+        lines = [
+            "# HELP http_requests_total Requests handled, by route template and status.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (route, method), metrics in routes:
+            for status, count in sorted(metrics.requests.items()):
+                lines.append(f"http_requests_total{_labels(route=route, method=method, status=status)} {count}")
+
+        lines += [
+            "# HELP http_request_duration_seconds Time from receiving a request to finishing its response.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (route, method), metrics in routes:
+            _histogram(lines, "http_request_duration_seconds", metrics.latency, {"route": route, "method": method})
+
+        lines += [
+            "# HELP mongo_commands_per_request Mongo commands issued while handling one request.",
+            "# TYPE mongo_commands_per_request histogram",
+        ]
+        for (route, method), metrics in routes:
+            _histogram(lines, "mongo_commands_per_request", metrics.commands_per_request, {"route": route, "method": method})
+
+        counters = [
+            ("mongo_commands_total", "counter", "Mongo commands issued.", "commands"),
+            ("mongo_command_failures_total", "counter", "Mongo commands that failed.", "failures"),
+            ("mongo_command_seconds_total", "counter", "Time spent in Mongo commands.", "db_seconds"),
+        ]
+        if REPLY_BYTES:
+            counters.append(("mongo_reply_bytes_total", "counter", "BSON bytes returned by Mongo.", "reply_bytes"))
+        for name, kind, help_text, field in counters:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for (route, method), stats in mongo:
+                lines.append(f"{name}{_labels(route=route, method=method)} {getattr(stats, field)}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,8 @@
+from pydantic import BaseModel
+from typing import Literal
+
+class UploadRequest(BaseModel):
+    owner_id: str
+    kind: Literal['patient', 'custom'] = 'patient'
+    content_type: str
+    size: int
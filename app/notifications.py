@@ -0,0 +1,174 @@
+"""Push notifications for new chat messages.
+
+``message_saved`` is called on the send path and never touches Mongo: it
+only records the message against its (sender, receiver) pair. The first
+message of a pair starts a short timer (PUSH_COALESCE_SECONDS); when it
+fires, one push covering every message in that window is queued on
+app.push, unless the pair's connection is muted or the receiver has no
+Expo token.
+
+Tokens and mute flags come from small TTL caches (PUSH_CACHE_TTL_SECONDS)
+filled off the request path. toggle_mute and profile updates drop the
+affected entries, so changes on this worker apply immediately and other
+workers pick them up within the TTL.
+"""
+from dataclasses import dataclass
+import asyncio
+import contextvars
+import os
+import time
+from app import push
+
+MAX_PREVIEW_CHARS = 180
+
+
+class TTLCache:
+    """Bounded dict whose entries expire; oldest entries go first when full."""
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: dict = {}
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            self._entries.pop(key, None)
+            return default
+        return entry[0]
+
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        if len(self._entries) >= self.maxsize:
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+
+_MISSING = object()
+
+
+@dataclass
+class PendingNotice:
+    count: int
+    last_message: dict
+
+
+def connection_key(user1: str, user2: str) -> frozenset:
+    return frozenset((user1, user2))
+
+
+def preview(message: dict) -> str:
+    text = message.get("message")
+    if message.get("type") in (None, "text") and isinstance(text, str) and text:
+        return text if len(text) <= MAX_PREVIEW_CHARS else text[:MAX_PREVIEW_CHARS - 1] + "…"
+    return f"New {message.get('type') or 'chat'} message"
+
+
+class MessageNotifier:
+    def __init__(self, window: float, cache_ttl: float):
+        self.window = window
+        self.tokens = TTLCache(cache_ttl)
+        self.mutes = TTLCache(cache_ttl)
+        self.db = None
+        self._pending: dict[tuple[str, str], PendingNotice] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def start(self, db):
+        self.db = db
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._pending.clear()
+
+    def message_saved(self, message: dict):
+        if self.db is None:
+            return
+        pair = (message["sender_id"], message["receiver_id"])
+        if pair[0] == pair[1]:
+            return
+        pending = self._pending.get(pair)
+        if pending:
+            pending.count += 1
+            pending.last_message = message
+            return
+        self._pending[pair] = PendingNotice(1, message)
+        # A fresh context, so the lookups are not charged to the request
+        # that happened to send the first message (its metrics are closed
+        # by the time the flush runs)
+        task = asyncio.create_task(self._flush_later(pair), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def forget_token(self, user_id: str):
+        self.tokens.discard(user_id)
+
+    def forget_mute(self, user1: str, user2: str):
+        self.mutes.discard(connection_key(user1, user2))
+
+    async def _flush_later(self, pair: tuple[str, str]):
+        await asyncio.sleep(self.window)
+        pending = self._pending.pop(pair, None)
+        if pending is None:
+            return
+        sender_id, receiver_id = pair
+        try:
+            muted, token = await asyncio.gather(
+                self._is_muted(sender_id, receiver_id),
+                self._token(receiver_id),
+            )
+            if muted or not token:
+                return
+            body = preview(pending.last_message) if pending.count == 1 else f"{pending.count} new messages"
+            push.queue.enqueue(token, body, {"type": "message", "sender_id": sender_id, "count": pending.count})
+        except asyncio.QueueFull:
+            print(f"Push queue full; dropped message notification for {receiver_id}")
+        except Exception as e:
+            print(f"Message notification failed: {e}")
+
+    async def _token(self, user_id: str) -> str | None:
+        token = self.tokens.get(user_id, _MISSING)
+        if token is _MISSING:
+            # Users are either patients or therapists and share the id space
+            patient, therapist = await asyncio.gather(
+                self.db["Patients"].find_one({"_id": user_id}, {"expoPushToken": 1}),
+                self.db["Therapists"].find_one({"_id": user_id}, {"expoPushToken": 1}),
+            )
+            user = patient or therapist or {}
+            token = user.get("expoPushToken") or None
+            self.tokens.set(user_id, token)
+        return token
+
+    async def _is_muted(self, user1: str, user2: str) -> bool:
+        key = connection_key(user1, user2)
+        muted = self.mutes.get(key)
+        if muted is None:
+            connection = await self.db["Connections"].find_one(
+                {"$or": [
+                    {"patient_id": user1, "therapist_id": user2},
+                    {"patient_id": user2, "therapist_id": user1},
+                ]},
+                {"is_muted": 1}
+            )
+            muted = bool(connection and connection.get("is_muted"))
+            self.mutes.set(key, muted)
+        return muted
+
+
+notifier = MessageNotifier(
+    window=float(os.getenv("PUSH_COALESCE_SECONDS", "5")),
+    cache_ttl=float(os.getenv("PUSH_CACHE_TTL_SECONDS", "60")),
+)
+
+
+async def start_notifier(db):
+    await notifier.start(db)
+
+
+async def stop_notifier():
+    await notifier.stop()
@@ -0,0 +1,279 @@
+"""Outbound Expo push notifications.
+
+Request handlers only ``enqueue``. A single background dispatcher drains
+the queue, coalescing whatever arrives within PUSH_BATCH_WINDOW_MS into
+one ``publish_multiple`` call of at most PUSH_BATCH_SIZE messages (Expo
+accepts 100 per request) over one reused HTTP session.
+
+Connection errors, rate limiting and Expo server errors are retried with
+exponential backoff and full jitter, up to PUSH_MAX_ATTEMPTS. A batch
+Expo rejects because of its contents is split into single sends so only
+the offending message is dropped. Tokens Expo reports as no
+longer registered are cleared from patients and therapists. The queue
+lives in memory, so pushes still waiting when the process stops are lost.
+
+Settings: PUSH_QUEUE_SIZE (10000), PUSH_BATCH_SIZE (100),
+PUSH_BATCH_WINDOW_MS (50), PUSH_MAX_ATTEMPTS (5), PUSH_RETRY_BASE_SECONDS (1).
+"""
+from collections import deque
+from dataclasses import dataclass, field
+import asyncio
+import os
+import random
+import time
+from starlette.concurrency import run_in_threadpool
+from app.integrations import get_rollbar
+
+EXPO_BATCH_LIMIT = 100
+# Request-level Expo error codes that say nothing about the messages
+TRANSIENT_ERROR_CODES = {"TOO_MANY_REQUESTS", "INTERNAL_SERVER_ERROR", "SERVER_ERROR"}
+
+
+def is_transient(exc) -> bool:
+    """Whether a PushServerError is worth retrying as a whole batch.
+
+    Rate limiting, 5xx responses and replies without an Expo error body are
+    about the request; anything else points at the messages in it.
+    """
+    status = getattr(exc.response, "status_code", None)
+    if status == 429 or (status is not None and status >= 500):
+        return True
+    if not exc.errors:
+        return True
+    codes = {error.get("code") for error in exc.errors if isinstance(error, dict)}
+    return bool(codes & TRANSIENT_ERROR_CODES)
+
+
+@dataclass
+class PendingPush:
+    token: str
+    body: str
+    data: dict | None = None
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    attempts: int = 0
+
+
+class PushMetrics:
+    def __init__(self, window: int = 1000):
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        # enqueue-to-accepted latency of the most recent deliveries
+        self.latencies = deque(maxlen=window)
+
+    def delivered(self, pending: PendingPush):
+        self.sent += 1
+        self.latencies.append((time.perf_counter() - pending.enqueued_at) * 1000)
+
+    def snapshot(self) -> dict:
+        latencies = sorted(self.latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None
+        return {
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "batches": self.batches,
+            "latency_ms": {
+                "last": round(self.latencies[-1], 2) if latencies else None,
+                "avg": round(sum(latencies) / len(latencies), 2) if latencies else None,
+                "p95": round(p95, 2) if latencies else None,
+            },
+        }
+
+
+class PushQueue:
+    def __init__(self, maxsize: int, batch_size: int, batch_window: float, max_attempts: int, retry_base_seconds: float):
+        self.maxsize = maxsize
+        self.batch_size = min(batch_size, EXPO_BATCH_LIMIT)
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.metrics = PushMetrics()
+        self.db = None
+        self._queue: asyncio.Queue | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._push_client = None
+
+    async def start(self, db):
+        self.db = db
+        self._queue = asyncio.Queue(self.maxsize)
+        self._spawn(self._dispatch())
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def enqueue(self, token: str, body: str, data: dict | None = None):
+        """Queue one notification; raises asyncio.QueueFull when saturated."""
+        if self._queue is None:
+            raise asyncio.QueueFull
+        self._queue.put_nowait(PendingPush(token, body, data))
+        self.metrics.enqueued += 1
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._queue.qsize() if self._queue else 0,
+            "scheduled_retries": sum(1 for task in self._tasks if task.get_name() == "push-retry"),
+            **self.metrics.snapshot(),
+        }
+
+    def _spawn(self, coroutine, name: str | None = None):
+        task = asyncio.create_task(coroutine, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _client(self):
+        if self._push_client is None:
+            from exponent_server_sdk import PushClient
+            import requests
+            session = requests.Session()
+            session.headers.update({
+                "accept": "application/json",
+                "accept-encoding": "gzip, deflate",
+                "content-type": "application/json",
+            })
+            self._push_client = PushClient(session=session)
+        return self._push_client
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._send(batch)
+            except Exception as e:
+                print(f"Push dispatch failed: {e}")
+                self.metrics.failed += len(batch)
+
+    async def _send(self, batch: list[PendingPush]):
+        from exponent_server_sdk import (
+            DeviceNotRegisteredError,
+            MessageRateExceededError,
+            PushMessage,
+            PushServerError,
+            PushTicketError,
+        )
+        from requests.exceptions import ConnectionError, HTTPError
+
+        rollbar = get_rollbar()
+        messages = [PushMessage(to=pending.token, body=pending.body, data=pending.data) for pending in batch]
+        self.metrics.batches += 1
+        try:
+            tickets = await run_in_threadpool(self._client().publish_multiple, messages)
+        except PushServerError as exc:
+            if is_transient(exc):
+                rollbar.report_exc_info(extra_data={
+                    'batch_size': len(batch),
+                    'status': getattr(exc.response, "status_code", None),
+                    'errors': exc.errors,
+                })
+                self._retry(batch)
+                return
+            if len(batch) > 1:
+                # Expo rejects the whole request for one malformed message;
+                # send individually so only that one is dropped
+                for pending in batch:
+                    await self._send([pending])
+                return
+            # Encountered some likely formatting/validation error.
+            rollbar.report_exc_info(
+                extra_data={
+                    'token': batch[0].token,
+                    'message': batch[0].body,
+                    'extra': batch[0].data,
+                    'errors': exc.errors,
+                    'response_data': exc.response_data,
+                })
+            self.metrics.failed += 1
+            return
+        except (ConnectionError, HTTPError):
+            # Encountered some Connection or HTTP error - retry a few times in
+            # case it is transient.
+            rollbar.report_exc_info(extra_data={'batch_size': len(batch)})
+            self._retry(batch)
+            return
+
+        unregistered = []
+        for pending, ticket in zip(batch, tickets):
+            try:
+                ticket.validate_response()
+                self.metrics.delivered(pending)
+            except DeviceNotRegisteredError:
+                unregistered.append(pending.token)
+                self.metrics.failed += 1
+            except MessageRateExceededError:
+                self._retry([pending])
+            except PushTicketError as exc:
+                # Encountered some other per-notification error.
+                rollbar.report_exc_info(
+                    extra_data={
+                        'token': pending.token,
+                        'message': pending.body,
+                        'extra': pending.data,
+                        'push_response': exc.push_response._asdict(),
+                    })
+                self.metrics.failed += 1
+        if unregistered:
+            await self._deactivate(unregistered)
+
+    def _retry(self, batch: list[PendingPush]):
+        for pending in batch:
+            pending.attempts += 1
+            if pending.attempts >= self.max_attempts:
+                self.metrics.failed += 1
+                continue
+            self.metrics.retried += 1
+            delay = random.uniform(0, self.retry_base_seconds * 2 ** (pending.attempts - 1))
+            self._spawn(self._requeue(pending, delay), name="push-retry")
+
+    async def _requeue(self, pending: PendingPush, delay: float):
+        await asyncio.sleep(delay)
+        await self._queue.put(pending)
+
+    async def _deactivate(self, tokens: list[str]):
+        """Stop pushing to devices Expo says are gone."""
+        # notifications imports this module
+        from app.notifications import notifier
+        for collection_name in ("Patients", "Therapists"):
+            collection = self.db[collection_name]
+            users = await collection.find({"expoPushToken": {"$in": tokens}}, {"_id": 1}).to_list(length=None)
+            if not users:
+                continue
+            await collection.update_many(
+                {"expoPushToken": {"$in": tokens}},
+                {"$set": {"expoPushToken": None}, "$inc": {"version": 1}}
+            )
+            # Otherwise message pushes keep using the cached token until it expires
+            for user in users:
+                notifier.forget_token(user["_id"])
+
+
+queue = PushQueue(
+    maxsize=int(os.getenv("PUSH_QUEUE_SIZE", "10000")),
+    batch_size=int(os.getenv("PUSH_BATCH_SIZE", str(EXPO_BATCH_LIMIT))),
+    batch_window=int(os.getenv("PUSH_BATCH_WINDOW_MS", "50")) / 1000,
+    max_attempts=int(os.getenv("PUSH_MAX_ATTEMPTS", "5")),
+    retry_base_seconds=float(os.getenv("PUSH_RETRY_BASE_SECONDS", "1")),
+)
+
+
+async def start_queue(db):
+    await queue.start(db)
+
+
+async def stop_queue():
+    await queue.stop()
@@ -0,0 +1,45 @@
+"""JSON responses for raw Mongo documents.
+
+``BSONResponse`` renders with orjson, which serializes dicts, lists,
+datetimes and UUIDs natively and calls ``bson_default`` only for the BSON
+types it does not know (ObjectId and Decimal128 become strings). Handlers
+return documents exactly as Motor produced them; nothing walks or copies
+them first.
+
+``ndjson_lines`` streams a cursor with the same encoding.
+
+Return it explicitly from handlers whose content holds BSON types: FastAPI
+runs ``jsonable_encoder`` over any other return value before the response
+class sees it, and that does not understand ObjectId.
+"""
+from bson import Decimal128, ObjectId
+from fastapi.responses import JSONResponse
+import orjson
+
+
+def bson_default(value):
+    if isinstance(value, (ObjectId, Decimal128)):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content) -> bytes:
+    return orjson.dumps(content, default=bson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class BSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+async def ndjson_lines(cursor):
+    """Encode documents one per line as the cursor yields them.
+
+    For a StreamingResponse: only the current batch is held in memory and
+    the first line goes out as soon as the first batch arrives.
+    """
+    async for document in cursor:
+        yield orjson.dumps(document, default=bson_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
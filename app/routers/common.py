@@ -1,101 +1,157 @@
-from collections import defaultdict
-from fastapi import HTTPException, APIRouter, UploadFile, status, Request
+import asyncio
+from typing import Literal
+from fastapi import HTTPException, APIRouter, UploadFile, status, Request, Query, WebSocket, WebSocketDisconnect
 from pymongo.errors import PyMongoError
-from app.database import get_database
+from app import catalog, chat
+from app.notifications import notifier
+from app.etag import etag_matches, not_modified, version_etag
+from app.database import (
+    PatientCollection,
+    TherapistCollection,
+    ExerciseCollection,
+    RoutineCollection,
+    MessageCollection,
+    ConnectionCollection,
+    HistoryBucketCollection,
+    ActivityCollection,
+)
+from app.history import totals_id
+from app.responses import BSONResponse
 from bson import ObjectId
 from uuid import uuid4
-from fastapi.responses import JSONResponse
-from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
 from pymongo.errors import PyMongoError
 import os
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
 
 
-patientCollection = get_database()["Patients"]
-therapistCollection = get_database()["Therapists"]
-exerciseCollection = get_database()["Exercises"]
-routineCollection = get_database()["Routines"]
-messageCollection = get_database()["Messages"]
-connectionCollection = get_database()["Connections"]
-completionCollection = get_database()["Patient_History"]
-patientHistoryCollection = get_database()["Patient_History"]
-
 router = APIRouter(tags=["Common"])
 
 @router.get("/get_explore_collection")
-def get_explore_collection():
-    exercises = exerciseCollection.find()
-    exercise_list = []
-    for exercise in exercises:
-        exercise["_id"] = str(exercise["_id"])
-        exercise_list.append(exercise)
-
-    def modify_exercises(exercise_list):
-        transformed = defaultdict(lambda: defaultdict(list))
-        for exercise in exercise_list:
-            category = exercise.get("category")
-            subcategory = exercise.get("subcategory")
-            transformed[category][subcategory].append({
-                "_id": {"$oid": exercise.get("_id")},
-                "reps": exercise.get("reps"),
-                "hold": exercise.get("hold"),
-                "sets": exercise.get("sets"),
-                "frequency": exercise.get("frequency"),
-                "description": exercise.get("description"),
-                "thumbnail_url": exercise.get("thumbnail_url"),
-                "video_url": exercise.get("video_url"),
-                "name": exercise.get("title"),
-            })
-        result = []
-        for category, subcategories in transformed.items():
-            result.append({
-                "title": category,
-                "subcategory": [
-                    {"subtitle": subcat, "exercises": exercises}
-                    for subcat, exercises in subcategories.items()
-                ]
-            })
-        return result
-
-    return modify_exercises(exercise_list)
+async def get_explore_collection(request: Request, exerciseCollection: ExerciseCollection):
+    # Served from the in-memory snapshot; rebuilt only after exercises change
+    snapshot = await catalog.get_snapshot(exerciseCollection)
+    if etag_matches(request, snapshot.etag):
+        return not_modified(snapshot.etag)
+    return Response(content=snapshot.body, media_type="application/json", headers={"ETag": snapshot.etag})
 
 @router.get("/get_exercise/{exercise_id}")
-def get_exercise_by_id(exercise_id: str):
-    exercise = exerciseCollection.find_one({"_id": ObjectId(exercise_id)})
+async def get_exercise_by_id(
+    exercise_id: str,
+    request: Request,
+    exerciseCollection: ExerciseCollection
+):
+    if request.headers.get("if-none-match"):
+        stamp = await exerciseCollection.find_one({"_id": ObjectId(exercise_id)}, {"version": 1})
+        if stamp is not None:
+            etag = version_etag("exercise", exercise_id, stamp.get("version", 0))
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+    exercise = await exerciseCollection.find_one({"_id": ObjectId(exercise_id)})
     if exercise is not None:
-        exercise["_id"] = str(exercise["_id"])
-        return exercise
+        return BSONResponse(exercise, headers={"ETag": version_etag("exercise", exercise_id, exercise.get("version", 0))})
     else:
         raise HTTPException(status_code=404, detail="Exercise not found")
     
 
-@router.get("/get_routine/{routine_id}")
-def get_routine_by_id(routine_id: str):
-    routine = routineCollection.find_one({"_id": ObjectId(routine_id)})
-
-    if routine:
-        routine["_id"] = str(routine["_id"])
-        # Extract exercise ObjectIds
-        exercise_ids = [exercise["_id"]
-                        for exercise in routine.get("exercises", [])]
-
-        # Fetch full exercise documents
-        exercises = list(exerciseCollection.find(
-            {"_id": {"$in": exercise_ids}}))
-
-        # Convert ObjectId to string for each exercise
-        for exercise in exercises:
-            exercise["_id"] = str(exercise["_id"])
+# support function
+async def hydrate_routines(routine_ids, exerciseCollection, routineCollection):
+    """Load routines with their full exercise documents embedded.
+
+    Always two round trips (one ``$in`` for the routines, one for every
+    exercise they reference) however many routines are requested. Routines
+    come back in the order of ``routine_ids`` and exercises in the order the
+    routine lists them; ids that no longer exist are skipped.
+    """
+    routine_ids = [ObjectId(routine_id) for routine_id in routine_ids]
+    if not routine_ids:
+        return []
+
+    routines = await routineCollection.find(
+        {"_id": {"$in": routine_ids}}).to_list(length=None)
+    routines_by_id = {routine["_id"]: routine for routine in routines}
+
+    exercise_ids = list({
+        exercise["_id"]
+        for routine in routines
+        for exercise in routine.get("exercises", [])
+        if exercise.get("_id")
+    })
+    exercises_by_id = {}
+    if exercise_ids:
+        async for exercise in exerciseCollection.find({"_id": {"$in": exercise_ids}}):
+            exercises_by_id[exercise["_id"]] = exercise
+
+    hydrated = []
+    for routine_id in routine_ids:
+        routine = routines_by_id.get(routine_id)
+        if routine is None:
+            continue
+        hydrated.append({
+            **routine,
+            "exercises": [
+                exercises_by_id[exercise["_id"]]
+                for exercise in routine.get("exercises", [])
+                if exercise.get("_id") in exercises_by_id
+            ],
+        })
+    return hydrated
+
+
+def routine_etag(routine_id, routine_version, exercise_versions):
+    """ETag for a hydrated routine: its own version plus each exercise's."""
+    return version_etag(
+        "routine", routine_id, routine_version,
+        *[f"{exercise_id}@{version}" for exercise_id, version in exercise_versions]
+    )
+
+
+async def current_routine_etag(routine_id, exerciseCollection, routineCollection):
+    """Compute a routine's ETag from version projections only."""
+    routine = await routineCollection.find_one(
+        {"_id": ObjectId(routine_id)}, {"version": 1, "exercises._id": 1})
+    if routine is None:
+        return None
+    exercise_ids = [exercise["_id"] for exercise in routine.get("exercises", []) if exercise.get("_id")]
+    versions = {}
+    if exercise_ids:
+        async for exercise in exerciseCollection.find({"_id": {"$in": exercise_ids}}, {"version": 1}):
+            versions[exercise["_id"]] = exercise.get("version", 0)
+    return routine_etag(
+        routine_id,
+        routine.get("version", 0),
+        [(str(exercise_id), versions[exercise_id]) for exercise_id in exercise_ids if exercise_id in versions]
+    )
 
-        # Attach full exercises to routine
-        routine["exercises"] = exercises
 
-        return routine
+@router.get("/get_routine/{routine_id}")
+async def get_routine_by_id(
+    routine_id: str,
+    request: Request,
+    exerciseCollection: ExerciseCollection,
+    routineCollection: RoutineCollection
+):
+    if request.headers.get("if-none-match"):
+        etag = await current_routine_etag(routine_id, exerciseCollection, routineCollection)
+        if etag is not None and etag_matches(request, etag):
+            return not_modified(etag)
+
+    routines = await hydrate_routines([routine_id], exerciseCollection, routineCollection)
+
+    if routines:
+        routine = routines[0]
+        etag = routine_etag(
+            routine_id,
+            routine.get("version", 0),
+            [(exercise["_id"], exercise.get("version", 0)) for exercise in routine["exercises"]]
+        )
+        return BSONResponse(routine, headers={"ETag": etag})
     else:
         raise HTTPException(status_code=404, detail="Routine not found")
 
 @router.post("/create_routine")
-def create_routine(routine: dict):
+async def create_routine(routine: dict, routineCollection: RoutineCollection):
     try:
         # Validate exercises array (if any) and ensure they are all ObjectId references
         if "exercises" in routine:
@@ -104,7 +160,8 @@ def create_routine(routine: dict):
                     exercise["_id"] = ObjectId(exercise["_id"])  # Convert string IDs to ObjectId
 
         # Insert new routine with exercises
-        routine_id = routineCollection.insert_one(routine).inserted_id
+        routine["version"] = 1
+        routine_id = (await routineCollection.insert_one(routine)).inserted_id
 
         # Return response with the routine ID
         return {"message": "Routine created successfully!", "routine_id": str(routine_id)}
@@ -123,46 +180,196 @@ def convert_message(doc):
     return doc
 
 
-@router.get("/messages/{user1}/{user2}")
-def get_messages(user1: str, user2: str):
-    # Query for all messages between user1 and user2
-    cursor = messageCollection.find({
-        "$or": [
-            {"sender_id": user1, "receiver_id": user2},
-            {"sender_id": user2, "receiver_id": user1}
-        ]
-    }).sort("timestamp", 1)
+def encode_message_cursor(msg):
+    return f"{msg['timestamp']}_{msg['_id']}"
+
 
-    messages = []
-    for msg in cursor:
-        messages.append(convert_message(msg))
+def decode_message_cursor(cursor: str):
+    try:
+        timestamp, message_id = cursor.rsplit("_", 1)
+        return timestamp, ObjectId(message_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid message cursor")
+
+
+def conversation_query(user1: str, user2: str, cursor=None, older=True):
+    """Messages between two users, optionally strictly older/newer than cursor.
+
+    The keyset condition is distributed into every $or branch so each branch
+    is an equality prefix on (sender_id, receiver_id) followed by a range on
+    (timestamp, _id), which the Messages index serves as a merge sort.
+    """
+    directions = [
+        {"sender_id": user1, "receiver_id": user2},
+        {"sender_id": user2, "receiver_id": user1}
+    ]
+    if cursor is None:
+        return {"$or": directions}
+
+    timestamp, message_id = cursor
+    op = "$lt" if older else "$gt"
+    branches = []
+    for direction in directions:
+        branches.append({**direction, "timestamp": {op: timestamp}})
+        branches.append({**direction, "timestamp": timestamp, "_id": {op: message_id}})
+    return {"$or": branches}
 
-    return JSONResponse(content=jsonable_encoder(messages))
 
-@router.put("/message/{user1}/{user2}")
-async def update_messages(user1: str, user2: str, request: Request):
-    data = await request.json()
-    message = data.get("message")
-    type = data.get("type")
+@router.get("/messages/{user1}/{user2}")
+async def get_messages(
+    user1: str,
+    user2: str,
+    messageCollection: MessageCollection,
+    limit: int = Query(50, ge=1, le=200),
+    before: str | None = None,
+    after: str | None = None
+):
+    """One page of a conversation, oldest first.
+
+    Without a cursor this is the latest ``limit`` messages. Pass ``before``
+    (the X-Before-Cursor header of a page) to load older history, or
+    ``after`` (X-After-Cursor) to load anything newer.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+
+    if after:
+        query = conversation_query(user1, user2, decode_message_cursor(after), older=False)
+        cursor = messageCollection.find(query).sort([("timestamp", 1), ("_id", 1)]).limit(limit)
+        page = await cursor.to_list(length=limit)
+    else:
+        query = conversation_query(user1, user2, decode_message_cursor(before) if before else None)
+        cursor = messageCollection.find(query).sort([("timestamp", -1), ("_id", -1)]).limit(limit)
+        page = await cursor.to_list(length=limit)
+        page.reverse()
+
+    headers = {}
+    if page:
+        headers["X-Before-Cursor"] = encode_message_cursor(page[0])
+        headers["X-After-Cursor"] = encode_message_cursor(page[-1])
+    elif after:
+        headers["X-After-Cursor"] = after
+
+    return BSONResponse(content=page, headers=headers)
+
+# support function
+async def save_message(messageCollection, sender_id: str, receiver_id: str, message, type):
+    """Persist a chat message, fan it out to connected sockets and queue a push."""
     tempObj: dict = {
-        "sender_id": user1,
-        "receiver_id": user2,
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
         "type": type,
         "read": False,
         "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
         "message": message}
+
+    await messageCollection.insert_one(tempObj)
+    saved = convert_message(tempObj)
+    try:
+        await chat.publish_message(saved)
+    except Exception as e:
+        # The message is stored; clients will still see it on their next fetch
+        print(f"Chat fan-out failed: {e}")
+    notifier.message_saved(saved)
+    return saved
+
+
+@router.put("/message/{user1}/{user2}")
+async def update_messages(
+    user1: str,
+    user2: str,
+    request: Request,
+    messageCollection: MessageCollection
+):
+    data = await request.json()
     
     try: 
-        message_id = messageCollection.insert_one(tempObj)
-        return {"message": "Message sent successfully", "message_id" : str(message_id.inserted_id)}
+        saved = await save_message(messageCollection, user1, user2, data.get("message"), data.get("type"))
+        return {"message": "Message sent successfully", "message_id" : saved["_id"]}
     except PyMongoError as e:
         raise HTTPException(status_code=500, detail="Database update failed")
 
-# @router.websocket("/chat")
-# def chat(websocket):
+
+@router.websocket("/chat/{user_id}")
+async def chat_socket(websocket: WebSocket, user_id: str, messageCollection: MessageCollection):
+    """Send and receive messages for user_id in real time.
+
+    Clients send {"receiver_id", "message", "type"}; every saved message is
+    pushed to both participants as {"event": "message", "message": {...}}.
+    """
+    await websocket.accept()
+    chat.hub.add(user_id, websocket)
+    try:
+        while True:
+            data = await websocket.receive_json()
+            receiver_id = data.get("receiver_id")
+            if not receiver_id:
+                await websocket.send_json({"event": "error", "detail": "receiver_id is required"})
+                continue
+            try:
+                await save_message(messageCollection, user_id, receiver_id, data.get("message"), data.get("type"))
+            except PyMongoError as e:
+                print(f"Database Error: {e}")
+                await websocket.send_json({"event": "error", "detail": "Database update failed"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        chat.hub.remove(user_id, websocket)
+
+
+@router.get("/unread_counts/{user_id}")
+async def get_unread_counts(user_id: str, messageCollection: MessageCollection):
+    """Unread message count per conversation partner, for app badges."""
+    try:
+        pipeline = [
+            {"$match": {"receiver_id": user_id, "read": False}},
+            {"$group": {"_id": "$sender_id", "count": {"$sum": 1}}}
+        ]
+        counts = {
+            row["_id"]: row["count"]
+            async for row in messageCollection.aggregate(pipeline)
+        }
+        return {"user_id": user_id, "counts": counts, "total": sum(counts.values())}
+    except PyMongoError as e:
+        print(f"Database Error: {e}")
+        raise HTTPException(status_code=500, detail="Database query failed")
+
+
+@router.put("/mark_read/{user_id}/{other_id}")
+async def mark_messages_read(
+    user_id: str,
+    other_id: str,
+    messageCollection: MessageCollection,
+    up_to: str | None = None
+):
+    """Mark messages other_id sent to user_id as read, in one update_many.
+
+    ``up_to`` is a message cursor (see get_messages); messages after it stay
+    unread. Without it the whole conversation is marked read.
+    """
+    query = {"sender_id": other_id, "receiver_id": user_id, "read": False}
+    if up_to:
+        timestamp, message_id = decode_message_cursor(up_to)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lte": message_id}}
+        ]
+    try:
+        result = await messageCollection.update_many(query, {"$set": {"read": True}})
+        return {"message": "Messages marked as read", "modified_count": result.modified_count}
+    except PyMongoError as e:
+        print(f"Database Error: {e}")
+        raise HTTPException(status_code=500, detail="Database update failed")
 
 @router.post("/connect_patient_therapist/{patient_id}/{therapist_id}")
-def connect_patient_therapist_bidirectional(patient_id: str, therapist_id: str, request: Request):
+async def connect_patient_therapist_bidirectional(
+    patient_id: str,
+    therapist_id: str,
+    request: Request,
+    patientCollection: PatientCollection,
+    therapistCollection: TherapistCollection,
+    connectionCollection: ConnectionCollection
+):
     try:
         print("Connecting patient:", patient_id, "to therapist:", therapist_id)
 
@@ -170,14 +377,15 @@ def connect_patient_therapist_bidirectional(patient_id: str, therapist_id: str,
         status = "accepted" if role == "therapist" else "pending"
         print("Using role:", role, "=> status:", status)
 
-        existing = connectionCollection.find_one({
-            "patient_id": patient_id,
-            "therapist_id": therapist_id
-        })
-
         if role == "therapist":
-            patient = patientCollection.find_one({"_id": patient_id})
-            therapist = therapistCollection.find_one({"_id": therapist_id})
+            existing, patient, therapist = await asyncio.gather(
+                connectionCollection.find_one({
+                    "patient_id": patient_id,
+                    "therapist_id": therapist_id
+                }),
+                patientCollection.find_one({"_id": patient_id}),
+                therapistCollection.find_one({"_id": therapist_id}),
+            )
 
             if not patient:
                 raise HTTPException(status_code=404, detail="Patient not found")
@@ -188,18 +396,25 @@ def connect_patient_therapist_bidirectional(patient_id: str, therapist_id: str,
                 raise HTTPException(status_code=400, detail="Connection already exists")
             if patient_id in therapist.get("connections", []):
                 raise HTTPException(status_code=400, detail="Connection already exists")
-            updated_item_1 = patientCollection.update_one(
-                {"_id": patient_id},
-                {"$addToSet": {"connections": therapist_id}}
-            )
-            updated_item_2 = therapistCollection.update_one(
-                {"_id": therapist_id},
-                {"$addToSet": {"connections": patient_id}}
+            updated_item_1, updated_item_2 = await asyncio.gather(
+                patientCollection.update_one(
+                    {"_id": patient_id},
+                    {"$addToSet": {"connections": therapist_id}, "$inc": {"version": 1}}
+                ),
+                therapistCollection.update_one(
+                    {"_id": therapist_id},
+                    {"$addToSet": {"connections": patient_id}, "$inc": {"version": 1}}
+                ),
             )
 
             if updated_item_1.modified_count != 1 or updated_item_2.modified_count != 1:
                 raise HTTPException(status_code=400, detail="Failed to add connection")
-        
+        else:
+            existing = await connectionCollection.find_one({
+                "patient_id": patient_id,
+                "therapist_id": therapist_id
+            })
+
         if existing:
             return {"message": "Connection already exists"}
 
@@ -209,7 +424,7 @@ def connect_patient_therapist_bidirectional(patient_id: str, therapist_id: str,
             "status": status
         }
 
-        connectionCollection.insert_one(connection)
+        await connectionCollection.insert_one(connection)
         return {"message": "Connection request created", "status": status}
 
     except Exception as e:
@@ -217,16 +432,23 @@ def connect_patient_therapist_bidirectional(patient_id: str, therapist_id: str,
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/accept_connection/{patient_id}/{therapist_id}")
-def accept_connection(patient_id: str, therapist_id: str):
+async def accept_connection(
+    patient_id: str,
+    therapist_id: str,
+    patientCollection: PatientCollection,
+    therapistCollection: TherapistCollection,
+    connectionCollection: ConnectionCollection
+):
     try:
-        result = connectionCollection.update_one(
-            {"patient_id": patient_id, "therapist_id": therapist_id, "status": "pending"},
-            {"$set": {"status": "accepted"}}
+        result, patient, therapist = await asyncio.gather(
+            connectionCollection.update_one(
+                {"patient_id": patient_id, "therapist_id": therapist_id, "status": "pending"},
+                {"$set": {"status": "accepted"}}
+            ),
+            patientCollection.find_one({"_id": patient_id}),
+            therapistCollection.find_one({"_id": therapist_id}),
         )
 
-        patient = patientCollection.find_one({"_id": patient_id})
-        therapist = therapistCollection.find_one({"_id": therapist_id})
-
         if not patient:
             raise HTTPException(status_code=404, detail="Patient not found")
         if not therapist:
@@ -236,14 +458,16 @@ def accept_connection(patient_id: str, therapist_id: str):
             raise HTTPException(status_code=400, detail="Connection already exists")
         if patient_id in therapist.get("connections", []):
             raise HTTPException(status_code=400, detail="Connection already exists")
-        updated_item_1 = patientCollection.update_one(
+        updated_item_1, updated_item_2 = await asyncio.gather(
+            patientCollection.update_one(
                 {"_id": patient_id},
-                {"$addToSet": {"connections": therapist_id}}
-            )
-        updated_item_2 = therapistCollection.update_one(
+                {"$addToSet": {"connections": therapist_id}, "$inc": {"version": 1}}
+            ),
+            therapistCollection.update_one(
                 {"_id": therapist_id},
-                {"$addToSet": {"connections": patient_id}}
-            )
+                {"$addToSet": {"connections": patient_id}, "$inc": {"version": 1}}
+            ),
+        )
 
         if updated_item_1.modified_count != 1 or updated_item_2.modified_count != 1:
             raise HTTPException(status_code=400, detail="Failed to add connection")
@@ -258,43 +482,78 @@ def accept_connection(patient_id: str, therapist_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/get_connections/{user_id}/{user_type}")
-def get_user_connections(user_id: str, user_type: str):
+async def get_user_connections(
+    user_id: str,
+    user_type: str,
+    patientCollection: PatientCollection,
+    therapistCollection: TherapistCollection,
+    connectionCollection: ConnectionCollection,
+    connection_status: Literal["pending", "accepted"] | None = Query(None, alias="status"),
+    limit: int = Query(200, ge=1, le=1000),
+    after: str | None = None
+):
+    """One page of a user's connections with the other party's profile.
+
+    At most ``limit`` (default 200) connections are returned, oldest first;
+    when there may be more, ``next_cursor`` is set and passing it back as
+    ``after`` loads the next page. ``status`` keeps only pending or accepted
+    connections. Two round trips however many connections there are: the
+    connections page, then one projected ``$in`` for the profiles.
+    """
+    if user_type.lower() == "patient":
+        query = {"patient_id": user_id}
+        other_collection = therapistCollection
+        id_key = "therapist_id"
+    elif user_type.lower() == "therapist":
+        query = {"therapist_id": user_id}
+        other_collection = patientCollection
+        id_key = "patient_id"
+    else:
+        raise HTTPException(status_code=400, detail="Invalid user type")
+
+    if connection_status == "accepted":
+        # Connections created before statuses existed count as accepted
+        query["status"] = {"$in": ["accepted", None]}
+    elif connection_status:
+        query["status"] = connection_status
+    if after:
+        if not ObjectId.is_valid(after):
+            raise HTTPException(status_code=400, detail="Invalid connection cursor")
+        query["_id"] = {"$gt": ObjectId(after)}
+
     try:
-        if user_type.lower() == "patient":
-            connections = connectionCollection.find({"patient_id": user_id})
-            other_collection = therapistCollection
-            id_key = "therapist_id"
-        elif user_type.lower() == "therapist":
-            connections = connectionCollection.find({"therapist_id": user_id})
-            other_collection = patientCollection
-            id_key = "patient_id"
-        else:
-            raise HTTPException(status_code=400, detail="Invalid user type")
+        connections = await connectionCollection.find(
+            query, {id_key: 1, "status": 1}
+        ).sort("_id", 1).limit(limit).to_list(length=limit)
+
+        other_ids = list({conn[id_key] for conn in connections if conn.get(id_key)})
+        users = {}
+        if other_ids:
+            async for user in other_collection.find(
+                {"_id": {"$in": other_ids}},
+                {"firstname": 1, "lastname": 1, "imageUrl": 1, "expoPushToken": 1}
+            ):
+                users[user["_id"]] = user
 
         results = []
         for conn in connections:
-            try:
-                user = other_collection.find_one({"_id": conn[id_key]})
-                if user:
-                    user_info = {
-                        "_id": str(user["_id"]),
-                        "firstname": user.get("firstname", ""),
-                        "lastname": user.get("lastname", ""),
-                        "imageUrl": user.get("imageUrl"),
-                        "expoPushToken": user.get("expoPushToken"),
-                        "status": conn.get("status", "accepted"),
-                        "expoPushToken": user.get("expoPushToken", ""),
-                    }
-                    results.append(user_info)
-            except Exception as inner_e:
-                print(f"Skipping bad connection entry: {conn} | Error: {inner_e}")
-                continue
+            user = users.get(conn.get(id_key))
+            if user:
+                results.append({
+                    "_id": str(user["_id"]),
+                    "firstname": user.get("firstname", ""),
+                    "lastname": user.get("lastname", ""),
+                    "imageUrl": user.get("imageUrl"),
+                    "status": conn.get("status", "accepted"),
+                    "expoPushToken": user.get("expoPushToken", ""),
+                })
 
         return {
             "user_id": user_id,
             "user_type": user_type,
             "connections": results,
-            "connection_count": len(results)
+            "connection_count": len(results),
+            "next_cursor": str(connections[-1]["_id"]) if len(connections) == limit else None
         }
 
     except Exception as e:
@@ -302,29 +561,39 @@ def get_user_connections(user_id: str, user_type: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/disconnect_patient_therapist/{patient_id}/{therapist_id}")
-def disconnect_patient_therapist(patient_id: str, therapist_id: str):
+async def disconnect_patient_therapist(
+    patient_id: str,
+    therapist_id: str,
+    patientCollection: PatientCollection,
+    therapistCollection: TherapistCollection,
+    connectionCollection: ConnectionCollection
+):
     try:
-        patient = patientCollection.find_one({"_id" : patient_id})
-        therapist = therapistCollection.find_one({"_id" : therapist_id})
+        patient, therapist = await asyncio.gather(
+            patientCollection.find_one({"_id" : patient_id}),
+            therapistCollection.find_one({"_id" : therapist_id}),
+        )
         if patient and therapist:
             if therapist_id not in patient.get("connections", []):
                 raise HTTPException(status_code=400, detail="Connection does not exist")
             if patient_id not in therapist.get("connections", []):
                 raise HTTPException(status_code=400, detail="Connection does not exist")
-            updated_item_1 = patientCollection.update_one(
-                {"_id": patient_id},
-                {"$pull": {"connections": therapist_id}}
-            )
-            updated_item_2 = therapistCollection.update_one(
-                {"_id": therapist_id},
-                {"$pull": {"connections": patient_id}}
+            updated_item_1, updated_item_2 = await asyncio.gather(
+                patientCollection.update_one(
+                    {"_id": patient_id},
+                    {"$pull": {"connections": therapist_id}, "$inc": {"version": 1}}
+                ),
+                therapistCollection.update_one(
+                    {"_id": therapist_id},
+                    {"$pull": {"connections": patient_id}, "$inc": {"version": 1}}
+                ),
             )
             if updated_item_1.modified_count != 1 or updated_item_2.modified_count != 1:
                 raise HTTPException(status_code=400, detail="Failed to remove connection")
         else:
             raise HTTPException(status_code=404, detail="Patient not found")
         
-        result = connectionCollection.delete_one({
+        result = await connectionCollection.delete_one({
             "patient_id": patient_id,
             "therapist_id": therapist_id
         })
@@ -338,9 +607,13 @@ def disconnect_patient_therapist(patient_id: str, therapist_id: str):
         raise HTTPException(status_code=500, detail=str(e))
     
 @router.post("/reject_connection/{patient_id}/{therapist_id}")
-def reject_connection(patient_id: str, therapist_id: str):
+async def reject_connection(
+    patient_id: str,
+    therapist_id: str,
+    connectionCollection: ConnectionCollection
+):
     try:
-        result = connectionCollection.delete_one({
+        result = await connectionCollection.delete_one({
             "patient_id": patient_id,
             "therapist_id": therapist_id,
             "status": "pending"
@@ -356,36 +629,39 @@ def reject_connection(patient_id: str, therapist_id: str):
 
 
 @router.delete("/delete_custom_routine/{therapist_id}/{routine_id}")
-def delete_custome_routine(therapist_id: str, routine_id: str):
+async def delete_custome_routine(
+    therapist_id: str,
+    routine_id: str,
+    patientCollection: PatientCollection,
+    therapistCollection: TherapistCollection,
+    exerciseCollection: ExerciseCollection,
+    routineCollection: RoutineCollection
+):
     try:
-        therapist = therapistCollection.find_one({"_id": therapist_id})
-        routine = routineCollection.find_one({"_id": ObjectId(routine_id)})
-        patients = patientCollection.find({
-            "assigned_routines": {
-                "$elemMatch": {"_id": ObjectId(routine_id)}
-            }
-        })
+        therapist, routine = await asyncio.gather(
+            therapistCollection.find_one({"_id": therapist_id}),
+            routineCollection.find_one({"_id": ObjectId(routine_id)}),
+        )
 
-        if patients:
-            for patient in patients:
-                patientCollection.update_one(
-                    {"_id": patient["_id"]},
-                    {"$pull": {"assigned_routines": {"_id": ObjectId(routine_id)}}}
-                )
+        await patientCollection.update_many(
+            {"assigned_routines": {"$elemMatch": {"_id": ObjectId(routine_id)}}},
+            {"$pull": {"assigned_routines": {"_id": ObjectId(routine_id)}}, "$inc": {"version": 1}}
+        )
         
         if therapist and routine:
-            updated_therapist = therapistCollection.update_one(
-                {"_id": therapist_id},
-                {"$pull": {"custom_routines": {"_id": ObjectId(routine_id)}}}
+            updated_therapist = await therapistCollection.update_one(
+                {"_id": therapist_id, "custom_routines._id": ObjectId(routine_id)},
+                {"$pull": {"custom_routines": {"_id": ObjectId(routine_id)}}, "$inc": {"version": 1}}
             )
 
             # Delete the routine from the Routines collection
             for exercise in routine.get("exercises", []):
                 exercise_id = exercise.get("_id")
                 if exercise_id:
-                    exerciseCollection.delete_one({"_id": ObjectId(exercise_id)})
+                    await exerciseCollection.delete_one({"_id": ObjectId(exercise_id)})
             
-            updated_routine = routineCollection.delete_one({"_id": ObjectId(routine_id)})
+            updated_routine = await routineCollection.delete_one({"_id": ObjectId(routine_id)})
+            catalog.invalidate()
 
 
             if updated_therapist.modified_count == 1 and updated_routine.deleted_count == 1:
@@ -402,9 +678,9 @@ def delete_custome_routine(therapist_id: str, routine_id: str):
         raise HTTPException(status_code=500, detail="Database update failed")
 
 @router.delete("/delete_chat/{user1}/{user2}")
-def delete_chat(user1: str, user2: str):
+async def delete_chat(user1: str, user2: str, messageCollection: MessageCollection):
     try:
-        result = messageCollection.delete_many({
+        result = await messageCollection.delete_many({
             "$or": [
                 {"sender_id": user1, "receiver_id": user2},
                 {"sender_id": user2, "receiver_id": user1}
@@ -420,10 +696,14 @@ def delete_chat(user1: str, user2: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/toggle_mute/{patient_id}/{therapist_id}")
-async def toggle_mute(patient_id: str, therapist_id: str):
+async def toggle_mute(
+    patient_id: str,
+    therapist_id: str,
+    connectionCollection: ConnectionCollection
+):
     try:
         # Find the connection
-        connection = connectionCollection.find_one({
+        connection = await connectionCollection.find_one({
             "patient_id": patient_id,
             "therapist_id": therapist_id
         })
@@ -435,7 +715,7 @@ async def toggle_mute(patient_id: str, therapist_id: str):
         current_mute_status = connection.get("is_muted", False)
         
         # Toggle the mute status
-        result = connectionCollection.update_one(
+        result = await connectionCollection.update_one(
             {
                 "patient_id": patient_id,
                 "therapist_id": therapist_id
@@ -445,6 +725,7 @@ async def toggle_mute(patient_id: str, therapist_id: str):
 
         if result.modified_count == 0:
             raise HTTPException(status_code=500, detail="Failed to update mute status")
+        notifier.forget_mute(patient_id, therapist_id)
 
         return {
             "message": f"Successfully {'muted' if not current_mute_status else 'unmuted'} the connection",
@@ -461,82 +742,94 @@ async def toggle_mute(patient_id: str, therapist_id: str):
         raise HTTPException(status_code=500, detail=str(e))
     
 @router.get("/get_patient_history/{patient_id}")
-def get_patient_history(patient_id: str):
+async def get_patient_history(patient_id: str, historyCollection: HistoryBucketCollection):
     try:
-        history = patientHistoryCollection.find_one({"_id": patient_id})
-        if history:
-            history["_id"] = str(history["_id"])
-            return history
+        buckets = await historyCollection.find(
+            {"patient_id": patient_id},
+            {"completed_exercises": 1, "completed_routines": 1}
+        ).sort("month", 1).to_list(length=None)
+        if buckets:
+            return {
+                "_id": patient_id,
+                "completed_exercises": [log for bucket in buckets for log in bucket.get("completed_exercises", [])],
+                "completed_routines": [log for bucket in buckets for log in bucket.get("completed_routines", [])]
+            }
         else:
             raise HTTPException(status_code=404, detail="Patient history not found")
     except Exception as e:
         print("Error getting patient history:", str(e))
         raise HTTPException(status_code=500, detail=str(e))
     
-@router.get("/get_graph_data/{patient_id}")
-def get_graph_data(patient_id: str):
-    try:
-        # Get the basic history document
-        history = patientHistoryCollection.find_one({"_id": patient_id})
-        if not history:
-            raise HTTPException(status_code=404, detail="Patient history not found")
-
-        # Calculate date 7 days ago
-        seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
-        seven_days_ago_str = seven_days_ago.strftime("%Y-%m-%d")
-
-        # Create aggregation pipeline for routines
-        routines_pipeline = [
-            {"$match": {"_id": patient_id}},
-            {"$unwind": "$completed_routines"},
-            {"$match": {"completed_routines.date": {"$gte": seven_days_ago_str}}},
-            {"$group": {
-                "_id": "$completed_routines.date",
-                "count": {"$sum": 1}
-            }},
-            {"$sort": {"_id": 1}}
-        ]
+MAX_GRAPH_DAYS = 366
 
-        # Create aggregation pipeline for exercises
-        exercises_pipeline = [
-            {"$match": {"_id": patient_id}},
-            {"$unwind": "$completed_exercises"},
-            {"$match": {"completed_exercises.date": {"$gte": seven_days_ago_str}}},
-            {"$group": {
-                "_id": "$completed_exercises.date",
-                "count": {"$sum": 1}
-            }},
-            {"$sort": {"_id": 1}}
-        ]
 
-        # Execute aggregations
-        routines_by_day = list(patientHistoryCollection.aggregate(routines_pipeline))
-        exercises_by_day = list(patientHistoryCollection.aggregate(exercises_pipeline))
-
-        # Convert to dictionary format for easier access
-        routines_dict = {item["_id"]: item["count"] for item in routines_by_day}
-        exercises_dict = {item["_id"]: item["count"] for item in exercises_by_day}
-
-        # Generate dates for the last 7 days
-        dates = [(datetime.now(timezone.utc) - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
-        dates.reverse()
-
-        # Create the final response
-        response = {
-            "last_7_days": [
-                {
-                    "date": date,
-                    "routines_count": routines_dict.get(date, 0),
-                    "exercises_count": exercises_dict.get(date, 0)
-                }
-                for date in dates
-            ],
-            "total_routines": len(history.get("completed_routines", [])),
-            "total_exercises": len(history.get("completed_exercises", []))
-        }
+# support function
+def graph_range(days: int, start: str | None, end: str | None):
+    """Inclusive (first, last) dates for get_graph_data, ending today by default."""
+    try:
+        last = datetime.strptime(end, "%Y-%m-%d").date() if end else datetime.now(timezone.utc).date()
+        first = datetime.strptime(start, "%Y-%m-%d").date() if start else last - timedelta(days=days - 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    if first > last or (last - first).days >= MAX_GRAPH_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range must be 1 to {MAX_GRAPH_DAYS} days")
+    return first, last
 
-        return response
 
+@router.get("/get_graph_data/{patient_id}")
+async def get_graph_data(
+    patient_id: str,
+    activityCollection: ActivityCollection,
+    days: int = Query(7, ge=1, le=MAX_GRAPH_DAYS),
+    start: str | None = None,
+    end: str | None = None,
+    group_by: str = Query("day", pattern="^(day|week)$")
+):
+    """Completion counts per day (or per Sunday-Saturday week) for a date range.
+
+    Served from the Patient_Activity rollups kept up to date by the
+    completion endpoints, so the cost depends on the range, not on how much
+    history the patient has.
+    """
+    first, last = graph_range(days, start, end)
+    try:
+        rollups, totals = await asyncio.gather(
+            activityCollection.find(
+                {"patient_id": patient_id, "day": {"$gte": first.isoformat(), "$lte": last.isoformat()}},
+                {"_id": 0, "day": 1, "routines": 1, "exercises": 1}
+            ).sort("day", 1).to_list(length=None),
+            activityCollection.find_one({"_id": totals_id(patient_id)}),
+        )
     except Exception as e:
         print("Error getting patient history:", str(e))
         raise HTTPException(status_code=500, detail=str(e))
+    if not totals:
+        raise HTTPException(status_code=404, detail="Patient history not found")
+
+    # Every day (or week start) in the range, including ones with no activity
+    series = {}
+    for offset in range((last - first).days + 1):
+        day = first + timedelta(days=offset)
+        if group_by == "week":
+            day -= timedelta(days=(day.weekday() + 1) % 7)
+        series.setdefault(day.isoformat(), {"date": day.isoformat(), "routines_count": 0, "exercises_count": 0})
+    for rollup in rollups:
+        day = date.fromisoformat(rollup["day"])
+        if group_by == "week":
+            day -= timedelta(days=(day.weekday() + 1) % 7)
+        point = series[day.isoformat()]
+        point["routines_count"] += rollup.get("routines", 0)
+        point["exercises_count"] += rollup.get("exercises", 0)
+
+    response = {
+        "start": first.isoformat(),
+        "end": last.isoformat(),
+        "group_by": group_by,
+        "series": list(series.values()),
+        "total_routines": totals.get("routines", 0),
+        "total_exercises": totals.get("exercises", 0)
+    }
+    # Shape returned before ranges were supported; existing clients read it
+    if group_by == "day" and start is None and end is None and days == 7:
+        response["last_7_days"] = response["series"]
+    return response
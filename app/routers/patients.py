@@ -1,28 +1,30 @@
-from fastapi import HTTPException, APIRouter
-from app.database import get_database
+from fastapi import HTTPException, APIRouter, Request, Query
+from fastapi.responses import StreamingResponse
+from app.responses import BSONResponse, NDJSON_MEDIA_TYPE, ndjson_lines
+from app.etag import etag_matches, not_modified, version_etag
+from app.database import PatientCollection, ExerciseCollection, RoutineCollection, HistoryBucketCollection, ActivityCollection
+from app.history import record_completion, bucket_ids_between, completion_page, parse_history_cursor
 from app.models.patients import Patient
 from pymongo.errors import PyMongoError
 from bson import ObjectId
-from app.routers.common import get_routine_by_id, get_exercise_by_id, create_routine
+from app.routers.common import hydrate_routines, create_routine
+from app.notifications import notifier
 from datetime import datetime, timedelta
+from typing import Literal
 import random
 
-patientCollection = get_database()["Patients"]
-completionCollection = get_database()["Patient_History"]
-exerciseCollection = get_database()["Exercises"]
-routineCollection = get_database()["Routines"]
-
 router = APIRouter(prefix="/patient", tags=["Patients"])
 
 @router.post("/create_patient", response_model=str, status_code=201)
-def create_new_patient(user: Patient):
+async def create_new_patient(user: Patient, patientCollection: PatientCollection):
     try:
         user_dict = user.model_dump(by_alias=True, exclude=["id"])
         user_dict["_id"] = user.id
         user_dict["connections"] = []
         user_dict["assigned_routines"] = []
+        user_dict["version"] = 1
 
-        database_response = patientCollection.insert_one(user_dict)
+        database_response = await patientCollection.insert_one(user_dict)
         print(f"\n\nNew Patient Added With ID : {database_response.inserted_id}\n\n")
         return database_response.inserted_id
 
@@ -35,57 +37,51 @@ def create_new_patient(user: Patient):
         raise HTTPException(status_code=500, detail="An unexpected error occurred")
 
 
-# support function
-def convert_object_ids_to_strings(data):
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if key == "_id":
-                if isinstance(value, dict) and "$oid" in value:
-                    # Convert MongoDB ObjectId to string
-                    data[key] = value["$oid"]
-                else:
-                    data[key] = str(value)  # Ensure all _id values are strings
-            else:
-                data[key] = convert_object_ids_to_strings(
-                    value)  # Recursively process other fields
-    elif isinstance(data, list):
-        # Recursively process lists
-        return [convert_object_ids_to_strings(item) for item in data]
-    return data
-
 @router.get("/get_patient/{patient_id}")
-def get_patient_by_id(patient_id: str):
+async def get_patient_by_id(
+    patient_id: str,
+    request: Request,
+    patientCollection: PatientCollection
+):
     print("Looking for patient with ID:", patient_id)
 
-    # DEBUG: print one sample patient
-    sample = patientCollection.find_one()
-    print("Sample document from Patients:", sample)
+    # Client already has a copy: compare versions without loading the document
+    if request.headers.get("if-none-match"):
+        stamp = await patientCollection.find_one({"_id": patient_id}, {"version": 1})
+        if stamp is not None:
+            etag = version_etag("patient", patient_id, stamp.get("version", 0))
+            if etag_matches(request, etag):
+                return not_modified(etag)
 
     # Check if the document with matching ID exists
-    patient = patientCollection.find_one({"_id": patient_id})
+    patient = await patientCollection.find_one({"_id": patient_id})
     print("Patient query result:", patient)
 
     if patient:
-        return convert_object_ids_to_strings(patient)
+        return BSONResponse(patient, headers={"ETag": version_etag("patient", patient_id, patient.get("version", 0))})
     else:
         raise HTTPException(status_code=404, detail="Patient not found")
 
 @router.put("/update_assigned_routines/{patient_id}/{routine_id}")
-def update_assigned_routines(patient_id: str, routine_id: str):
+async def update_assigned_routines(
+    patient_id: str,
+    routine_id: str,
+    patientCollection: PatientCollection
+):
     try:
-        patient = patientCollection.find_one({"_id": patient_id})
+        patient = await patientCollection.find_one({"_id": patient_id})
 
         if patient:
             # Check if the routine already exists in assigned_routines
-            existing_routine = patientCollection.find_one(
+            existing_routine = await patientCollection.find_one(
                 {"_id": patient_id, "assigned_routines._id": ObjectId(routine_id)}
             )
             if existing_routine:
                 return {"message": "Routine already assigned to this patient!"}
             
-            updated_item = patientCollection.update_one(
+            updated_item = await patientCollection.update_one(
                 {"_id": patient_id},
-                {"$addToSet": {"assigned_routines": {"_id": ObjectId(routine_id)}}}
+                {"$addToSet": {"assigned_routines": {"_id": ObjectId(routine_id)}}, "$inc": {"version": 1}}
             )
 
             if updated_item.modified_count == 1:
@@ -101,15 +97,20 @@ def update_assigned_routines(patient_id: str, routine_id: str):
 
 # adding assigned routines to patients
 @router.post("/add_explore_routine/{patient_id}")
-def add_explore_routine(patient_id:str, routine: dict):
+async def add_explore_routine(
+    patient_id:str,
+    routine: dict,
+    patientCollection: PatientCollection,
+    routineCollection: RoutineCollection
+):
     try : 
         for exercise in routine.get("exercises", []):
             if isinstance(exercise["_id"], str):
                 exercise["_id"] = ObjectId(exercise["_id"])
                 
-        routine_id = create_routine(routine).get("routine_id")
+        routine_id = (await create_routine(routine, routineCollection)).get("routine_id")
         print(f"\n\nRoutine ID: {routine_id}\n\n")
-        update_assigned_routines(patient_id, routine_id)
+        await update_assigned_routines(patient_id, routine_id, patientCollection)
         return {"message": "Routine added successfully!"}
     except PyMongoError as e:
         raise HTTPException(status_code=500, detail="Database update failed")
@@ -118,22 +119,23 @@ def add_explore_routine(patient_id:str, routine: dict):
 
 
 @router.get("/get_assigned_routines/{patient_id}")
-def get_assigned_routines(patient_id: str):
-    patient = patientCollection.find_one({"_id": patient_id})
+async def get_assigned_routines(
+    patient_id: str,
+    patientCollection: PatientCollection,
+    exerciseCollection: ExerciseCollection,
+    routineCollection: RoutineCollection
+):
+    patient = await patientCollection.find_one({"_id": patient_id}, {"assigned_routines": 1})
     if patient:
-        routine_ids = [{"_id": str(routineID["_id"])} for routineID in patient.get("assigned_routines", [])]
-        routines = [get_routine_by_id(routine["_id"]) for routine in routine_ids]
-        for routine in routines:
-            exercise_ids = [exercise["_id"] for exercise in routine.get("exercises", [])]
-            routine["exercises"] = [get_exercise_by_id(exercise_id) for exercise_id in exercise_ids]
-        return routines
+        routine_ids = [routineID["_id"] for routineID in patient.get("assigned_routines", [])]
+        return BSONResponse(await hydrate_routines(routine_ids, exerciseCollection, routineCollection))
     else:
         raise HTTPException(status_code=404, detail="No Such Patient")    
 
 
 @router.get("/get_connections/{patient_id}")
-def get_connections(patient_id: str):
-    patient = patientCollection.find_one({"_id": patient_id})
+async def get_connections(patient_id: str, patientCollection: PatientCollection):
+    patient = await patientCollection.find_one({"_id": patient_id})
     if patient:
         connections = patient.get("connections", [])
         print(f"\n\nConnections Found: {connections}\n\n")
@@ -142,12 +144,11 @@ def get_connections(patient_id: str):
         raise HTTPException(status_code=404, detail="No Therapist Found for this Patient")
     
 @router.get("/get_patient_by_email/{email}")
-def get_patient_by_email(email: str):
+async def get_patient_by_email(email: str, patientCollection: PatientCollection):
     try:
-        patient = patientCollection.find_one({"email": email})
+        patient = await patientCollection.find_one({"email": email})
         if patient:
-            patient["_id"] = str(patient["_id"])
-            return convert_object_ids_to_strings(patient)
+            return BSONResponse(patient)
         else:
             raise HTTPException(status_code=404, detail="Patient not found with provided email")
     except PyMongoError as e:
@@ -156,9 +157,13 @@ def get_patient_by_email(email: str):
         raise HTTPException(status_code=500, detail="An unexpected error occurred")
 
 @router.put("/update_patient/{patient_username}")
-def update_patient_by_username(patient_username: str, user: Patient):
+async def update_patient_by_username(
+    patient_username: str,
+    user: Patient,
+    patientCollection: PatientCollection
+):
     try:
-        result = patientCollection.find_one({"username": patient_username})
+        result = await patientCollection.find_one({"username": patient_username})
         if result:
             user_dict = user.model_dump(by_alias=True, exclude=["id"])
             update_fields = {
@@ -167,11 +172,15 @@ def update_patient_by_username(patient_username: str, user: Patient):
                 "streak": user_dict.get("streak"),
                 "expoPushToken" : user_dict.get("expoPushToken"),
             }
-            updated_item = patientCollection.update_one(
-                {"username": patient_username},
-                {"$set": update_fields}
+            # Only match (and bump the version) when a field actually changes
+            updated_item = await patientCollection.update_one(
+                {"username": patient_username, "$or": [
+                    {field: {"$ne": value}} for field, value in update_fields.items()
+                ]},
+                {"$set": update_fields, "$inc": {"version": 1}}
             )
             if updated_item.modified_count == 1:
+                notifier.forget_token(result["_id"])
                 return {"message": "Item updated successfully!"}
             else:
                 return {"message": "No changes made to the item."}
@@ -181,27 +190,21 @@ def update_patient_by_username(patient_username: str, user: Patient):
         raise HTTPException(status_code=500, detail="Database update failed")
     
 
-def validate_log(user_id: str):
-    if not completionCollection.find_one({"_id": user_id}):
-        completionCollection.insert_one({
-            "_id": user_id,
-            "completed_routines": [],
-            "completed_exercises": []
-        })
-
 @router.put("/complete_routine/{user_id}/{routine_id}")
-def mark_routine_complete(user_id: str, routine_id: str, name: str = ""):
+async def mark_routine_complete(
+    user_id: str,
+    routine_id: str,
+    completionCollection: HistoryBucketCollection,
+    activityCollection: ActivityCollection,
+    name: str = ""
+):
     try:
-        validate_log(user_id)
         routine_entry = {
             "_id": routine_id,
             "name": name,
             "date": datetime.utcnow().isoformat()
         }
-        completionCollection.update_one(
-            {"_id": user_id},
-            {"$addToSet": {"completed_routines": routine_entry}}
-        )
+        await record_completion(completionCollection, activityCollection, user_id, "routine", routine_entry)
         return {"message": "Routine marked as completed."}
     except PyMongoError:
         raise HTTPException(status_code=500, detail="Database error")
@@ -209,70 +212,129 @@ def mark_routine_complete(user_id: str, routine_id: str, name: str = ""):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/complete_exercise/{user_id}/{exercise_id}")
-def mark_exercise_complete(user_id: str, exercise_id: str, title: str = ""):
+async def mark_exercise_complete(
+    user_id: str,
+    exercise_id: str,
+    completionCollection: HistoryBucketCollection,
+    activityCollection: ActivityCollection,
+    title: str = ""
+):
     try:
-        validate_log(user_id)
         exercise_entry = {
             "_id": exercise_id,
             "title": title,
             "date": datetime.utcnow().isoformat()
         }
-        completionCollection.update_one(
-            {"_id": user_id},
-            {"$addToSet": {"completed_exercises": exercise_entry}}
-        )
+        await record_completion(completionCollection, activityCollection, user_id, "exercise", exercise_entry)
         return {"message": "Exercise marked as completed."}
     except PyMongoError:
         raise HTTPException(status_code=500, detail="Database error")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# support function
+async def completed_page(completionCollection, patient_id: str, kind: str, limit: int, before, start, end):
+    """One newest-first page of history entries and its pagination headers."""
+    for bound in (start, end):
+        if bound:
+            try:
+                datetime.strptime(bound, "%Y-%m-%d")
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    if before:
+        try:
+            parse_history_cursor(before)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid history cursor")
+
+    page = await completion_page(completionCollection, patient_id, kind, limit, before, start, end)
+    headers = {}
+    if len(page) > limit:
+        page = page[:limit]
+        headers["X-Before-Cursor"] = page[-1][1]
+    return [entry for entry, _ in page], headers
+
+
+# support function
+async def documents_by_id(collection, logs, projection):
+    """Fetch every distinct document referenced by logs in one $in query."""
+    ids = list({ObjectId(log["_id"]) for log in logs if ObjectId.is_valid(log.get("_id"))})
+    if not ids:
+        return {}
+    documents = await collection.find({"_id": {"$in": ids}}, projection).to_list(length=None)
+    return {str(document["_id"]): document for document in documents}
+
+
 @router.get("/get_completed_exercises/{patient_id}")
-def get_completed_exercises(patient_id: str):
+async def get_completed_exercises(
+    patient_id: str,
+    exerciseCollection: ExerciseCollection,
+    completionCollection: HistoryBucketCollection,
+    limit: int = Query(50, ge=1, le=200),
+    before: str | None = None,
+    start: str | None = None,
+    end: str | None = None
+):
+    """Completed exercises, newest first.
+
+    Pass the X-Before-Cursor header of a page as ``before`` to load the next
+    one; it is absent on the last page. ``start``/``end`` (YYYY-MM-DD,
+    inclusive) limit the date range.
+    """
     try:
-        patient = completionCollection.find_one({
-            "_id": patient_id,
-        })
-        logs = list(patient.get("completed_exercises", []))
+        logs, headers = await completed_page(completionCollection, patient_id, "exercise", limit, before, start, end)
+        exercises = await documents_by_id(
+            exerciseCollection, logs, {"title": 1, "category": 1, "subcategory": 1})
         completed = []
         for log in logs:
-            exercise = exerciseCollection.find_one({"_id": ObjectId(log["_id"])})
+            exercise = exercises.get(log["_id"])
             if exercise:
-                exercise["_id"] = str(exercise["_id"])
                 completed.append({
                     "date": log.get("date"),
                     "title": exercise.get("title"),
                     "category": exercise.get("category"),
                     "subcategory": exercise.get("subcategory")
                 })
-        return completed
+        return BSONResponse(content=completed, headers=headers)
     except PyMongoError as e:
         raise HTTPException(status_code=500, detail="Database query failed")
 
 @router.get("/get_completed_routines/{patient_id}")
-def get_completed_routines(patient_id: str):
+async def get_completed_routines(
+    patient_id: str,
+    routineCollection: RoutineCollection,
+    completionCollection: HistoryBucketCollection,
+    limit: int = Query(50, ge=1, le=200),
+    before: str | None = None,
+    start: str | None = None,
+    end: str | None = None
+):
+    """Completed routines, newest first. Paginated like get_completed_exercises."""
     try:
-        patient = completionCollection.find_one({
-            "_id": patient_id,
-        })
-        logs = list(patient.get("completed_routines", []))
+        logs, headers = await completed_page(completionCollection, patient_id, "routine", limit, before, start, end)
+        routines = await documents_by_id(routineCollection, logs, {"name": 1})
         completed = []
         for log in logs:
-            routine = routineCollection.find_one({"_id": ObjectId(log["_id"])})
+            routine = routines.get(log["_id"])
             if routine:
-                routine["_id"] = str(routine["_id"])
                 completed.append({
                     "date": log.get("date"),
                     "name": routine.get("name"),
                 })
-        return completed
+        return BSONResponse(content=completed, headers=headers)
     except PyMongoError as e:
         raise HTTPException(status_code=500, detail="Database query failed")
 
 @router.get("/get_progress/{patient_id}")
-def get_progress(patient_id: str):
+async def get_progress(
+    patient_id: str,
+    patientCollection: PatientCollection,
+    exerciseCollection: ExerciseCollection,
+    routineCollection: RoutineCollection,
+    completionCollection: HistoryBucketCollection
+):
     try:
-        patient = patientCollection.find_one({"_id": patient_id})
+        patient = await patientCollection.find_one({"_id": patient_id}, {"assigned_routines": 1})
         if not patient:
             raise HTTPException(status_code=404, detail="Patient not found")
         
@@ -285,36 +347,56 @@ def get_progress(patient_id: str):
         weekday = today.weekday()
         sunday_offset = (weekday + 1) % 7
         start_of_week = (today - timedelta(days=sunday_offset)).replace(hour=0, minute=0, second=0, microsecond=0)
-        end_of_week = start_of_week + timedelta(days=6, hours=23, minutes=59, seconds=59)
-
-        # Calculate expected completions
-        total_expected = 0
-        assigned_exercise_ids = set()
-
-        for r in assigned_routines:
-            routine = routineCollection.find_one({"_id": ObjectId(r["_id"])})
-            if not routine:
-                continue
-            for ex_ref in routine.get("exercises", []):
-                exercise = exerciseCollection.find_one({"_id": ex_ref["_id"]})
-                if not exercise:
-                    continue
-                assigned_exercise_ids.add(str(exercise["_id"]))
-                total_expected += int(exercise.get("frequency", 0))
+        start_of_next_week = start_of_week + timedelta(days=7)
+
+        # Expected completions: sum of frequency over every exercise reference
+        # in the assigned routines, plus the ids those references point at
+        expected_pipeline = [
+            {"$match": {"_id": {"$in": [ObjectId(r["_id"]) for r in assigned_routines]}}},
+            {"$unwind": "$exercises"},
+            {"$lookup": {
+                "from": exerciseCollection.name,
+                "localField": "exercises._id",
+                "foreignField": "_id",
+                "as": "exercise"
+            }},
+            {"$unwind": "$exercise"},
+            {"$group": {
+                "_id": None,
+                "total_expected": {"$sum": {"$toInt": {"$ifNull": ["$exercise.frequency", 0]}}},
+                "exercise_ids": {"$addToSet": {"$toString": "$exercise._id"}}
+            }}
+        ]
+        expected = await routineCollection.aggregate(expected_pipeline).to_list(length=None)
+        total_expected = expected[0]["total_expected"] if expected else 0
 
         if total_expected == 0:
             return {"patient_id": patient_id, "progress": 0}
 
-        # Get completed exercises this week
-        log_entry = completionCollection.find_one({"_id": patient_id})
-        completed_exercises = log_entry.get("completed_exercises", []) if log_entry else []
-
-        completed_this_week = [
-            e for e in completed_exercises
-            if e["_id"] in assigned_exercise_ids and start_of_week <= datetime.fromisoformat(e["date"]) <= end_of_week
+        # Completed assigned exercises this week, read from only the (one or
+        # two) monthly buckets the week falls in. Dates are stored as ISO
+        # strings, so the week bounds compare lexically.
+        week_buckets = bucket_ids_between(patient_id, start_of_week, start_of_next_week - timedelta(microseconds=1))
+        completed_pipeline = [
+            {"$match": {"_id": {"$in": week_buckets}}},
+            {"$project": {
+                "_id": 0,
+                "completed_this_week": {"$size": {"$filter": {
+                    "input": {"$ifNull": ["$completed_exercises", []]},
+                    "as": "entry",
+                    "cond": {"$and": [
+                        {"$in": ["$$entry._id", expected[0]["exercise_ids"]]},
+                        {"$gte": ["$$entry.date", start_of_week.isoformat()]},
+                        {"$lt": ["$$entry.date", start_of_next_week.isoformat()]}
+                    ]}
+                }}}
+            }},
+            {"$group": {"_id": None, "completed_this_week": {"$sum": "$completed_this_week"}}}
         ]
+        completed = await completionCollection.aggregate(completed_pipeline).to_list(length=None)
+        completed_this_week = completed[0]["completed_this_week"] if completed else 0
 
-        progress = min(int((len(completed_this_week) / total_expected) * 100), 100)
+        progress = min(int((completed_this_week / total_expected) * 100), 100)
         return {"patient_id": patient_id, "progress": progress}
 
     except PyMongoError:
@@ -324,15 +406,52 @@ def get_progress(patient_id: str):
         raise HTTPException(status_code=500, detail="Unexpected error")
 
 
+# The fields the admin patient list shows; _id is always included
+PATIENT_LIST_FIELDS = ["username", "firstname", "lastname", "email", "imageUrl", "streak"]
+PATIENT_PAGE_SIZE = 100
+PATIENT_STREAM_BATCH_SIZE = 500
+
+
+# support function
+def patient_projection(fields: str | None) -> dict:
+    names = [name.strip() for name in fields.split(",") if name.strip()] if fields else PATIENT_LIST_FIELDS
+    if any(name.startswith("$") for name in names):
+        raise HTTPException(status_code=400, detail="Invalid field name")
+    return dict.fromkeys(names, 1)
+
+
 @router.get("/get_all_patients")
-def get_all_patients():
+async def get_all_patients(
+    patientCollection: PatientCollection,
+    limit: int | None = Query(None, ge=1, le=1000),
+    after: str | None = None,
+    fields: str | None = None,
+    format: Literal["json", "ndjson"] = "json"
+):
+    """Patients in ``_id`` order.
+
+    ``fields`` is a comma separated list of fields to return (default
+    PATIENT_LIST_FIELDS). A JSON page holds ``limit`` patients (default 100);
+    pass its X-Next-Cursor header back as ``after`` for the next one, it is
+    absent on the last page. ``format=ndjson`` streams one patient per line
+    as the cursor reads them, to the end of the collection unless ``limit``
+    is given; resume a broken stream with ``after`` set to the last ``_id``.
+    """
+    projection = patient_projection(fields)
+    query = {"_id": {"$gt": after}} if after else {}
+    cursor = patientCollection.find(query, projection).sort("_id", 1)
+
+    if format == "ndjson":
+        if limit:
+            cursor = cursor.limit(limit)
+        return StreamingResponse(
+            ndjson_lines(cursor.batch_size(PATIENT_STREAM_BATCH_SIZE)), media_type=NDJSON_MEDIA_TYPE)
+
+    limit = limit or PATIENT_PAGE_SIZE
     try:
-        patients = list(patientCollection.find())
-        for patient in patients:
-            patient["_id"] = str(patient["_id"])
-        return convert_object_ids_to_strings(patients)
+        patients = await cursor.limit(limit).to_list(length=limit)
     except PyMongoError as e:
         raise HTTPException(status_code=500, detail="Database query failed")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="An unexpected error occurred")
+    headers = {"X-Next-Cursor": str(patients[-1]["_id"])} if len(patients) == limit else {}
+    return BSONResponse(patients, headers=headers)
 
@@ -1,74 +1,32 @@
-from exponent_server_sdk import (
-    DeviceNotRegisteredError,
-    PushClient,
-    PushMessage,
-    PushServerError,
-    PushTicketError,
-)
-import rollbar
-import requests
-from requests.exceptions import ConnectionError, HTTPError
-from fastapi import HTTPException, APIRouter, Body
-from app.database import get_database
+import asyncio
+from fastapi import HTTPException, APIRouter, Body, Request
+from app.database import TherapistCollection, ExerciseCollection, RoutineCollection, ConnectionCollection
+from app import catalog, push
+from app.responses import BSONResponse
+from app.notifications import notifier
+from app.etag import etag_matches, not_modified, version_etag
 from app.models.therapists import Therapist, ConnectionBase
 from pymongo.errors import PyMongoError
 from bson import ObjectId
-from app.routers.common import get_routine_by_id, get_exercise_by_id, create_routine
+from app.routers.common import hydrate_routines, create_routine
 from typing import Union, List
 import logging
 from dotenv import load_dotenv
-import os
-import boto3 
 
 load_dotenv()
 
-collection = get_database()["Therapists"]
-routineCollection = get_database()["Routines"]
-exerciseCollection = get_database()["Exercises"]
-connectionCollection = get_database()["Connections"]
-
 router = APIRouter(prefix="/therapist", tags=["Therapists"])
 
-
-AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-S3_REGION = os.getenv("AWS_REGION")
-
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=AWS_ACCESS_KEY,
-    aws_secret_access_key=AWS_SECRET_KEY,
-    region_name=S3_REGION
-)
-
-def convert_object_ids_to_strings(data):
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if key == "_id":
-                if isinstance(value, dict) and "$oid" in value:
-                    # Convert MongoDB ObjectId to string
-                    data[key] = value["$oid"]
-                else:
-                    data[key] = str(value)  # Ensure all _id values are strings
-            else:
-                data[key] = convert_object_ids_to_strings(
-                    value)  # Recursively process other fields
-    elif isinstance(data, list):
-        # Recursively process lists
-        return [convert_object_ids_to_strings(item) for item in data]
-    return data
-
-
 @router.post("/create_therapist", response_model=str, status_code=201)
-def create_new_therapist(user: Therapist):
+async def create_new_therapist(user: Therapist, collection: TherapistCollection):
     try:
         user_dict = user.model_dump(by_alias=True, exclude=["id"])
         user_dict["_id"] = user.id
         user_dict["connections"] = []
         user_dict["custom_routines"] = []
+        user_dict["version"] = 1
 
-        database_response = collection.insert_one(user_dict)
+        database_response = await collection.insert_one(user_dict)
         
         print(
             f"\n\nNew Therapist Added With ID : {database_response.inserted_id}\n\n")
@@ -86,22 +44,33 @@ def create_new_therapist(user: Therapist):
 
 
 @router.get("/get_therapist/")
-def get_therapist_by_id(therapist_id: str):
-    collection_response = collection.find_one({"_id": therapist_id})
+async def get_therapist_by_id(
+    therapist_id: str,
+    request: Request,
+    collection: TherapistCollection
+):
+    # Client already has a copy: compare versions without loading the document
+    if request.headers.get("if-none-match"):
+        stamp = await collection.find_one({"_id": therapist_id}, {"version": 1})
+        if stamp is not None:
+            etag = version_etag("therapist", therapist_id, stamp.get("version", 0))
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+    collection_response = await collection.find_one({"_id": therapist_id})
     if collection_response:
         therapist = collection_response
         print(f"\n\nTherapist Found: {therapist}\n\n")
-        return convert_object_ids_to_strings(therapist)
+        return BSONResponse(therapist, headers={"ETag": version_etag("therapist", therapist_id, therapist.get("version", 0))})
     else:
         raise HTTPException(status_code=404, detail="Therapist not found")
 
 @router.get("/get_therapist_by_email/")
-def get_therapist_by_email(email: str):
+async def get_therapist_by_email(email: str, collection: TherapistCollection):
     try:
-        therapist = collection.find_one({"email": email})
+        therapist = await collection.find_one({"email": email})
         if therapist:
-            therapist["_id"] = str(therapist["_id"])  # Convert ObjectId to string if needed
-            return convert_object_ids_to_strings(therapist)
+            return BSONResponse(therapist)
         else:
             raise HTTPException(status_code=404, detail="Therapist not found with provided email")
     except PyMongoError as e:
@@ -110,9 +79,13 @@ def get_therapist_by_email(email: str):
         raise HTTPException(status_code=500, detail="An unexpected error occurred")
 
 @router.put("/update_therapist/{therapist_username}")
-def update_therapist_by_username(therapist_username: str, user: Therapist):
+async def update_therapist_by_username(
+    therapist_username: str,
+    user: Therapist,
+    collection: TherapistCollection
+):
     try:
-        result = collection.find_one({"username": therapist_username})
+        result = await collection.find_one({"username": therapist_username})
         if result:
             user_dict = user.model_dump(by_alias=True, exclude=["id"])
             update_fields = {
@@ -120,11 +93,15 @@ def update_therapist_by_username(therapist_username: str, user: Therapist):
                 "imageUrl": user_dict.get("imageUrl"),
                 "expoPushToken": user_dict.get("expoPushToken"),
             }
-            updated_item = collection.update_one(
-                {"username": therapist_username},
-                {"$set": update_fields}
+            # Only match (and bump the version) when a field actually changes
+            updated_item = await collection.update_one(
+                {"username": therapist_username, "$or": [
+                    {field: {"$ne": value}} for field, value in update_fields.items()
+                ]},
+                {"$set": update_fields, "$inc": {"version": 1}}
             )
             if updated_item.modified_count == 1:
+                notifier.forget_token(result["_id"])
                 return {"message": "Therapist updated successfully!"}
             else:
                 return {"message": "No changes made to the therapist"}
@@ -135,7 +112,10 @@ def update_therapist_by_username(therapist_username: str, user: Therapist):
     
     
 @router.post("/create_exercise")
-def create_exercise(exercises: Union[dict, List[dict]] = Body(...)):
+async def create_exercise(
+    exerciseCollection: ExerciseCollection,
+    exercises: Union[dict, List[dict]] = Body(...)
+):
     try:
         if isinstance(exercises, dict):
             exercises = [exercises]
@@ -144,8 +124,10 @@ def create_exercise(exercises: Union[dict, List[dict]] = Body(...)):
         for exercise in exercises:
             if "_id" in exercise and exercise["_id"]:
                 exercise["_id"] = ObjectId(exercise["_id"])
-            inserted = exerciseCollection.insert_one(exercise)
+            exercise["version"] = 1
+            inserted = await exerciseCollection.insert_one(exercise)
             inserted_ids.append(str(inserted.inserted_id))
+        catalog.invalidate()
 
         if len(inserted_ids) == 1:
             return { "_id": inserted_ids[0] }
@@ -163,27 +145,28 @@ def create_exercise(exercises: Union[dict, List[dict]] = Body(...)):
     
 
 @router.get("/get_custom_routines/{therapist_id}")
-def get_custom_routines(therapist_id: str):
-    therapist = collection.find_one({"_id": therapist_id})
+async def get_custom_routines(
+    therapist_id: str,
+    collection: TherapistCollection,
+    exerciseCollection: ExerciseCollection,
+    routineCollection: RoutineCollection
+):
+    therapist = await collection.find_one({"_id": therapist_id}, {"custom_routines": 1})
     if therapist:
-        routine_ids = [{"_id": str(routineID["_id"])} for routineID in therapist.get("custom_routines", [])]
-        routines = [get_routine_by_id(routine["_id"]) for routine in routine_ids]
-        for routine in routines:
-            exercise_ids = [exercise["_id"] for exercise in routine.get("exercises", [])]
-            routine["exercises"] = [get_exercise_by_id(exercise_id) for exercise_id in exercise_ids]
-        return routines
+        routine_ids = [routineID["_id"] for routineID in therapist.get("custom_routines", [])]
+        return BSONResponse(await hydrate_routines(routine_ids, exerciseCollection, routineCollection))
     else:
         raise HTTPException(status_code=404, detail="No Such Therapist")
 
 @router.put("/add_custom_routines/{therapist_id}/{routine_id}")
-def add_custom_routines(therapist_id: str, routine_id: str):
+async def add_custom_routines(therapist_id: str, routine_id: str, collection: TherapistCollection):
     try:
-        therapist = collection.find_one({"_id": therapist_id})
+        therapist = await collection.find_one({"_id": therapist_id})
 
         if therapist:
-            updated_item = collection.update_one(
-                {"_id": therapist_id},
-                {"$addToSet": {"custom_routines": {"_id": ObjectId(routine_id)}}}
+            updated_item = await collection.update_one(
+                {"_id": therapist_id, "custom_routines._id": {"$ne": ObjectId(routine_id)}},
+                {"$addToSet": {"custom_routines": {"_id": ObjectId(routine_id)}}, "$inc": {"version": 1}}
             )
 
             if updated_item.modified_count == 1:
@@ -199,15 +182,21 @@ def add_custom_routines(therapist_id: str, routine_id: str):
     
 
 @router.put("/update_exercise/{exercise_id}")
-async def update_exercise(exercise_id: str, updated_data: dict = Body(...)):
+async def update_exercise(
+    exercise_id: str,
+    exerciseCollection: ExerciseCollection,
+    updated_data: dict = Body(...)
+):
     try:
-        existing = exerciseCollection.find_one({"_id": ObjectId(exercise_id)})
+        existing = await exerciseCollection.find_one({"_id": ObjectId(exercise_id)}, {"_id": 1})
+        updated_data.pop("version", None)
         
         if existing:
-            updated_item = exerciseCollection.update_one(
+            updated_item = await exerciseCollection.update_one(
                 {"_id": ObjectId(exercise_id)},
-                {"$set": updated_data}
+                {"$set": updated_data, "$inc": {"version": 1}}
             )
+            catalog.invalidate()
             return {"message": "Exercise updated", "matched": updated_item.matched_count}
         else:
             raise HTTPException(status_code=404, detail="Exercise not found")
@@ -215,9 +204,14 @@ async def update_exercise(exercise_id: str, updated_data: dict = Body(...)):
         raise HTTPException(status_code=500, detail="Database update failed")
 
 @router.put("/update_routine/{routine_id}")
-async def update_routine(routine_id: str, updated_data: dict = Body(...)):
+async def update_routine(
+    routine_id: str,
+    exerciseCollection: ExerciseCollection,
+    routineCollection: RoutineCollection,
+    updated_data: dict = Body(...)
+):
     try:
-        existing = routineCollection.find_one({"_id": ObjectId(routine_id)})
+        existing = await routineCollection.find_one({"_id": ObjectId(routine_id)})
 
         if not existing:
             raise HTTPException(status_code=404, detail="Routine not found")
@@ -230,23 +224,26 @@ async def update_routine(routine_id: str, updated_data: dict = Body(...)):
                 if "_id" in ex and ex["_id"]:
                     # Validate the exercise exists
                     ex_id = ObjectId(ex["_id"])
-                    if not exerciseCollection.find_one({"_id": ex_id}):
+                    if not await exerciseCollection.find_one({"_id": ex_id}):
                         raise HTTPException(status_code=404, detail=f"Exercise with _id {ex_id} not found")
                     # Just reference it
                     exercise_refs.append({"_id": ex_id})
                 else:
                     # Only insert new exercise
-                    inserted = exerciseCollection.insert_one(ex)
+                    ex["version"] = 1
+                    inserted = await exerciseCollection.insert_one(ex)
                     exercise_refs.append({"_id": inserted.inserted_id})
+                    catalog.invalidate()
 
             updated_data["exercises"] = exercise_refs
 
         # Remove fields not wanted to update
         updated_data.pop("_id", None)
+        updated_data.pop("version", None)
 
-        updated_item = routineCollection.update_one(
+        updated_item = await routineCollection.update_one(
             {"_id": ObjectId(routine_id)},
-            {"$set": updated_data}
+            {"$set": updated_data, "$inc": {"version": 1}}
         )
 
         return {
@@ -259,7 +256,12 @@ async def update_routine(routine_id: str, updated_data: dict = Body(...)):
         raise HTTPException(status_code=500, detail="Database update failed")
 
 @router.put("/update_favorites/{therapist_id}")
-async def update_favorites(therapist_id: str, update_data: dict = Body(...)):
+async def update_favorites(
+    therapist_id: str,
+    collection: TherapistCollection,
+    exerciseCollection: ExerciseCollection,
+    update_data: dict = Body(...)
+):
     try:
         # Validate required fields
         if "exerciseId" not in update_data:
@@ -270,13 +272,13 @@ async def update_favorites(therapist_id: str, update_data: dict = Body(...)):
         
         exercise_id = update_data["exerciseId"]
             
-        # Check if therapist exists
-        therapist = collection.find_one({"_id": therapist_id})
+        # Check if therapist and exercise exist
+        therapist, exercise = await asyncio.gather(
+            collection.find_one({"_id": therapist_id}),
+            exerciseCollection.find_one({"_id": ObjectId(exercise_id)}),
+        )
         if not therapist:
             raise HTTPException(status_code=404, detail="Therapist not found")
-            
-        # Check if exercise exists
-        exercise = exerciseCollection.find_one({"_id": ObjectId(exercise_id)})
         if not exercise:
             raise HTTPException(status_code=404, detail="Exercise not found")
         
@@ -285,16 +287,16 @@ async def update_favorites(therapist_id: str, update_data: dict = Body(...)):
         
         if is_favorited:
             # Remove exercise ID from favorites
-            result = collection.update_one(
+            result = await collection.update_one(
                 {"_id": therapist_id},
-                {"$pull": {"favorites": exercise_id}}
+                {"$pull": {"favorites": exercise_id}, "$inc": {"version": 1}}
             )
             action = "removed from"
         else:
             # Add exercise ID to favorites
-            result = collection.update_one(
+            result = await collection.update_one(
                 {"_id": therapist_id},
-                {"$addToSet": {"favorites": exercise_id}}
+                {"$addToSet": {"favorites": exercise_id}, "$inc": {"version": 1}}
             )
             action = "added to"
             
@@ -315,9 +317,13 @@ async def update_favorites(therapist_id: str, update_data: dict = Body(...)):
 
 
 @router.get("/get_connection_details/{patient_id}/{therapist_id}")
-def get_connection_details(patient_id: str, therapist_id: str):
+async def get_connection_details(
+    patient_id: str,
+    therapist_id: str,
+    connectionCollection: ConnectionCollection
+):
     try:
-        connection = connectionCollection.find_one({
+        connection = await connectionCollection.find_one({
             "patient_id": patient_id,
             "therapist_id": therapist_id
         })
@@ -336,16 +342,16 @@ def get_connection_details(patient_id: str, therapist_id: str):
     
 
 @router.put("/update_connection_details/{patient_id}/{therapist_id}")
-def update_connection_details(
+async def update_connection_details(
     patient_id: str,
     therapist_id: str,
-    data: dict = Body(...)
+    connectionCollection: ConnectionCollection, data: dict = Body(...)
 ):
     try:
         diagnosis = data.get("diagnosis", "")
         notes = data.get("notes", "")
 
-        result = connectionCollection.update_one(
+        result = await connectionCollection.update_one(
             {"patient_id": patient_id, "therapist_id": therapist_id},
             {"$set": {"diagnosis": diagnosis, "notes": notes}}
         )
@@ -360,11 +366,15 @@ def update_connection_details(
         raise HTTPException(status_code=500, detail="Error updating connection details")
 
 @router.post("/add_favorite/{therapist_id}/{exercise_id}")
-def add_favorite_exercise(therapist_id: str, exercise_id: str):
+async def add_favorite_exercise(
+    therapist_id: str,
+    exercise_id: str,
+    collection: TherapistCollection
+):
     try:
-        result = collection.update_one(
-            {"_id": therapist_id},
-            {"$addToSet": {"favorites": exercise_id}}
+        result = await collection.update_one(
+            {"_id": therapist_id, "favorites": {"$ne": exercise_id}},
+            {"$addToSet": {"favorites": exercise_id}, "$inc": {"version": 1}}
         )
         if result.modified_count == 1:
             return {"message": "Exercise added to favorites"}
@@ -375,11 +385,15 @@ def add_favorite_exercise(therapist_id: str, exercise_id: str):
 
 
 @router.delete("/remove_favorite/{therapist_id}/{exercise_id}")
-def remove_favorite_exercise(therapist_id: str, exercise_id: str):
+async def remove_favorite_exercise(
+    therapist_id: str,
+    exercise_id: str,
+    collection: TherapistCollection
+):
     try:
-        result = collection.update_one(
-            {"_id": therapist_id},
-            {"$pull": {"favorites": exercise_id}}
+        result = await collection.update_one(
+            {"_id": therapist_id, "favorites": exercise_id},
+            {"$pull": {"favorites": exercise_id}, "$inc": {"version": 1}}
         )
         if result.modified_count == 1:
             return {"message": "Exercise removed from favorites"}
@@ -389,27 +403,23 @@ def remove_favorite_exercise(therapist_id: str, exercise_id: str):
         raise HTTPException(status_code=500, detail="Database update failed")
 
 @router.get("/get_favorite_routines/{therapist_id}")
-def get_favorite_routines(therapist_id: str):
+async def get_favorite_routines(
+    therapist_id: str,
+    collection: TherapistCollection,
+    exerciseCollection: ExerciseCollection,
+    routineCollection: RoutineCollection
+):
     try:
-        therapist = collection.find_one({"_id": therapist_id})
+        therapist = await collection.find_one({"_id": therapist_id}, {"favorites": 1})
         if not therapist:
             raise HTTPException(status_code=404, detail="Therapist not found")
 
         favorite_ids = [ObjectId(rid) for rid in therapist.get("favorites", []) if rid]
-        routines = list(routineCollection.find({"_id": {"$in": favorite_ids}}))
-
-        for routine in routines:
-            routine["_id"] = str(routine["_id"])
-            exercise_ids = [ex["_id"] for ex in routine.get("exercises", [])]
-            full_exercises = list(exerciseCollection.find({"_id": {"$in": exercise_ids}}))
-
-            for ex in full_exercises:
-                ex["_id"] = str(ex["_id"])
-            routine["exercises"] = full_exercises
+        routines = await hydrate_routines(favorite_ids, exerciseCollection, routineCollection)
 
         print("Matching routine IDs:", favorite_ids)
         print("Routines found:", [r["_id"] for r in routines])
-        return routines
+        return BSONResponse(routines)
 
     except PyMongoError:
         raise HTTPException(status_code=500, detail="Database query failed")
@@ -418,9 +428,13 @@ def get_favorite_routines(therapist_id: str):
         raise HTTPException(status_code=500, detail="Unexpected error")
 
 @router.put("/toggle_favorite/{therapist_id}/{routine_id}")
-def toggle_favorite_routine(therapist_id: str, routine_id: str):
+async def toggle_favorite_routine(
+    therapist_id: str,
+    routine_id: str,
+    collection: TherapistCollection
+):
     try:
-        therapist = collection.find_one({"_id": therapist_id})
+        therapist = await collection.find_one({"_id": therapist_id})
         if not therapist:
             raise HTTPException(status_code=404, detail="Therapist not found")
 
@@ -428,16 +442,16 @@ def toggle_favorite_routine(therapist_id: str, routine_id: str):
 
         if routine_id in favorites:
             # Remove from favorites
-            result = collection.update_one(
+            result = await collection.update_one(
                 {"_id": therapist_id},
-                {"$pull": {"favorites": routine_id}}
+                {"$pull": {"favorites": routine_id}, "$inc": {"version": 1}}
             )
             return {"message": "Routine removed from favorites"}
         else:
             # Add to favorites
-            result = collection.update_one(
+            result = await collection.update_one(
                 {"_id": therapist_id},
-                {"$addToSet": {"favorites": routine_id}}
+                {"$addToSet": {"favorites": routine_id}, "$inc": {"version": 1}}
             )
             return {"message": "Routine added to favorites"}
 
@@ -448,56 +462,11 @@ def toggle_favorite_routine(therapist_id: str, routine_id: str):
         raise HTTPException(status_code=500, detail="Unexpected error")
     
 
-ROLLBAR_ACCESS_TOKEN = os.getenv("ROLLBAR_ACCESS_TOKEN")  # Store the token in an environment variable
-rollbar.init(
-  access_token=ROLLBAR_ACCESS_TOKEN,
-  environment='testenv',
-  code_version='1.0'
-)
-rollbar.report_message('Rollbar is configured correctly', 'info')
-
-@router.post("/send_push_message/{token}")
-def send_push_message(token: str, message: str, extra=None):
-    try:
-        response = PushClient().publish(
-            PushMessage(to=token,
-                        body=message,
-                        data=extra))
-        
-    except PushServerError as exc:
-        # Encountered some likely formatting/validation error.
-        rollbar.report_exc_info(
-            extra_data={
-                'token': token,
-                'message': message,
-                'extra': extra,
-                'errors': exc.errors,
-                'response_data': exc.response_data,
-            })
-        raise
-    except (ConnectionError, HTTPError) as exc:
-        # Encountered some Connection or HTTP error - retry a few times in
-        # case it is transient.
-        rollbar.report_exc_info(
-            extra_data={'token': token, 'message': message, 'extra': extra})
-        raise self.retry(exc=exc)
-
+@router.post("/send_push_message/{token}", status_code=202)
+async def send_push_message(token: str, message: str, extra=None):
+    # Delivery happens in the background push dispatcher (app/push.py)
     try:
-        # We got a response back, but we don't know whether it's an error yet.
-        # This call raises errors so we can handle them with normal exception
-        # flows.
-        response.validate_response()
-    except DeviceNotRegisteredError:
-        # Mark the push token as inactive
-        from notifications.models import PushToken
-        PushToken.objects.filter(token=token).update(active=False)
-    except PushTicketError as exc:
-        # Encountered some other per-notification error.
-        rollbar.report_exc_info(
-            extra_data={
-                'token': token,
-                'message': message,
-                'extra': extra,
-                'push_response': exc.push_response._asdict(),
-            })
-        raise self.retry(exc=exc)
\ No newline at end of file
+        push.queue.enqueue(token, message, extra)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Push queue is full, try again later")
+    return {"message": "Push notification queued"}
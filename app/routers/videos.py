@@ -1,62 +1,173 @@
-from collections import defaultdict
-from fastapi import HTTPException, APIRouter, UploadFile, status
-from pymongo.errors import PyMongoError
-from app.database import get_database
+from fastapi import HTTPException, APIRouter, UploadFile
+from starlette.concurrency import run_in_threadpool
+from pathlib import Path
+from typing import Literal
+import asyncio
+from app import media
+from app.database import VideoCollection
+from app.integrations import get_s3_client
+from app.responses import BSONResponse
+from app.media import SUPPORTED_FILE_TYPES, UPLOAD_BUCKETS, MAX_UPLOAD_BYTES, SNIFF_BYTES, INTERNAL_FIELDS
+from app.models.videos import UploadRequest
+from datetime import datetime, timezone
 from uuid import uuid4
-import os
-import magic
-import boto3
 
-SUPPORTED_FILE_TYPES = {
-    "video/mp4" : "mp4",
-    "video/mov" : "mov",
-    "application/pdf" : "pdf",
-}
+READ_SIZE = 256 * 1024
+PRESIGNED_EXPIRES_SECONDS = 15 * 60
 
-AWS_BUCKET = "powerplaypatientvids"
-s3 = boto3.resource('s3',
-    aws_access_key_id=os.getenv("PATIENTVIDS_KEY_ID"),
-    aws_secret_access_key=os.getenv("PATIENTVIDS_SECRET_KEY"),
-    region_name=os.getenv("us-east-2")
-)
 
-bucket = s3.Bucket(AWS_BUCKET)
+def sniff_file_type(head: bytes) -> str:
+    file_type = media.sniff(head)
+    if file_type not in SUPPORTED_FILE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type {file_type}")
+    return file_type
 
-async def s3_upload(contents, name):
-    bucket.put_object(Key=name, Body=contents)
 
-# custom videos
-CUSTOM_VIDS_BUCKET = "custom-exercise-vids"
-bucket_2 = s3.Bucket(CUSTOM_VIDS_BUCKET)
+QUEUE_FULL_DETAIL = "Media queue is full, try again later"
 
-s3 = boto3.resource('s3',
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_KEY_ID"),
-    region_name=os.getenv("AWS_REGION")
-)
 
-async def s3_custom_vids_upload(contents, name):
-    bucket_2.put_object(Key=name, Body=contents)
+def queue_or_503():
+    if media.queue.full():
+        raise HTTPException(status_code=503, detail=QUEUE_FULL_DETAIL)
 
 
-patientCollection = get_database()["Patients"]
-therapistCollection = get_database()["Therapists"]
-exerciseCollection = get_database()["Exercises"]
-routineCollection = get_database()["Routines"]
+async def spool_upload(file: UploadFile, path: Path, head: bytes):
+    """Copy an upload to the spool file in chunks, enforcing the size limit."""
+    total = len(head)
+    spool = await run_in_threadpool(open, path, "wb")
+    try:
+        await run_in_threadpool(spool.write, head)
+        while chunk := await file.read(READ_SIZE):
+            total += len(chunk)
+            if total > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=400, detail="File size exceeds limit of 20 MB")
+            await run_in_threadpool(spool.write, chunk)
+    except BaseException:
+        await run_in_threadpool(spool.close)
+        await run_in_threadpool(path.unlink, missing_ok=True)
+        raise
+    await run_in_threadpool(spool.close)
+
 
 router = APIRouter( tags=["Videos"])
 
 
-@router.post("/upload_video")
-async def upload(file: UploadFile | None = None):
+@router.post("/upload_video", status_code=202)
+async def upload(
+    videoCollection: VideoCollection,
+    file: UploadFile | None = None,
+    owner_id: str = "",
+    kind: Literal["patient", "custom"] = "patient"
+):
+    """Accept a file and queue it for storage; poll /upload_status/{key}."""
     if not file:
         raise HTTPException(status_code=400, detail="No file provided")
-    
-    contents = await file.read()
-    file_size = len(contents)
-    if file_size > 20 * 1024 * 1024:  # 10 MB limit
+    queue_or_503()
+
+    head = await file.read(SNIFF_BYTES)
+    if not head:
+        raise HTTPException(status_code=400, detail="Empty file")
+    file_type = sniff_file_type(head)
+    key = f"{uuid4()}.{SUPPORTED_FILE_TYPES[file_type]}"
+    path = media.spool_dir() / key
+    await spool_upload(file, path, head)
+
+    await videoCollection.insert_one({
+        "_id": key,
+        "owner_id": owner_id,
+        "kind": kind,
+        "bucket": UPLOAD_BUCKETS[kind],
+        "content_type": file_type,
+        "status": "queued",
+        "attempts": 0,
+        "spool_path": str(path),
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
+    try:
+        media.queue.submit(key)
+    except asyncio.QueueFull:
+        # Filled up while the file was being read; don't leave the job behind
+        await videoCollection.delete_one({"_id": key})
+        await run_in_threadpool(path.unlink, missing_ok=True)
+        raise HTTPException(status_code=503, detail=QUEUE_FULL_DETAIL)
+    return {"key": key, "status": "queued"}
+
+
+@router.post("/upload_url")
+async def create_upload_url(upload: UploadRequest, videoCollection: VideoCollection):
+    """Presigned POST for uploading one file straight to S3.
+
+    The client sends a multipart form to ``url`` with every entry of
+    ``fields`` followed by ``file``; S3 itself rejects a different
+    Content-Type or a file over the size limit. Afterwards the client calls
+    ``POST /upload_complete/{key}``.
+    """
+    if upload.content_type not in SUPPORTED_FILE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type {upload.content_type}")
+    if not 0 < upload.size <= MAX_UPLOAD_BYTES:
         raise HTTPException(status_code=400, detail="File size exceeds limit of 20 MB")
-    file_type = magic.from_buffer(buffer=contents, mime=True)
-    await s3_upload(contents=contents, name=f"{uuid4()}.{SUPPORTED_FILE_TYPES[file_type]}")
-        
-    
\ No newline at end of file
+
+    bucket_name = UPLOAD_BUCKETS[upload.kind]
+    key = f"{uuid4()}.{SUPPORTED_FILE_TYPES[upload.content_type]}"
+    presigned = await run_in_threadpool(
+        get_s3_client().generate_presigned_post,
+        Bucket=bucket_name,
+        Key=key,
+        Fields={"Content-Type": upload.content_type},
+        Conditions=[
+            {"Content-Type": upload.content_type},
+            ["content-length-range", 1, MAX_UPLOAD_BYTES]
+        ],
+        ExpiresIn=PRESIGNED_EXPIRES_SECONDS
+    )
+    await videoCollection.insert_one({
+        "_id": key,
+        "owner_id": upload.owner_id,
+        "kind": upload.kind,
+        "bucket": bucket_name,
+        "content_type": upload.content_type,
+        "status": "pending",
+        "attempts": 0,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
+    return {
+        "key": key,
+        "url": presigned["url"],
+        "fields": presigned["fields"],
+        "expires_in": PRESIGNED_EXPIRES_SECONDS
+    }
+
+
+@router.post("/upload_complete/{key}", status_code=202)
+async def complete_upload(key: str, videoCollection: VideoCollection):
+    """Queue verification of a presigned upload; poll /upload_status/{key}."""
+    queue_or_503()
+    video = await videoCollection.find_one_and_update(
+        {"_id": key, "status": "pending"}, {"$set": {"status": "queued"}})
+    if video:
+        try:
+            media.queue.submit(key)
+        except asyncio.QueueFull:
+            # Back to pending so the client can call again later
+            await videoCollection.update_one({"_id": key, "status": "queued"}, {"$set": {"status": "pending"}})
+            raise HTTPException(status_code=503, detail=QUEUE_FULL_DETAIL)
+        return {"key": key, "status": "queued"}
+
+    video = await videoCollection.find_one({"_id": key}, {"status": 1})
+    if not video:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    # Already queued or finished; calling again changes nothing
+    return {"key": key, "status": video["status"]}
+
+
+@router.get("/upload_status/{key}")
+async def get_upload_status(key: str, videoCollection: VideoCollection):
+    """Current state of an upload job.
+
+    Clients connected to /chat/{owner_id} also receive every change as a
+    ``{"event": "media", "video": {...}}`` message.
+    """
+    video = await videoCollection.find_one({"_id": key}, {field: 0 for field in INTERNAL_FIELDS})
+    if not video:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return BSONResponse(content=video, headers={"Cache-Control": "no-store"})
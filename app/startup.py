@@ -0,0 +1,44 @@
+"""Startup cost accounting.
+
+Each subsystem wraps its import or initialisation in ``timed`` and the
+collected numbers are printed once the app is ready and served at
+/startup_report.
+"""
+from contextlib import contextmanager
+import time
+
+_process_start = time.perf_counter()
+_timings: list[dict] = []
+_ready_at: float | None = None
+
+
+@contextmanager
+def timed(subsystem: str, phase: str = "init"):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timings.append({
+            "subsystem": subsystem,
+            "phase": phase,
+            "ms": round((time.perf_counter() - start) * 1000, 2),
+        })
+
+
+def mark_ready():
+    global _ready_at
+    _ready_at = time.perf_counter()
+
+
+def startup_report() -> dict:
+    ready_ms = None
+    if _ready_at is not None:
+        ready_ms = round((_ready_at - _process_start) * 1000, 2)
+    return {"ready_ms": ready_ms, "timings": list(_timings)}
+
+
+def print_startup_report():
+    report = startup_report()
+    print(f"Startup finished in {report['ready_ms']} ms")
+    for entry in report["timings"]:
+        print(f"  {entry['subsystem']:<20} {entry['phase']:<10} {entry['ms']:>9.2f} ms")
@@ -0,0 +1 @@
+"""Endpoint benchmarks; see benchmarks/run.py."""
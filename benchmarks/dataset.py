@@ -0,0 +1,475 @@
+"""Synthetic data shaped like production.
+
+    python -m benchmarks.dataset --preset production --mongo-uri mongodb://localhost:27017
+    python -m benchmarks.dataset --preset medium --patients 20000 --seed 7 --dry-run
+
+Every document has the shape the routers write: patients and therapists
+as create_new_patient / create_new_therapist insert them (plus the
+connections, assigned routines and favourites later requests add, with
+``version`` bumped once per change), exercises and routines as
+create_exercise / create_routine store them, history buckets and
+Patient_Activity counters as record_completion leaves them, and messages
+as save_message inserts them.
+
+Output depends only on the seed, the size and ``--now``. Each collection,
+and each patient's history, draws from its own seeded generator, so most
+size changes only alter the documents they describe. Documents
+are produced lazily and written with unordered ``insert_many`` batches,
+several in flight at once, so memory stays flat at any size.
+
+Patient ``p000000`` and therapist ``t000000`` are connected and share the
+longest message thread; the benchmarks request them.
+"""
+from dataclasses import asdict, dataclass, fields, replace
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import os
+import random
+import time
+from bson import ObjectId
+from app.history import ACTIVITY_COUNTERS, HISTORY_FIELDS, activity_id, bucket_id, day_key, month_key, totals_id
+
+# Never generate into the real database
+PROTECTED_DATABASES = {"Power_Play"}
+
+CATEGORIES = {
+    "Upper Body": ["Shoulder", "Elbow", "Wrist", "Neck"],
+    "Lower Body": ["Hip", "Knee", "Ankle", "Foot"],
+    "Core": ["Abdominals", "Lower Back", "Obliques"],
+    "Balance": ["Static", "Dynamic", "Vestibular"],
+    "Mobility": ["Stretching", "Range of Motion"],
+}
+# Time a patient spends on each exercise of a routine, and from the last
+# exercise to marking the routine complete
+EXERCISE_DURATION = timedelta(minutes=3)
+ROUTINE_DELAY = timedelta(seconds=1)
+DIAGNOSES = ["ACL reconstruction", "Rotator cuff repair", "Lower back pain", "Ankle sprain", "Total knee replacement"]
+
+
+@dataclass
+class DatasetSize:
+    therapists: int
+    patients: int
+    exercises: int
+    routines: int
+    routines_per_patient: int
+    # Share of patients that also see a second therapist
+    second_therapist_ratio: float = 0.1
+    custom_routines_per_therapist: int = 3
+    favorites_per_therapist: int = 5
+    # The first history_patients patients have completions on roughly
+    # sessions_per_week days a week for the last history_days days
+    history_patients: int = 0
+    history_days: int = 0
+    sessions_per_week: float = 3
+    # Conversations on the first message_threads connections, plus one
+    # long_thread_messages long thread between the target pair
+    message_threads: int = 0
+    messages_per_thread: int = 0
+    long_thread_messages: int = 0
+
+
+PRESETS = {
+    "small": DatasetSize(
+        therapists=5, patients=50, exercises=100, routines=20, routines_per_patient=3,
+        history_patients=5, history_days=90, sessions_per_week=7,
+        message_threads=20, messages_per_thread=12, long_thread_messages=250),
+    "medium": DatasetSize(
+        therapists=20, patients=1000, exercises=500, routines=100, routines_per_patient=8,
+        history_patients=20, history_days=365, sessions_per_week=7,
+        message_threads=200, messages_per_thread=12, long_thread_messages=2500),
+    "large": DatasetSize(
+        therapists=50, patients=5000, exercises=2000, routines=400, routines_per_patient=20,
+        history_patients=50, history_days=3 * 365, sessions_per_week=7,
+        message_threads=1000, messages_per_thread=10, long_thread_messages=10000),
+    "production": DatasetSize(
+        therapists=2000, patients=40000, exercises=3000, routines=8000, routines_per_patient=6,
+        history_patients=10000, history_days=2 * 365, sessions_per_week=3,
+        message_threads=40000, messages_per_thread=25, long_thread_messages=20000),
+}
+
+
+def _rng(seed: int, *scope) -> random.Random:
+    return random.Random(":".join(str(part) for part in (seed, *scope)))
+
+
+def _oid(rng: random.Random) -> ObjectId:
+    return ObjectId(rng.randbytes(12))
+
+
+def patient_id(i: int) -> str:
+    return f"p{i:06d}"
+
+
+def therapist_id(i: int) -> str:
+    return f"t{i:06d}"
+
+
+def _avatar(rng: random.Random, _id: str) -> str | None:
+    return f"https://example.com/avatars/{_id}.jpg" if rng.random() < 0.6 else None
+
+
+def _push_token(rng: random.Random) -> str | None:
+    return f"ExponentPushToken[{rng.randbytes(11).hex()}]" if rng.random() < 0.7 else None
+
+
+def completion_date(when: datetime) -> str:
+    # datetime.utcnow().isoformat() as mark_*_complete writes it
+    return when.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def message_timestamp(when: datetime) -> str:
+    return when.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class Dataset:
+    """Lazily generated documents for one seed, size and point in time."""
+
+    def __init__(self, size: DatasetSize, seed: int = 0, now: datetime | None = None):
+        self.size = size
+        self.seed = seed
+        self.now = now or datetime.utcnow()
+
+        # Ids other collections refer to; small enough to keep
+        rng = _rng(seed, "exercise ids")
+        self.exercise_ids = [_oid(rng) for _ in range(size.exercises)]
+        rng = _rng(seed, "routine ids")
+        self.routine_ids = [_oid(rng) for _ in range(size.routines)]
+
+        rng = _rng(seed, "routines")
+        self.routine_exercises = [
+            rng.sample(range(size.exercises), min(size.exercises, rng.randint(3, 10)))
+            for _ in range(size.routines)
+        ]
+
+        # therapist index -> patient indexes and the reverse
+        rng = _rng(seed, "connections")
+        self.patient_therapists = []
+        self.therapist_patients = [[] for _ in range(size.therapists)]
+        for i in range(size.patients):
+            therapists = [i % size.therapists]
+            if size.therapists > 1 and rng.random() < size.second_therapist_ratio:
+                therapists.append((therapists[0] + rng.randrange(1, size.therapists)) % size.therapists)
+            self.patient_therapists.append(therapists)
+            for t in therapists:
+                self.therapist_patients[t].append(i)
+
+    def exercises(self):
+        rng = _rng(self.seed, "exercises")
+        for i, exercise_id in enumerate(self.exercise_ids):
+            category = rng.choice(list(CATEGORIES))
+            yield {
+                "_id": exercise_id,
+                "title": f"{rng.choice(CATEGORIES[category])} exercise {i}",
+                "category": category,
+                "subcategory": rng.choice(CATEGORIES[category]),
+                "reps": rng.randint(5, 20),
+                "hold": rng.randint(0, 30),
+                "sets": rng.randint(1, 4),
+                "frequency": rng.randint(1, 7),
+                "description": "Keep the movement slow and controlled. " * rng.randint(1, 6),
+                "thumbnail_url": f"https://example.com/thumbnails/{exercise_id}.jpg",
+                "video_url": f"https://example.com/videos/{exercise_id}.mp4",
+                "version": 1,
+            }
+
+    def routines(self):
+        for i, routine_id in enumerate(self.routine_ids):
+            yield {
+                "_id": routine_id,
+                "name": f"Routine {i}",
+                "imageurl": "",
+                "exercises": [{"_id": self.exercise_ids[e]} for e in self.routine_exercises[i]],
+                "version": 1,
+            }
+
+    def assigned_routines(self, i: int) -> list[int]:
+        """Routine indexes assigned to patient i; history only uses these."""
+        rng = _rng(self.seed, "assigned", i)
+        return rng.sample(range(self.size.routines), min(self.size.routines, self.size.routines_per_patient))
+
+    def patients(self):
+        # Field order follows the Patient model dump, then what
+        # create_new_patient adds
+        rng = _rng(self.seed, "patients")
+        for i in range(self.size.patients):
+            _id = patient_id(i)
+            connections = [therapist_id(t) for t in self.patient_therapists[i]]
+            assigned = self.assigned_routines(i)
+            yield {
+                "username": _id,
+                "firstname": f"First{i}",
+                "lastname": f"Last{i}",
+                "email": f"{_id}@example.com",
+                "connections": connections,
+                "assigned_routines": [{"_id": self.routine_ids[r]} for r in assigned],
+                "imageUrl": _avatar(rng, _id),
+                "streak": rng.randint(0, 60),
+                "expoPushToken": _push_token(rng),
+                "_id": _id,
+                "version": 1 + len(connections) + len(assigned),
+            }
+
+    def therapists(self):
+        rng = _rng(self.seed, "therapists")
+        for i in range(self.size.therapists):
+            _id = therapist_id(i)
+            connections = [patient_id(p) for p in self.therapist_patients[i]]
+            custom = rng.sample(self.routine_ids, min(len(self.routine_ids), self.size.custom_routines_per_therapist))
+            favorites = rng.sample(self.routine_ids, min(len(self.routine_ids), self.size.favorites_per_therapist))
+            yield {
+                "username": _id,
+                "firstname": f"First{i}",
+                "lastname": f"Last{i}",
+                "email": f"{_id}@example.com",
+                "imageUrl": _avatar(rng, _id),
+                "favorites": [str(routine_id) for routine_id in favorites],
+                "expoPushToken": _push_token(rng),
+                "_id": _id,
+                "connections": connections,
+                "custom_routines": [{"_id": routine_id} for routine_id in custom],
+                "version": 1 + len(connections) + len(custom) + len(favorites),
+            }
+
+    def connections(self):
+        rng = _rng(self.seed, "connection details")
+        for i, therapists in enumerate(self.patient_therapists):
+            for t in therapists:
+                connection = {
+                    "patient_id": patient_id(i),
+                    "therapist_id": therapist_id(t),
+                    "status": "accepted" if rng.random() < 0.9 else "pending",
+                }
+                if rng.random() < 0.5:
+                    connection["diagnosis"] = rng.choice(DIAGNOSES)
+                    connection["notes"] = "Progressing well. " * rng.randint(1, 5)
+                if rng.random() < 0.05:
+                    connection["is_muted"] = True
+                yield connection
+
+    def _thread(self, rng: random.Random, user1: str, user2: str, count: int):
+        unread = rng.randint(0, 3)
+        when = self.now - timedelta(minutes=count * rng.randint(5, 120))
+        for i in range(count):
+            when += timedelta(seconds=rng.randint(5, 7200))
+            sender, receiver = (user1, user2) if rng.random() < 0.5 else (user2, user1)
+            if rng.random() < 0.95:
+                kind, message = "text", ("How is the knee feeling today? " * rng.randint(1, 4)).strip()
+            else:
+                kind, message = "image", f"https://example.com/chat/{rng.randbytes(8).hex()}.jpg"
+            yield {
+                "sender_id": sender,
+                "receiver_id": receiver,
+                "type": kind,
+                "read": i < count - unread,
+                "timestamp": message_timestamp(min(when, self.now)),
+                "message": message,
+            }
+
+    def messages(self):
+        rng = _rng(self.seed, "messages")
+        if self.size.long_thread_messages and self.size.patients and self.size.therapists:
+            yield from self._thread(rng, patient_id(0), therapist_id(self.patient_therapists[0][0]),
+                                    self.size.long_thread_messages)
+        threads = 0
+        for i, therapists in enumerate(self.patient_therapists):
+            if threads >= self.size.message_threads:
+                break
+            for t in therapists:
+                if threads >= self.size.message_threads:
+                    break
+                count = max(1, int(rng.expovariate(1 / self.size.messages_per_thread)))
+                yield from self._thread(rng, patient_id(i), therapist_id(t), count)
+                threads += 1
+
+    def _sessions(self, i: int):
+        """(when, routine index) for every day patient i worked out."""
+        rng = _rng(self.seed, "history", i)
+        chance = min(1.0, self.size.sessions_per_week / 7)
+        assigned = self.assigned_routines(i)
+        if not assigned:
+            return
+        for days_ago in range(self.size.history_days, -1, -1):
+            if rng.random() < chance:
+                when = (self.now - timedelta(days=days_ago)).replace(
+                    hour=rng.randint(6, 21), minute=rng.randint(0, 59), second=rng.randint(0, 59),
+                    microsecond=rng.randint(0, 999999))
+                yield min(when, self.now), rng.choice(assigned)
+
+    def history(self):
+        """Monthly buckets and activity counters, one patient at a time.
+
+        Yields ``(collection name, document)`` so both collections are
+        built from a single pass over each patient's sessions.
+        """
+        titles = {}
+        for exercise in self.exercises():
+            titles[exercise["_id"]] = exercise["title"]
+
+        for i in range(min(self.size.history_patients, self.size.patients)):
+            _id = patient_id(i)
+            buckets, days = {}, {}
+            totals = {"_id": totals_id(_id), "patient_id": _id, "exercises": 0, "routines": 0}
+            for when, routine in self._sessions(i):
+                # Each exercise is marked complete as it is finished and the
+                # routine after the last one, so no two entries share a date
+                exercises = self.routine_exercises[routine]
+                when = min(when, self.now - EXERCISE_DURATION * len(exercises) - ROUTINE_DELAY)
+                completions = []
+                for step, e in enumerate(exercises, 1):
+                    exercise_id = self.exercise_ids[e]
+                    completions.append(("exercise", {
+                        "_id": str(exercise_id), "title": titles[exercise_id],
+                        "date": completion_date(when + EXERCISE_DURATION * step)}))
+                completions.append(("routine", {
+                    "_id": str(self.routine_ids[routine]), "name": f"Routine {routine}",
+                    "date": completion_date(when + EXERCISE_DURATION * len(exercises) + ROUTINE_DELAY)}))
+
+                for kind, entry in completions:
+                    month, day = month_key(entry["date"]), day_key(entry["date"])
+                    bucket = buckets.get(month)
+                    if bucket is None:
+                        bucket = buckets[month] = {"_id": bucket_id(_id, month), "patient_id": _id, "month": month}
+                    daily = days.get(day)
+                    if daily is None:
+                        daily = days[day] = {"_id": activity_id(_id, day), "patient_id": _id, "day": day}
+                    field, counter = HISTORY_FIELDS[kind]
+                    bucket.setdefault(field, []).append(entry)
+                    bucket[counter] = bucket.get(counter, 0) + 1
+                    activity_counter = ACTIVITY_COUNTERS[kind]
+                    daily[activity_counter] = daily.get(activity_counter, 0) + 1
+                    totals[activity_counter] += 1
+
+            for bucket in buckets.values():
+                yield "Patient_History_Buckets", bucket
+            for daily in days.values():
+                yield "Patient_Activity", daily
+            if totals["exercises"] or totals["routines"]:
+                yield "Patient_Activity", totals
+
+    def collections(self):
+        """(collection name, document iterator) in load order."""
+        return [
+            ("Exercises", self.exercises()),
+            ("Routines", self.routines()),
+            ("Therapists", self.therapists()),
+            ("Patients", self.patients()),
+            ("Connections", self.connections()),
+            ("Messages", self.messages()),
+            (None, self.history()),
+        ]
+
+
+class BulkWriter:
+    """Unordered insert_many batches with a bounded number in flight."""
+
+    def __init__(self, db, batch_size: int = 1000, concurrency: int = 4, dry_run: bool = False):
+        self.db = db
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.counts: dict[str, int] = {}
+        self._batches: dict[str, list] = {}
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: set[asyncio.Task] = set()
+
+    async def add(self, collection_name: str, document: dict):
+        batch = self._batches.setdefault(collection_name, [])
+        batch.append(document)
+        if len(batch) >= self.batch_size:
+            await self._flush(collection_name)
+
+    async def _flush(self, collection_name: str):
+        batch = self._batches.pop(collection_name, [])
+        if not batch:
+            return
+        self.counts[collection_name] = self.counts.get(collection_name, 0) + len(batch)
+        if self.dry_run:
+            return
+        await self._slots.acquire()
+        task = asyncio.create_task(self._insert(collection_name, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _insert(self, collection_name: str, batch: list):
+        try:
+            await self.db[collection_name].insert_many(batch, ordered=False)
+        finally:
+            self._slots.release()
+
+    async def close(self):
+        for collection_name in list(self._batches):
+            await self._flush(collection_name)
+        await asyncio.gather(*self._tasks)
+
+
+async def load(db, dataset: Dataset, batch_size: int = 1000, concurrency: int = 4, dry_run: bool = False) -> dict:
+    """Write every collection of ``dataset`` into ``db``; returns document counts."""
+    writer = BulkWriter(db, batch_size, concurrency, dry_run)
+    for collection_name, documents in dataset.collections():
+        for document in documents:
+            if collection_name is None:
+                await writer.add(*document)
+            else:
+                await writer.add(collection_name, document)
+    await writer.close()
+    return writer.counts
+
+
+def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from app import database, indexes
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.dataset")
+    parser.add_argument("--preset", choices=PRESETS, default="medium")
+    for field in fields(DatasetSize):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=field.type, help=f"override the preset's {field.name}")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--now", help="YYYY-MM-DD the history and messages end on (default today)")
+    parser.add_argument("--mongo-uri", help="default MONGO_DB_URI")
+    parser.add_argument("--database", help="default MONGO_DB_NAME")
+    parser.add_argument("--drop", action="store_true", help="drop the generated collections first")
+    parser.add_argument("--no-indexes", action="store_true", help="skip creating the declared indexes afterwards")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=4, help="insert_many batches in flight")
+    parser.add_argument("--dry-run", action="store_true", help="generate and count only")
+    args = parser.parse_args()
+
+    load_dotenv()
+    overrides = {
+        field: getattr(args, field) for field in asdict(PRESETS[args.preset])
+        if getattr(args, field) is not None
+    }
+    size = replace(PRESETS[args.preset], **overrides)
+    now = datetime.strptime(args.now, "%Y-%m-%d").replace(hour=23, minute=59, second=59) if args.now else None
+    dataset = Dataset(size, args.seed, now)
+
+    async def run():
+        client = AsyncIOMotorClient(args.mongo_uri or os.getenv("MONGO_DB_URI"), **database.client_options())
+        db = client[args.database or database.DATABASE_NAME]
+        try:
+            if db.name in PROTECTED_DATABASES and not args.dry_run:
+                parser.error(f"refusing to write to {db.name}; pass --database or set MONGO_DB_NAME")
+            if args.drop and not args.dry_run:
+                for collection_name in ("Exercises", "Routines", "Therapists", "Patients", "Connections",
+                                        "Messages", "Patient_History_Buckets", "Patient_Activity"):
+                    await db[collection_name].drop()
+            started = time.perf_counter()
+            counts = await load(db, dataset, args.batch_size, args.concurrency, args.dry_run)
+            elapsed = time.perf_counter() - started
+            for collection_name, count in counts.items():
+                print(f"{collection_name:<25} {count:>12,}")
+            print(f"{'total':<25} {sum(counts.values()):>12,}  in {elapsed:.1f}s{' (dry run)' if args.dry_run else ''}")
+            if not args.dry_run and not args.no_indexes:
+                started = time.perf_counter()
+                await indexes.ensure_indexes(db)
+                print(f"indexes created in {time.perf_counter() - started:.1f}s")
+        finally:
+            client.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
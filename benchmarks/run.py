@@ -0,0 +1,199 @@
+"""Time the hot endpoints at several data sizes.
+
+    python -m benchmarks.run                              # mongomock, every size
+    python -m benchmarks.run --sizes small,medium --repeat 100
+    python -m benchmarks.run --mongo-uri mongodb://localhost:27017
+    python -m benchmarks.run --compare benchmarks/results/before.json
+
+Each size is generated into a fresh database (the presets of
+benchmarks/dataset.py) and every endpoint is called in-process through
+the ASGI app, without a network hop or the app lifespan, so the
+background queues stay idle.
+With ``--mongo-uri`` the data goes to the MONGO_DB_NAME database
+(default ``Power_Play_bench``, which is dropped first), and the declared
+indexes are created before timing.
+
+Results are written as JSON. ``--compare`` reads an earlier run, prints
+the median change per endpoint and exits with status 1 when one got
+slower than ``--threshold``.
+"""
+from dataclasses import asdict
+from datetime import datetime, timezone
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DATABASE = "Power_Play_bench"
+os.environ.setdefault("MONGO_DB_NAME", BENCH_DATABASE)
+
+import httpx
+from app import catalog, database, indexes
+from app.main import app
+from benchmarks.dataset import PRESETS, Dataset, load, patient_id, therapist_id
+
+SIZES = {name: PRESETS[name] for name in ("small", "medium", "large")}
+TARGETS = {"patient_id": patient_id(0), "therapist_id": therapist_id(0)}
+
+# (name, path) with {patient_id} and {therapist_id} from TARGETS.
+# explore_collection rebuilds the snapshot on every call, explore_collection
+# (cached) measures serving it.
+ENDPOINTS = [
+    ("explore_collection", "/get_explore_collection"),
+    ("explore_collection (cached)", "/get_explore_collection"),
+    ("assigned_routines", "/patient/get_assigned_routines/{patient_id}"),
+    ("progress", "/patient/get_progress/{patient_id}"),
+    ("graph_data", "/get_graph_data/{patient_id}"),
+    ("graph_data (365 days)", "/get_graph_data/{patient_id}?days=365&group_by=week"),
+    ("messages", "/messages/{patient_id}/{therapist_id}"),
+    ("user_connections", "/get_connections/{therapist_id}/therapist"),
+    ("completed_exercises", "/patient/get_completed_exercises/{patient_id}"),
+]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+    return {
+        "median_ms": round(statistics.median(ordered) * 1000, 3),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+async def time_endpoint(client: httpx.AsyncClient, name: str, path: str, repeat: int, warmup: int) -> dict:
+    samples, response = [], None
+    for i in range(warmup + repeat):
+        if name == "explore_collection":
+            catalog.invalidate()
+        start = time.perf_counter()
+        response = await client.get(path)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            samples.append(elapsed)
+    return {"status": response.status_code, "bytes": len(response.content), **summarize(samples)}
+
+
+async def run_size(size_name: str, mongo_uri: str | None, repeat: int, warmup: int, seed_value: int) -> list[dict]:
+    if mongo_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(mongo_uri, **database.client_options())
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        client = AsyncMongoMockClient()
+    database.connect(client)
+    try:
+        db = database.get_database()
+        if mongo_uri:
+            await client.drop_database(db.name)
+            await indexes.ensure_indexes(db)
+
+        started = time.perf_counter()
+        await load(db, Dataset(SIZES[size_name], seed_value))
+        print(f"[{size_name}] loaded in {time.perf_counter() - started:.1f}s")
+
+        results = []
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            for name, path in ENDPOINTS:
+                result = await time_endpoint(http, name, path.format(**TARGETS), repeat, warmup)
+                if result["status"] != 200:
+                    print(f"[{size_name}] {name} returned {result['status']}")
+                print(f"[{size_name}] {name:<30} median {result['median_ms']:>9.3f} ms   p95 {result['p95_ms']:>9.3f} ms")
+                results.append({"size": size_name, "endpoint": name, "path": path, **result})
+        return results
+    finally:
+        if mongo_uri:
+            await client.drop_database(database.get_database().name)
+        database.close()
+
+
+def compare(results: list[dict], baseline_path: Path, threshold: float) -> bool:
+    """Print median changes against an earlier run; True if any regressed."""
+    baseline = {
+        (result["size"], result["endpoint"]): result
+        for result in json.loads(baseline_path.read_text())["results"]
+    }
+    regressed = False
+    print(f"\nCompared with {baseline_path} (threshold {threshold:.0%}):")
+    for result in results:
+        before = baseline.get((result["size"], result["endpoint"]))
+        if before is None:
+            continue
+        change = result["median_ms"] / before["median_ms"] - 1 if before["median_ms"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"  [{result['size']}] {result['endpoint']:<30} {before['median_ms']:>9.3f} -> "
+              f"{result['median_ms']:>9.3f} ms  ({change:+.1%}){flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--sizes", default=",".join(SIZES), help=f"comma separated, from {', '.join(SIZES)}")
+    parser.add_argument("--repeat", type=int, default=30, help="timed calls per endpoint")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed calls per endpoint first")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo-uri", help="benchmark against this mongod instead of mongomock")
+    parser.add_argument("--output", type=Path, help="default benchmarks/results/<timestamp>-<commit>.json")
+    parser.add_argument("--compare", type=Path, help="earlier results file to compare medians with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown counted as a regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    sizes = [name.strip() for name in args.sizes.split(",") if name.strip()]
+    unknown = [name for name in sizes if name not in SIZES]
+    if unknown:
+        parser.error(f"unknown size(s): {', '.join(unknown)}")
+    if args.mongo_uri and database.DATABASE_NAME == "Power_Play":
+        parser.error("refusing to drop the Power_Play database; set MONGO_DB_NAME to a scratch database")
+
+    results = []
+    for size_name in sizes:
+        results += asyncio.run(run_size(size_name, args.mongo_uri, args.repeat, args.warmup, args.seed))
+
+    commit = git_commit()
+    started_at = datetime.now(timezone.utc)
+    output = args.output or Path(__file__).resolve().parent / "results" / (
+        f"{started_at:%Y%m%dT%H%M%SZ}-{commit or 'unknown'}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        "meta": {
+            "created_at": started_at.isoformat(),
+            "commit": commit,
+            "backend": "mongod" if args.mongo_uri else "mongomock",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "sizes": {name: asdict(SIZES[name]) for name in sizes},
+        },
+        "results": results,
+    }, indent=2))
+    print(f"\nResults written to {output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import httpx
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from app import database
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db():
+    database.connect(AsyncMongoMockClient())
+    yield database.get_database()
+    database._client = None
+
+
+@pytest.fixture
+async def client(db):
+    """The app in-process, without its lifespan, so no queue is running."""
+    from app.main import app
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
@@ -0,0 +1,91 @@
+import asyncio
+import fakeredis
+import pytest
+from app import chat
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSocket:
+    def __init__(self):
+        self.received = []
+
+    async def send_json(self, payload):
+        self.received.append(payload)
+
+
+async def wait_for(condition, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("timed out")
+        await asyncio.sleep(0.01)
+
+
+def connected(hub: chat.ChatHub, user_id: str) -> FakeSocket:
+    socket = FakeSocket()
+    hub.add(user_id, socket)
+    return socket
+
+
+async def test_in_process_broker_delivers_to_both_participants(monkeypatch):
+    hub = chat.ChatHub()
+    monkeypatch.setattr(chat, "broker", chat.InProcessBroker(hub))
+    patient, therapist = connected(hub, "p1"), connected(hub, "t1")
+
+    await chat.publish_message({"sender_id": "p1", "receiver_id": "t1", "text": "hi"})
+
+    assert patient.received == therapist.received == [{"event": "message", "message": {
+        "sender_id": "p1", "receiver_id": "t1", "text": "hi"}}]
+
+
+async def test_redis_broker_relays_between_workers():
+    server = fakeredis.FakeServer()
+    hubs = [chat.ChatHub(), chat.ChatHub()]
+    brokers = [chat.RedisBroker(hub, fakeredis.FakeAsyncRedis(server=server)) for hub in hubs]
+    for broker in brokers:
+        await broker.start()
+    socket = connected(hubs[1], "t1")
+    try:
+        await brokers[0].publish("t1", {"event": "message", "text": "hi"})
+        await wait_for(lambda: socket.received)
+        assert socket.received == [{"event": "message", "text": "hi"}]
+    finally:
+        for broker in brokers:
+            await broker.stop()
+
+
+async def test_redis_broker_resubscribes_after_losing_redis():
+    server = fakeredis.FakeServer()
+    hub = chat.ChatHub()
+    redis = fakeredis.FakeAsyncRedis(server=server)
+    broker = chat.RedisBroker(hub, redis)
+    broker.RECONNECT_BASE_SECONDS = 0.01
+    socket = connected(hub, "t1")
+
+    async def dropped():
+        raise ConnectionError("Connection reset by peer")
+        yield
+
+    pubsubs = []
+
+    def pubsub():
+        # The first subscription fails as soon as it is read
+        pubsubs.append(fakeredis.FakeAsyncRedis.pubsub(redis))
+        if len(pubsubs) == 1:
+            pubsubs[0].listen = dropped
+        return pubsubs[-1]
+
+    redis.pubsub = pubsub
+    await broker.start()
+    publisher = fakeredis.FakeAsyncRedis(server=server)
+    try:
+        await wait_for(lambda: broker._pubsub is not None and len(pubsubs) == 2)
+        assert not broker._listener.done()
+
+        await publisher.publish("chat:t1", '{"text": "after"}')
+        await wait_for(lambda: socket.received)
+        assert socket.received == [{"text": "after"}]
+    finally:
+        await broker.stop()
+        await publisher.aclose()
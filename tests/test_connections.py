@@ -0,0 +1,28 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_connections_filter_and_page(client, db):
+    await db["Therapists"].insert_one({"_id": "t1", "firstname": "Terry"})
+    await db["Patients"].insert_many([{"_id": f"p{i}", "firstname": f"Pat {i}"} for i in range(3)])
+    await db["Connections"].insert_many([
+        {"patient_id": "p0", "therapist_id": "t1", "status": "accepted"},
+        {"patient_id": "p1", "therapist_id": "t1", "status": "pending"},
+        {"patient_id": "p2", "therapist_id": "t1"},
+    ])
+
+    response = await client.get("/get_connections/t1/therapist", params={"status": "accepted"})
+    assert response.status_code == 200
+    assert [c["_id"] for c in response.json()["connections"]] == ["p0", "p2"]
+
+    page = (await client.get("/get_connections/t1/therapist", params={"limit": 2})).json()
+    assert [c["_id"] for c in page["connections"]] == ["p0", "p1"]
+    rest = (await client.get("/get_connections/t1/therapist", params={"limit": 2, "after": page["next_cursor"]})).json()
+    assert [c["_id"] for c in rest["connections"]] == ["p2"]
+    assert rest["next_cursor"] is None
+
+
+async def test_connections_rejects_unknown_status(client, db):
+    response = await client.get("/get_connections/t1/therapist", params={"status": "blocked"})
+    assert response.status_code == 422
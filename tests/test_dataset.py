@@ -0,0 +1,27 @@
+from datetime import datetime
+from benchmarks.dataset import PRESETS, Dataset, completion_date
+
+NOW = datetime(2025, 6, 1, 0, 10)
+
+
+def test_history_dates_are_unique_and_ordered():
+    dataset = Dataset(PRESETS["small"], seed=3, now=NOW)
+    dates = {}
+    for name, document in dataset.history():
+        if name != "Patient_History_Buckets":
+            continue
+        for field in ("completed_exercises", "completed_routines"):
+            entries = document.get(field, [])
+            assert [entry["date"] for entry in entries] == sorted(entry["date"] for entry in entries)
+            assert all(entry["date"][:7] == document["month"] for entry in entries)
+            dates.setdefault(document["patient_id"], []).extend(entry["date"] for entry in entries)
+
+    assert dates
+    for patient_dates in dates.values():
+        assert len(patient_dates) == len(set(patient_dates))
+        assert max(patient_dates) <= completion_date(NOW)
+
+
+def test_history_is_deterministic():
+    first = list(Dataset(PRESETS["small"], seed=3, now=NOW).history())
+    assert first == list(Dataset(PRESETS["small"], seed=3, now=NOW).history())
@@ -0,0 +1,53 @@
+import pytest
+from app.history import completion_page, history_cursor, parse_history_cursor
+
+pytestmark = pytest.mark.anyio
+
+PATIENT = "p1"
+
+
+async def add_bucket(db, month: str, dates: list[str]):
+    await db["Patient_History_Buckets"].insert_one({
+        "_id": f"{PATIENT}:{month}",
+        "patient_id": PATIENT,
+        "month": month,
+        "completed_exercises": [{"_id": f"e{i}", "title": f"exercise {i}", "date": date} for i, date in enumerate(dates)],
+    })
+
+
+async def page_through(db, limit: int, **bounds) -> list[dict]:
+    seen, before = [], None
+    while True:
+        page = await completion_page(db["Patient_History_Buckets"], PATIENT, "exercise", limit, before, **bounds)
+        seen += [entry for entry, _ in page[:limit]]
+        if len(page) <= limit:
+            return seen
+        before = page[limit - 1][1]
+
+
+def test_cursor_round_trip():
+    assert parse_history_cursor(history_cursor("2025-03-01T10:00:00", 4)) == ("2025-03-01T10:00:00", 4)
+    assert parse_history_cursor("2025-03-01T10:00:00") == ("2025-03-01T10:00:00", None)
+    with pytest.raises(ValueError):
+        parse_history_cursor("2025-03-01T10:00:00_x")
+
+
+async def test_pages_through_tied_dates(db):
+    # A routine and its exercises are recorded in the same instant
+    tied = "2025-03-10T09:00:00"
+    await add_bucket(db, "2025-02", ["2025-02-27T08:00:00", "2025-02-27T08:00:00"])
+    await add_bucket(db, "2025-03", ["2025-03-01T10:00:00"] + [tied] * 7 + ["2025-03-12T18:30:00"])
+
+    for limit in (1, 2, 3, 5):
+        seen = await page_through(db, limit)
+        assert len(seen) == 11
+        assert len({entry["_id"] + entry["date"][:7] for entry in seen}) == 11
+        dates = [entry["date"] for entry in seen]
+        assert dates == sorted(dates, reverse=True)
+
+
+async def test_date_bounds_with_ties(db):
+    await add_bucket(db, "2025-03", ["2025-03-01T10:00:00"] * 3 + ["2025-03-05T10:00:00"] * 3)
+
+    seen = await page_through(db, 2, start="2025-03-02", end="2025-03-31")
+    assert [entry["_id"] for entry in seen] == ["e5", "e4", "e3"]
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta, timezone
+import asyncio
+import pytest
+from app import media
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def queue(db):
+    queue = media.MediaQueue(workers=1, maxsize=10, max_attempts=3, retry_base_seconds=0, lease_seconds=60)
+    queue.videoCollection = db["Videos"]
+    queue._queue = asyncio.Queue(queue.maxsize)
+    return queue
+
+
+def job(key: str, status: str, **fields) -> dict:
+    return {"_id": key, "owner_id": "t1", "kind": "custom", "bucket": "bucket", "content_type": "application/pdf",
+            "status": status, "attempts": 1, **fields}
+
+
+async def test_resume_skips_live_leases(queue, db):
+    now = datetime.now(timezone.utc)
+    await db["Videos"].insert_many([
+        job("live.pdf", "processing", owner="other", lease_until=now + timedelta(minutes=5)),
+        job("expired.pdf", "processing", owner="other", lease_until=now - timedelta(minutes=5)),
+        job("waiting.pdf", "retrying", owner="other", lease_until=now + timedelta(minutes=5)),
+        job("queued.pdf", "queued"),
+        job("done.pdf", "uploaded"),
+    ])
+    await queue._resume()
+
+    resumed = sorted(queue._queue.get_nowait() for _ in range(queue._queue.qsize()))
+    assert resumed == ["expired.pdf", "queued.pdf"]
+    live = await db["Videos"].find_one({"_id": "live.pdf"})
+    assert (live["status"], live["owner"]) == ("processing", "other")
+    expired = await db["Videos"].find_one({"_id": "expired.pdf"})
+    assert (expired["status"], expired["owner"], expired["lease_until"]) == ("queued", None, None)
+
+
+async def test_run_leases_and_releases(queue, db, monkeypatch):
+    seen = {}
+
+    async def process(video):
+        seen.update(await db["Videos"].find_one({"_id": video["_id"]}))
+        return {"size": 1}
+
+    monkeypatch.setattr(media, "process", process)
+    monkeypatch.setattr(media.chat.broker, "publish", lambda *args: asyncio.sleep(0))
+    await db["Videos"].insert_one(job("a.pdf", "queued", attempts=0))
+    await queue._run("a.pdf")
+
+    assert seen["status"] == "processing"
+    assert seen["owner"] == queue.owner
+    assert seen["lease_until"] is not None
+    video = await db["Videos"].find_one({"_id": "a.pdf"})
+    assert (video["status"], video["owner"], video["lease_until"]) == ("uploaded", None, None)
+    assert "owner" not in media.public_job(video)
@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from app import metrics
+
+
+def succeeded(reply: dict):
+    metrics.listener.succeeded(SimpleNamespace(reply=reply, duration_micros=1500))
+
+
+def test_reply_bytes_off(monkeypatch):
+    monkeypatch.setattr(metrics, "_background", metrics.RequestStats())
+    monkeypatch.setattr(metrics, "REPLY_BYTES", False)
+
+    succeeded({"ok": 1, "cursor": {"firstBatch": [{"_id": 1}]}})
+
+    assert metrics._background.commands == 1
+    assert metrics._background.reply_bytes == 0
+    assert "mongo_reply_bytes_total" not in metrics.render()
+
+
+def test_reply_bytes_when_enabled(monkeypatch):
+    monkeypatch.setattr(metrics, "_background", metrics.RequestStats())
+    monkeypatch.setattr(metrics, "REPLY_BYTES", True)
+
+    succeeded({"ok": 1})
+
+    assert metrics._background.reply_bytes > 0
+    assert 'mongo_reply_bytes_total{route="background",method=""}' in metrics.render()
+
+
+class CountingCollection:
+    """Reports each lookup to the listener the way the Mongo client would."""
+
+    async def find_one(self, *args, **kwargs):
+        succeeded({"ok": 1})
+        return None
+
+
+@pytest.mark.anyio
+async def test_notifier_lookups_count_as_background(monkeypatch):
+    from app.notifications import MessageNotifier
+    monkeypatch.setattr(metrics, "_background", metrics.RequestStats())
+    notifier = MessageNotifier(window=0, cache_ttl=60)
+    await notifier.start({"Connections": CountingCollection(), "Patients": CountingCollection(),
+                          "Therapists": CountingCollection()})
+
+    request = metrics.RequestStats()
+    token = metrics._current.set(request)
+    try:
+        notifier.message_saved({"sender_id": "p1", "receiver_id": "t1", "message": "hi"})
+    finally:
+        metrics._current.reset(token)
+    await asyncio.gather(*notifier._tasks)
+
+    assert request.commands == 0
+    assert metrics._background.commands == 3
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+import pytest
+from exponent_server_sdk import PushServerError
+from app import push
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeRollbar:
+    def report_exc_info(self, **kwargs):
+        pass
+
+
+class FailingClient:
+    def __init__(self, status: int, errors: list | None):
+        self.status = status
+        self.errors = errors
+        self.calls = []
+
+    def publish_multiple(self, messages):
+        self.calls.append(len(messages))
+        raise PushServerError("Request failed", SimpleNamespace(status_code=self.status), errors=self.errors)
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    monkeypatch.setattr(push, "get_rollbar", FakeRollbar)
+    queue = push.PushQueue(maxsize=100, batch_size=100, batch_window=0, max_attempts=3, retry_base_seconds=60)
+    yield queue
+    for task in queue._tasks:
+        task.cancel()
+
+
+def batch(size: int) -> list[push.PendingPush]:
+    return [push.PendingPush(f"ExponentPushToken[{i}]", "hello") for i in range(size)]
+
+
+@pytest.mark.parametrize("status, errors", [
+    (429, [{"code": "TOO_MANY_REQUESTS", "message": "slow down"}]),
+    (503, [{"code": "INTERNAL_SERVER_ERROR", "message": "oops"}]),
+    (502, None),
+])
+async def test_request_errors_retry_whole_batch(queue, status, errors):
+    queue._push_client = client = FailingClient(status, errors)
+    await queue._send(batch(10))
+
+    assert client.calls == [10]
+    assert queue.metrics.retried == 10
+    assert queue.metrics.failed == 0
+    assert queue.stats()["scheduled_retries"] == 10
+
+
+async def test_message_errors_split_the_batch(queue):
+    queue._push_client = client = FailingClient(400, [{"code": "VALIDATION_ERROR", "message": "bad token"}])
+    await queue._send(batch(3))
+
+    assert client.calls == [3, 1, 1, 1]
+    assert queue.metrics.retried == 0
+    assert queue.metrics.failed == 3
+
+
+async def test_unregistered_tokens_leave_the_notifier_cache(queue, db, monkeypatch):
+    from app.notifications import notifier
+    monkeypatch.setattr(notifier, "tokens", notifier.tokens.__class__(60))
+    await db["Patients"].insert_one({"_id": "p1", "expoPushToken": "ExponentPushToken[gone]", "version": 1})
+    await db["Therapists"].insert_one({"_id": "t1", "expoPushToken": "ExponentPushToken[kept]", "version": 1})
+    notifier.tokens.set("p1", "ExponentPushToken[gone]")
+    notifier.tokens.set("t1", "ExponentPushToken[kept]")
+    queue.db = db
+
+    await queue._deactivate(["ExponentPushToken[gone]"])
+
+    assert (await db["Patients"].find_one({"_id": "p1"}))["expoPushToken"] is None
+    assert notifier.tokens.get("p1", "missing") == "missing"
+    assert notifier.tokens.get("t1") == "ExponentPushToken[kept]"
@@ -0,0 +1,129 @@
+import asyncio
+import pytest
+from app import media
+
+pytestmark = pytest.mark.anyio
+
+PDF = b"%PDF-1.4\n" + b"0" * 64
+
+
+@pytest.fixture
+def saturated(monkeypatch, tmp_path):
+    """A queue that fills up between the full() check and submit()."""
+    def submit(key):
+        raise asyncio.QueueFull
+
+    monkeypatch.setenv("MEDIA_SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(media.queue, "full", lambda: False)
+    monkeypatch.setattr(media.queue, "submit", submit)
+    return tmp_path
+
+
+async def test_upload_rolls_back_when_queue_fills(client, db, saturated):
+    response = await client.post("/upload_video", files={"file": ("a.pdf", PDF, "application/pdf")})
+
+    assert response.status_code == 503
+    assert await db["Videos"].count_documents({}) == 0
+    assert list(saturated.iterdir()) == []
+
+
+async def test_complete_upload_returns_to_pending_when_queue_fills(client, db, saturated):
+    await db["Videos"].insert_one({"_id": "a.pdf", "owner_id": "t1", "status": "pending"})
+    response = await client.post("/upload_complete/a.pdf")
+
+    assert response.status_code == 503
+    assert (await db["Videos"].find_one({"_id": "a.pdf"}))["status"] == "pending"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    from moto import mock_aws
+    from app import integrations
+    monkeypatch.setenv("PATIENTVIDS_KEY_ID", "testing")
+    monkeypatch.setenv("PATIENTVIDS_SECRET_KEY", "testing")
+    monkeypatch.setenv("PATIENTVIDS_REGION", "us-east-1")
+    with mock_aws():
+        integrations.get_s3_resource.cache_clear()
+        client = integrations.get_s3_client()
+        for bucket in media.UPLOAD_BUCKETS.values():
+            client.create_bucket(Bucket=bucket)
+        yield client
+    integrations.get_s3_resource.cache_clear()
+
+
+@pytest.fixture
+def worker(db, monkeypatch):
+    """The media queue without its workers; ``run_next`` processes one job."""
+    monkeypatch.setattr(media.queue, "videoCollection", db["Videos"])
+    monkeypatch.setattr(media.queue, "_queue", asyncio.Queue(10))
+
+    async def run_next():
+        await media.queue._run(media.queue._queue.get_nowait())
+    return run_next
+
+
+async def presign(client) -> dict:
+    response = await client.post("/upload_url", json={
+        "owner_id": "p1", "kind": "patient", "content_type": "application/pdf", "size": len(PDF)})
+    assert response.status_code == 200
+    upload = response.json()
+    assert upload["fields"]["key"] == upload["key"]
+    assert upload["fields"]["Content-Type"] == "application/pdf"
+    return upload
+
+
+async def status(client, key: str) -> dict:
+    response = await client.get(f"/upload_status/{key}")
+    assert response.status_code == 200
+    return response.json()
+
+
+async def test_presigned_upload_verified(client, s3, worker):
+    upload = await presign(client)
+    key = upload["key"]
+    assert (await status(client, key))["status"] == "pending"
+
+    s3.put_object(Bucket=media.PATIENT_VIDEOS_BUCKET, Key=key, Body=PDF, ContentType="application/pdf")
+    response = await client.post(f"/upload_complete/{key}")
+    assert response.status_code == 202
+    assert response.json()["status"] == "queued"
+    await worker()
+
+    video = await status(client, key)
+    assert video["status"] == "uploaded"
+    assert video["size"] == len(PDF)
+    assert video["attempts"] == 1
+    assert "spool_path" not in video and "owner" not in video
+    # Completing again changes nothing
+    assert (await client.post(f"/upload_complete/{key}")).json()["status"] == "uploaded"
+
+
+async def test_upload_complete_before_object_exists(client, s3, worker):
+    key = (await presign(client))["key"]
+
+    assert (await client.post(f"/upload_complete/{key}")).status_code == 202
+    await worker()
+    video = await status(client, key)
+    assert video["status"] == "pending"
+    assert video["error"] == "File has not been uploaded yet"
+
+    # The client uploads after all and calls again
+    s3.put_object(Bucket=media.PATIENT_VIDEOS_BUCKET, Key=key, Body=PDF, ContentType="application/pdf")
+    assert (await client.post(f"/upload_complete/{key}")).json()["status"] == "queued"
+    await worker()
+    assert (await status(client, key))["status"] == "uploaded"
+
+
+async def test_presigned_upload_of_the_wrong_type_is_rejected(client, s3, worker):
+    key = (await presign(client))["key"]
+    s3.put_object(Bucket=media.PATIENT_VIDEOS_BUCKET, Key=key, Body=b"not a pdf at all", ContentType="application/pdf")
+
+    await client.post(f"/upload_complete/{key}")
+    await worker()
+
+    assert (await status(client, key))["status"] == "rejected"
+    assert "Contents" not in s3.list_objects_v2(Bucket=media.PATIENT_VIDEOS_BUCKET)
+
+
+async def test_upload_complete_unknown_key(client, s3, worker):
+    assert (await client.post("/upload_complete/missing.pdf")).status_code == 404